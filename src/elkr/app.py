@@ -7,21 +7,40 @@ from gi.repository import Gst, GObject, GLib, Adw
 
 from .ui.main_window import MainWindow
 from .pipeline import Pipeline
+from .devices import Devices, default_cache_path
+from .control import ControlServer
+from .ticker import Ticker
 
 class App(Adw.Application):
-    def __init__(self, debug=False, **kwargs):
+    def __init__(self, debug=False, socket_path=None, pipeline_options=None, **kwargs):
         "Main application class"
 
         super().__init__(**kwargs)
         self.connect('activate', self.on_activate)
+        self.connect('shutdown', self.on_shutdown)
 
         self.debug = debug
-        self.pipeline = Pipeline()
+        self.pipeline = Pipeline(**(pipeline_options or {}))
+        self.devices = Devices(cache_path=default_cache_path())
+        self.ticker = Ticker(self.pipeline)
+        # The UI drives the same recorder core as the headless mode, the
+        # control socket stays available to external clients.
+        self.control = ControlServer(self.pipeline, self.devices, socket_path)
 
     def on_activate(self, app):
+        self.control.start()
         self.main_win = MainWindow(
             application=app,
             title="ELK Recorder",
             fullscreened=False
         )
         self.main_win.present()
+        # The window is usable with the cached devices while the live ones
+        # are probed
+        self.devices.start(background=True)
+
+    def on_shutdown(self, app):
+        self.devices.stop()
+        self.control.stop()
+        if self.pipeline.verifier is not None:
+            self.pipeline.verifier.shutdown()
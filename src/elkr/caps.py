@@ -0,0 +1,111 @@
+import logging
+
+import gi
+from gi.repository import Gst
+
+logger = logging.getLogger(__name__)
+
+# Rate picked when a device advertises a range of rates
+PREFERRED_RATE = 48000
+# Devices advertising a range of channels are captured with all of them
+MAX_CHANNELS = 256
+
+
+
+def native_caps(caps):
+    """
+    Picks the native format of a device out of the caps it advertises: its
+    preferred sample format, all its channels and its rate, or PREFERRED_RATE
+    if it supports several. Returns None when the caps say nothing useful.
+    """
+    if caps is None or caps.is_empty() or caps.is_any():
+        return None
+
+    structure = caps.get_structure(0).copy()
+    structure.fixate_field_nearest_int('rate', PREFERRED_RATE)
+    structure.fixate_field_nearest_int('channels', MAX_CHANNELS)
+
+    native = Gst.Caps.new_empty()
+    native.append_structure(structure)
+    native = native.fixate()
+    if not native.is_fixed():
+        return None
+    return native
+
+
+def caps_channels(caps):
+    "The channel count of caps, or None when it isn't fixed"
+    if caps is None or caps.is_empty() or caps.is_any():
+        return None
+    ok, channels = caps.get_structure(0).get_int('channels')
+    return channels if ok else None
+
+
+def stream_headers(caps):
+    "The header buffers an encoded stream carries in its caps"
+    if caps is None or caps.is_empty():
+        return []
+    structure = caps.get_structure(0)
+    if not structure.has_field('streamheader'):
+        return []
+    headers = structure.get_value('streamheader')
+    return [headers[i] for i in range(len(headers))]
+
+
+def pinned_caps(caps_string):
+    "Parses caps pinned by the user, which must describe raw audio"
+    caps = Gst.Caps.from_string(caps_string)
+    if caps is None or caps.is_empty():
+        raise ValueError(f"Invalid caps '{caps_string}'")
+    if caps.get_structure(0).get_name() != 'audio/x-raw':
+        raise ValueError(f"Caps '{caps_string}' are not raw audio")
+    return caps
+
+
+def sink_template_caps(factory_name):
+    factory = Gst.ElementFactory.find(factory_name)
+    if factory is None:
+        return None
+
+    for template in factory.get_static_pad_templates():
+        if template.direction == Gst.PadDirection.SINK:
+            return template.get_caps()
+    return None
+
+
+def accepted_by(caps, factory_names):
+    "Whether fixed caps can flow into all these elements without conversion"
+    if caps is None or not caps.is_fixed():
+        return False
+
+    for name in factory_names:
+        template = sink_template_caps(name)
+        if template is None or not caps.is_subset(template):
+            return False
+    return True
+
+
+def parse_version(version):
+    "Parses a version such as '1.2.0' into a tuple of ints"
+    return tuple(int(part) for part in version.split('.')[:3])
+
+
+def pipewire_needs_copy(fixed_version=None):
+    """
+    Whether the installed PipeWire source needs the 'always-copy' workaround.
+    The release fixing the recycling of buffers still held downstream isn't
+    known for sure, so it is always needed unless fixed_version is given, in
+    which case only older sources need it.
+    """
+    if fixed_version is None:
+        return True
+    plugin = Gst.Registry.get().find_plugin('pipewire')
+    if plugin is None:
+        return True
+
+    try:
+        version = parse_version(plugin.get_version())
+    except ValueError:
+        logger.warning(f"Unknown PipeWire version '{plugin.get_version()}'")
+        return True
+    return version < fixed_version
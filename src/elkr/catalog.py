@@ -0,0 +1,283 @@
+import os, json, sqlite3, logging, threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .segments import MANIFEST_SUFFIX, manifest_path
+from .verify import CHECKSUM_SUFFIX
+from .encoder import FORMATS
+
+logger = logging.getLogger(__name__)
+
+CATALOG_NAME = 'catalog.sqlite'
+# Rows returned by a search, the UI doesn't show more anyway
+SEARCH_LIMIT = 200
+
+# Catalogs by recording directory, shared so the schema is checked once,
+# until their volume is unmounted
+catalogs = {}
+# Runs the reindexing and the searches of the UI, one at a time
+worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='elkr-catalog')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS takes (
+    take TEXT PRIMARY KEY,
+    created REAL,
+    format TEXT,
+    device TEXT,
+    channel INTEGER,
+    duration_s REAL,
+    bytes INTEGER,
+    segments TEXT,
+    gaps INTEGER,
+    complete INTEGER,
+    sha256 TEXT,
+    manifest_mtime REAL
+);
+CREATE INDEX IF NOT EXISTS takes_created ON takes (created);
+CREATE TABLE IF NOT EXISTS names (
+    stem TEXT PRIMARY KEY,
+    next_suffix INTEGER NOT NULL
+);
+"""
+
+
+def catalog_for(record_dir):
+    return catalogs.setdefault(record_dir, Catalog(record_dir))
+
+
+def drop_catalog(record_dir):
+    "Forgets the catalog of a recording directory, once its volume is gone"
+    catalogs.pop(record_dir, None)
+
+
+def read_checksums(path):
+    "The sha256 of each file of a take, from its sidecar, by file name"
+    root, _ = os.path.splitext(path)
+    checksums = {}
+    try:
+        with open(f"{root}{CHECKSUM_SUFFIX}") as f:
+            for line in f:
+                digest, _, name = line.strip().partition('  ')
+                checksums[name] = digest
+    except OSError:
+        pass
+    return checksums
+
+
+def take_checksum(checksums, segments):
+    "A single checksum for a take, the one of its file or a digest of its segments"
+    digests = [checksums.get(s['file']) for s in segments]
+    if len(digests) == 0 or None in digests:
+        return None
+    if len(digests) == 1:
+        return digests[0]
+    return ','.join(digests)
+
+
+class Catalog:
+    def __init__(self, record_dir):
+        """
+        Index of the takes recorded in a recording directory, kept in an
+        SQLite database next to them. The takes are added as they are
+        finalized, and reindex() catches up with the files it doesn't know
+        about. Each call opens its own connection, so it can be used from
+        any thread.
+        """
+        self.record_dir = record_dir
+        self.path = os.path.join(record_dir, CATALOG_NAME)
+        self.initialized = False
+        self.lock = threading.Lock()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        db.row_factory = sqlite3.Row
+        with self.lock:
+            if not self.initialized:
+                db.executescript(SCHEMA)
+                self.initialized = True
+        return db
+
+    def allocate_name(self, stem):
+        """
+        Reserves a take name derived from stem in a single statement, stem
+        itself the first time, then stem-1, stem-2... Returns None if the
+        catalog can't be used.
+        """
+        try:
+            db = self.connect()
+            try:
+                with db:
+                    row = db.execute(
+                        "INSERT INTO names (stem, next_suffix) VALUES (?, 1) "
+                        "ON CONFLICT (stem) DO UPDATE SET next_suffix = next_suffix + 1 "
+                        "RETURNING next_suffix",
+                        (stem,)
+                    ).fetchone()
+            finally:
+                db.close()
+        except sqlite3.Error as err:
+            logger.error(f"Unable to allocate a name in {self.path}: {err}")
+            return None
+
+        suffix = row['next_suffix'] - 1
+        return stem if suffix == 0 else f"{stem}-{suffix}"
+
+    def add_take(self, path, manifest, device=None, channel=None, duration_s=None, sha256=None):
+        "Adds or replaces the entry of the take recorded to path"
+        segments = manifest.get('segments', [])
+        try:
+            manifest_mtime = os.path.getmtime(manifest_path(path))
+        except OSError:
+            manifest_mtime = None
+        try:
+            created = os.path.getmtime(os.path.join(self.record_dir, segments[0]['file']))
+        except (OSError, IndexError):
+            created = manifest_mtime
+
+        row = (
+            os.path.basename(path),
+            created,
+            manifest.get('format'),
+            device,
+            channel,
+            duration_s,
+            sum(s.get('bytes', 0) for s in segments),
+            json.dumps([s['file'] for s in segments]),
+            len(manifest.get('gaps', [])),
+            int(manifest.get('complete', False)),
+            sha256,
+            manifest_mtime,
+        )
+        try:
+            db = self.connect()
+            try:
+                with db:
+                    db.execute(f"INSERT OR REPLACE INTO takes VALUES ({', '.join('?' * len(row))})", row)
+            finally:
+                db.close()
+        except sqlite3.Error as err:
+            logger.error(f"Unable to catalog {path}: {err}")
+
+    def refresh_checksum(self, path):
+        "Reads the checksum of a take from its sidecar, once it has been verified"
+        take = os.path.basename(path)
+        try:
+            db = self.connect()
+            try:
+                with db:
+                    row = db.execute("SELECT segments FROM takes WHERE take = ?", (take,)).fetchone()
+                    if row is None:
+                        return
+                    segments = [{'file': f} for f in json.loads(row['segments'] or '[]')]
+                    sha256 = take_checksum(read_checksums(path), segments)
+                    db.execute("UPDATE takes SET sha256 = ? WHERE take = ?", (sha256, take))
+            finally:
+                db.close()
+        except sqlite3.Error as err:
+            logger.error(f"Unable to update the checksum of {path}: {err}")
+
+    def search(self, query='', limit=SEARCH_LIMIT):
+        "The takes whose name or device contain query, the most recent first"
+        pattern = f"%{query}%"
+        try:
+            db = self.connect()
+            try:
+                rows = db.execute(
+                    "SELECT * FROM takes WHERE take LIKE ? OR device LIKE ? "
+                    "ORDER BY created DESC LIMIT ?",
+                    (pattern, pattern, limit)
+                ).fetchall()
+            finally:
+                db.close()
+        except sqlite3.Error as err:
+            logger.error(f"Unable to search {self.path}: {err}")
+            return []
+
+        takes = []
+        for row in rows:
+            take = dict(row)
+            take['segments'] = json.loads(take['segments'] or '[]')
+            takes.append(take)
+        return takes
+
+    def reindex(self):
+        """
+        Brings the catalog up to date with the files: the takes whose
+        manifest is new or changed are read again, the ones whose files are
+        gone are dropped. Returns the number of takes added and removed.
+        """
+        try:
+            db = self.connect()
+        except sqlite3.Error as err:
+            logger.error(f"Unable to open {self.path}: {err}")
+            return None
+
+        try:
+            known = {
+                row['take']: row['manifest_mtime']
+                for row in db.execute("SELECT take, manifest_mtime FROM takes")
+            }
+            try:
+                names = os.listdir(self.record_dir)
+            except OSError as err:
+                logger.error(f"Unable to list {self.record_dir}: {err}")
+                return None
+
+            seen = set()
+            added = 0
+            for name in names:
+                if not name.endswith(MANIFEST_SUFFIX):
+                    continue
+                manifest_file = os.path.join(self.record_dir, name)
+                try:
+                    mtime = os.path.getmtime(manifest_file)
+                    with open(manifest_file) as f:
+                        manifest = json.load(f)
+                except (OSError, ValueError) as err:
+                    logger.warning(f"Skipping unreadable manifest {manifest_file}: {err}")
+                    continue
+
+                take = manifest.get('take')
+                if take is None or manifest.get('format') not in FORMATS:
+                    continue
+                seen.add(take)
+                if known.get(take) == mtime:
+                    continue
+
+                path = os.path.join(self.record_dir, take)
+                checksum = take_checksum(read_checksums(path), manifest.get('segments', []))
+                self.add_take(
+                    path, manifest,
+                    device=manifest.get('device'),
+                    channel=manifest.get('channel'),
+                    duration_s=manifest.get('duration_s'),
+                    sha256=checksum
+                )
+                added += 1
+
+            gone = [take for take in known if take not in seen]
+            with db:
+                db.executemany("DELETE FROM takes WHERE take = ?", [(take,) for take in gone])
+        except sqlite3.Error as err:
+            logger.error(f"Unable to reindex {self.path}: {err}")
+            return None
+        finally:
+            db.close()
+
+        logger.info(f"Reindexed {self.record_dir}: {added} takes updated, {len(gone)} removed")
+        return {'updated': added, 'removed': len(gone)}
+
+    def reindex_async(self, callback=None):
+        "Reindexes from the worker thread, callback(result) is then called from it"
+        def run():
+            result = self.reindex()
+            if callback is not None:
+                callback(result)
+
+        return worker.submit(run)
+
+    def search_async(self, query, callback, limit=SEARCH_LIMIT):
+        "Searches from the worker thread, callback(takes) is then called from it"
+        def run():
+            callback(self.search(query, limit))
+
+        return worker.submit(run)
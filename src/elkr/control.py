@@ -0,0 +1,410 @@
+import os, json, logging
+
+import gi
+from gi.repository import Gio, GLib, GObject
+
+from .storage import make_record_dir, make_record_path, make_take_paths, make_resume_path
+from .encoder import FORMATS
+from .catalog import catalog_for
+from .pipeline import parse_monitor_address
+
+logger = logging.getLogger(__name__)
+
+SOCKET_NAME = 'elkr.sock'
+
+
+def default_socket_path():
+    return os.path.join(GLib.get_user_runtime_dir(), SOCKET_NAME)
+
+
+class ControlError(Exception):
+    pass
+
+
+class DeferredResponse:
+    """
+    Returned by the commands answered once some work is done off the main
+    loop. The connection reads its next command after the answer.
+    """
+    def __init__(self):
+        self.callback = None
+
+    def succeed(self, result=None):
+        "Called from the main loop"
+        response = {'ok': True}
+        if result is not None:
+            response.update(result)
+        self.callback(response)
+        return GLib.SOURCE_REMOVE
+
+    def fail(self, error):
+        "Called from the main loop"
+        self.callback({'ok': False, 'error': error})
+        return GLib.SOURCE_REMOVE
+
+
+class ControlServer(GObject.Object):
+    """
+    Exposes the recorder over a local unix socket. The protocol is line based:
+    each line is a command followed by its space separated argument, and each
+    command is answered with a single line of JSON.
+
+        start
+        stop
+        status
+        devices
+        select-device <device name>
+        inputs
+        add-input <device name>
+        remove-input <input>
+        add-sink <file path or volume root>
+        add-sink-as <format> <file path or volume root>
+        add-input-sink <input> <file path or volume root>
+        add-take <volume root>
+        remove-sink <file path>
+        resume-sink <failed file path> <file path or volume root>
+        monitor <host[:port]>
+        takes <volume root> [search]
+        reindex <volume root>
+        stop-monitor
+        metrics
+        metrics-prometheus
+    """
+
+    def __init__(self, pipeline, devices, path=None):
+        super().__init__()
+
+        self.pipeline = pipeline
+        self.devices = devices
+        self.path = path or default_socket_path()
+        self.connections = set()
+        self.service = None
+
+        self.commands = {
+            'start': self.cmd_start,
+            'stop': self.cmd_stop,
+            'status': self.cmd_status,
+            'devices': self.cmd_devices,
+            'select-device': self.cmd_select_device,
+            'inputs': self.cmd_inputs,
+            'add-input': self.cmd_add_input,
+            'remove-input': self.cmd_remove_input,
+            'add-sink': self.cmd_add_sink,
+            'add-sink-as': self.cmd_add_sink_as,
+            'add-input-sink': self.cmd_add_input_sink,
+            'add-take': self.cmd_add_take,
+            'remove-sink': self.cmd_remove_sink,
+            'resume-sink': self.cmd_resume_sink,
+            'monitor': self.cmd_monitor,
+            'takes': self.cmd_takes,
+            'reindex': self.cmd_reindex,
+            'stop-monitor': self.cmd_stop_monitor,
+            'metrics': self.cmd_metrics,
+            'metrics-prometheus': self.cmd_metrics_prometheus,
+        }
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.service = Gio.SocketService.new()
+        self.service.add_address(
+            Gio.UnixSocketAddress.new(self.path),
+            Gio.SocketType.STREAM,
+            Gio.SocketProtocol.DEFAULT,
+            None
+        )
+        self.service.connect('incoming', self.on_incoming)
+        self.service.start()
+        logger.info(f"Control socket listening on {self.path}")
+
+    def stop(self):
+        if self.service is None:
+            return
+
+        self.service.stop()
+        self.service.close()
+        self.service = None
+        for connection in list(self.connections):
+            connection.close(None)
+        self.connections.clear()
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def on_incoming(self, service, connection, source_object):
+        logger.debug("New control connection")
+        self.connections.add(connection)
+        stream = Gio.DataInputStream.new(connection.get_input_stream())
+        self.read_next_line(stream, connection)
+
+        return True
+
+    def read_next_line(self, stream, connection):
+        stream.read_line_async(GLib.PRIORITY_DEFAULT, None, self.on_line_read, connection)
+
+    def on_line_read(self, stream, result, connection):
+        try:
+            line, _ = stream.read_line_finish_utf8(result)
+        except GLib.Error as err:
+            logger.debug(f"Control connection error: {err.message}")
+            line = None
+
+        if line is None:
+            logger.debug("Control connection closed")
+            self.connections.discard(connection)
+            connection.close(None)
+            return
+
+        response = self.handle_line(line.strip())
+        if isinstance(response, DeferredResponse):
+            response.callback = lambda response: self.answer(stream, connection, response)
+            return
+        self.answer(stream, connection, response)
+
+    def answer(self, stream, connection, response):
+        if connection not in self.connections:
+            return
+
+        data = (json.dumps(response) + "\n").encode('utf-8')
+        try:
+            connection.get_output_stream().write_all(data, None)
+        except GLib.Error as err:
+            logger.warning(f"Unable to answer control command: {err.message}")
+
+        self.read_next_line(stream, connection)
+
+    def handle_line(self, line):
+        if len(line) == 0:
+            return {'ok': False, 'error': 'empty command'}
+
+        command, _, argument = line.partition(' ')
+        if command not in self.commands:
+            return {'ok': False, 'error': f"unknown command '{command}'"}
+
+        logger.debug(f"Control command: {line}")
+        try:
+            result = self.commands[command](argument.strip())
+        except ControlError as err:
+            return {'ok': False, 'error': str(err)}
+        except Exception as err:
+            logger.exception(f"Control command '{line}' failed")
+            return {'ok': False, 'error': f"{type(err).__name__}: {err}"}
+
+        if isinstance(result, DeferredResponse):
+            return result
+
+        response = {'ok': True}
+        if result is not None:
+            response.update(result)
+        return response
+
+    def cmd_start(self, _):
+        self.pipeline.start()
+
+    def cmd_stop(self, _):
+        self.pipeline.stop()
+
+    def cmd_status(self, _):
+        return {
+            'state': self.pipeline.current_state.value_nick,
+            'position': self.pipeline.current_position,
+            'device': self.pipeline.device_name,
+            'can_record': self.pipeline.can_record,
+            'preroll': self.pipeline.preroll_stats(),
+            'verifying': [] if self.pipeline.verifier is None else list(self.pipeline.verifier.takes),
+            'monitor': self.pipeline.monitor_stats(),
+            'gates': {input: self.pipeline.gate_stats(input) for input in self.pipeline.inputs},
+            'failed': [path for path, h in self.pipeline.filesinks.items() if h['failed']],
+            'sinks': {
+                path: self.pipeline.filesink_stats(path)
+                for path in self.pipeline.filesinks
+            },
+        }
+
+    def cmd_devices(self, _):
+        return {'devices': self.devices.names()}
+
+    def cmd_select_device(self, name):
+        if name not in self.devices:
+            raise ControlError(f"unknown device '{name}'")
+        self.pipeline.select_device(self.devices[name])
+
+    def parse_input(self, argument):
+        try:
+            input = int(argument)
+        except ValueError:
+            raise ControlError(f"invalid input '{argument}'")
+        if input not in self.pipeline.inputs:
+            raise ControlError(f"unknown input {input}")
+        return input
+
+    def cmd_inputs(self, _):
+        return {
+            'inputs': {
+                input: inp['device_name']
+                for input, inp in self.pipeline.inputs.items()
+            },
+        }
+
+    def cmd_add_input(self, name):
+        if name not in self.devices:
+            raise ControlError(f"unknown device '{name}'")
+        input = self.pipeline.add_input()
+        if input is None:
+            raise ControlError("inputs can only be added while stopped")
+        self.pipeline.select_device(self.devices[name], input)
+        return {'input': input}
+
+    def cmd_remove_input(self, argument):
+        input = self.parse_input(argument)
+        if input == 0:
+            raise ControlError("the first input can't be removed")
+        self.pipeline.remove_input(input)
+        if input in self.pipeline.inputs:
+            raise ControlError(f"unable to remove input {input}")
+
+    def cmd_add_sink(self, path, format=None, input=0):
+        if len(path) == 0:
+            raise ControlError("add-sink requires a path")
+        if format is None:
+            format = self.pipeline.default_format
+
+        channels = None
+        if self.pipeline.split_channels:
+            channels = self.pipeline.input_channels(input)
+
+        if os.path.isdir(path):
+            record_dir = make_record_dir(path)
+            path = make_record_path(record_dir, FORMATS[format]['ext'], channels=channels,
+                                    catalog=catalog_for(record_dir))
+            if path is None:
+                raise ControlError(f"unable to find a free file name in {record_dir}")
+
+        if path in self.pipeline.filesinks:
+            raise ControlError(f"already recording to {path}")
+
+        if channels is not None:
+            paths = self.pipeline.add_split_filesinks(path, format=format, input=input)
+            if paths is None:
+                raise ControlError(f"unable to record to {path}")
+            self.check_added(paths.values())
+            return {'paths': paths, 'format': format, 'input': input}
+
+        if self.pipeline.add_filesink(path, format=format, input=input) is None:
+            raise ControlError(f"unable to record to {path}")
+        return {'path': path, 'format': format, 'input': input}
+
+    def check_added(self, paths):
+        "Removes the files of a take when one of them could not be added"
+        missing = [path for path in paths if path not in self.pipeline.filesinks]
+        if len(missing) == 0:
+            return
+        for path in paths:
+            if path in self.pipeline.filesinks:
+                self.pipeline.remove_filesink(path)
+        raise ControlError(f"unable to record to {', '.join(missing)}")
+
+    def cmd_add_input_sink(self, argument):
+        input, _, path = argument.partition(' ')
+        return self.cmd_add_sink(path.strip(), input=self.parse_input(input))
+
+    def cmd_add_take(self, root):
+        "Records every input to its own file of the same take, starting aligned"
+        if not os.path.isdir(root):
+            raise ControlError("add-take requires a volume root")
+        format = self.pipeline.default_format
+
+        record_dir = make_record_dir(root)
+        paths = make_take_paths(record_dir, list(self.pipeline.inputs), FORMATS[format]['ext'],
+                                catalog=catalog_for(record_dir))
+        if paths is None:
+            raise ControlError(f"unable to find a free take name in {record_dir}")
+
+        self.pipeline.add_filesinks(paths, format=format)
+        self.check_added(paths.values())
+        return {'paths': paths, 'format': format}
+
+    def cmd_add_sink_as(self, argument):
+        format, _, path = argument.partition(' ')
+        if format not in FORMATS:
+            raise ControlError(f"unknown format '{format}'")
+        return self.cmd_add_sink(path.strip(), format)
+
+    def cmd_remove_sink(self, path):
+        if path not in self.pipeline.filesinks or self.pipeline.filesinks[path]['removing']:
+            raise ControlError(f"not recording to {path}")
+        self.pipeline.remove_filesink(path)
+
+    def cmd_resume_sink(self, argument):
+        failed_path, _, path = argument.partition(' ')
+        path = path.strip()
+        h = self.pipeline.filesinks.get(failed_path)
+        if h is None or not h['failed'] or h['removing']:
+            raise ControlError(f"no failed recording to {failed_path}")
+        if len(path) == 0:
+            raise ControlError("resume-sink requires a path")
+
+        if os.path.isdir(path):
+            record_dir = make_record_dir(path)
+            path = make_resume_path(record_dir, failed_path)
+            if path is None:
+                raise ControlError(f"unable to find a free file name in {record_dir}")
+
+        if path in self.pipeline.filesinks:
+            raise ControlError(f"already recording to {path}")
+
+        if self.pipeline.resume_filesink(failed_path, path) is None:
+            raise ControlError(f"unable to resume {failed_path}")
+        return {'path': path, 'resumed': failed_path}
+
+    def cmd_monitor(self, address):
+        if len(address) == 0:
+            raise ControlError("monitor requires a host")
+        if self.pipeline.monitor is not None:
+            raise ControlError("already monitoring, stop it first")
+        try:
+            host, port = parse_monitor_address(address)
+        except ValueError as err:
+            raise ControlError(str(err))
+        if self.pipeline.start_monitor(host, port) is None:
+            raise ControlError(f"unable to monitor to {address}")
+        return {'monitor': self.pipeline.monitor_stats()}
+
+    def cmd_stop_monitor(self, _):
+        if self.pipeline.monitor is None:
+            raise ControlError("not monitoring")
+        self.pipeline.stop_monitor()
+
+    def parse_root(self, root):
+        if not os.path.isdir(root):
+            raise ControlError(f"no volume root at '{root}'")
+        return make_record_dir(root)
+
+    def cmd_takes(self, argument):
+        root, _, query = argument.partition(' ')
+        catalog = catalog_for(self.parse_root(root))
+        return {'takes': catalog.search(query.strip())}
+
+    def cmd_reindex(self, root):
+        # A large archive takes a while to scan, answered once done
+        deferred = DeferredResponse()
+
+        def on_reindexed(result):
+            if result is None:
+                GLib.idle_add(deferred.fail, f"unable to reindex {root}")
+            else:
+                GLib.idle_add(deferred.succeed, result)
+
+        catalog_for(self.parse_root(root)).reindex_async(on_reindexed)
+        return deferred
+
+    def cmd_metrics(self, _):
+        if self.pipeline.metrics is None:
+            raise ControlError("metrics are disabled")
+        return {'metrics': self.pipeline.metrics.collect()}
+
+    def cmd_metrics_prometheus(self, _):
+        if self.pipeline.metrics is None:
+            raise ControlError("metrics are disabled")
+        return {'text': self.pipeline.metrics.to_prometheus()}
@@ -0,0 +1,232 @@
+import os, json, logging, threading
+from types import SimpleNamespace
+
+import gi
+from gi.repository import Gst, GObject, GLib
+
+logger = logging.getLogger(__name__)
+
+CACHE_NAME = 'devices.json'
+# Types of the source properties kept to recreate a cached device
+CACHED_PROPERTY_TYPES = (GObject.TYPE_STRING, GObject.TYPE_INT, GObject.TYPE_UINT, GObject.TYPE_BOOLEAN)
+
+
+def default_cache_path():
+    return os.path.join(GLib.get_user_cache_dir(), 'elkr', CACHE_NAME)
+
+
+def element_recipe(element):
+    "Returns what it takes to create the same source element again, as a dict"
+    properties = {}
+    for pspec in element.list_properties():
+        if pspec.name == 'name' or pspec.value_type not in CACHED_PROPERTY_TYPES:
+            continue
+        if not pspec.flags & GObject.ParamFlags.WRITABLE:
+            continue
+        value = element.get_property(pspec.name)
+        if value is not None and value != pspec.get_default_value():
+            properties[pspec.name] = value
+
+    return {'factory': element.get_factory().get_name(), 'properties': properties}
+
+
+class CachedDevice:
+    def __init__(self, name, factory, properties, caps=None):
+        """
+        A device known from the last run. It creates the source element from
+        its recipe, so it can be recorded from before the device monitor
+        found it again.
+        """
+        self.props = SimpleNamespace(display_name=name)
+        self.factory = factory
+        self.properties = properties
+        self.caps = caps
+
+    def create_element(self, name=None):
+        element = Gst.ElementFactory.make(self.factory, name)
+        if element is None:
+            return None
+        for key, value in self.properties.items():
+            element.set_property(key, value)
+        return element
+
+    def get_caps(self):
+        "The caps negotiated during the last run, or None"
+        if self.caps is None:
+            return None
+        return Gst.Caps.from_string(self.caps)
+
+
+class Devices(GObject.Object):
+    @GObject.Signal(name='device-added', flags=GObject.SignalFlags.RUN_LAST,
+                    arg_types=(str,),
+                    return_type=None)
+    def device_added(self, *args):
+        pass
+
+    @GObject.Signal(name='device-removed', flags=GObject.SignalFlags.RUN_LAST,
+                    arg_types=(str,),
+                    return_type=None)
+    def device_removed(self, *args):
+        pass
+
+    def __init__(self, cache_path=None):
+        """
+        Keeps track of the audio sources available on the system. With a
+        cache_path, the devices of the last run are available right away and
+        reconciled with the live ones once the monitor is started.
+        """
+        super().__init__()
+
+        self.devices = {}
+        self.cache_path = cache_path
+        self.cache = {'devices': {}, 'selected': None}
+        self.started = False
+
+        self.monitor = Gst.DeviceMonitor.new()
+        self.monitor.add_filter("Audio/Source", None)
+
+        monitor_bus = self.monitor.get_bus()
+        monitor_bus.add_signal_watch()
+        monitor_bus.connect('message', self.on_device_monitor_message)
+
+        if self.cache_path is not None:
+            self.load_cache()
+
+    def __getitem__(self, name):
+        return self.devices[name]
+
+    def __contains__(self, name):
+        return name in self.devices
+
+    def names(self):
+        return list(self.devices.keys())
+
+    @property
+    def selected(self):
+        "The device selected during the last run, if it is known"
+        name = self.cache['selected']
+        return name if name in self.devices else None
+
+    def start(self, background=False):
+        """
+        Starts monitoring the devices. Probing them can take seconds on some
+        systems, in the background it happens in a worker thread and the
+        devices are reconciled from the main loop once it is done.
+        """
+        if not background:
+            self.monitor.start()
+            self.on_monitor_started()
+            return
+
+        def start_monitor():
+            self.monitor.start()
+            GLib.idle_add(self.on_monitor_started)
+
+        thread = threading.Thread(target=start_monitor, name='elkr-device-probe', daemon=True)
+        thread.start()
+
+    def on_monitor_started(self):
+        self.reconcile()
+        self.started = True
+        self.save_cache()
+        return GLib.SOURCE_REMOVE
+
+    def stop(self):
+        self.monitor.stop()
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path) as f:
+                self.cache = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as err:
+            logger.warning(f"Ignoring the device cache {self.cache_path}: {err}")
+            return
+
+        for name, entry in self.cache['devices'].items():
+            self.devices[name] = CachedDevice(name, entry['factory'], entry['properties'], entry.get('caps'))
+        logger.debug(f"Loaded {len(self.devices)} cached devices")
+
+    def save_cache(self):
+        if self.cache_path is None:
+            return
+
+        tmp = f"{self.cache_path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(self.cache, f, indent=2)
+            os.replace(tmp, self.cache_path)
+        except OSError as err:
+            logger.warning(f"Unable to write the device cache {self.cache_path}: {err}")
+
+    def remember(self, name, caps=None):
+        "Records the selected device and, once known, its negotiated caps"
+        self.cache['selected'] = name
+        entry = self.cache['devices'].get(name)
+        if entry is not None and caps is not None:
+            entry['caps'] = caps.to_string()
+        self.save_cache()
+
+    def cache_device(self, name, device):
+        element = device.create_element()
+        if element is None:
+            return
+        entry = element_recipe(element)
+        entry['caps'] = self.cache['devices'].get(name, {}).get('caps')
+        self.cache['devices'][name] = entry
+
+    def reconcile(self):
+        "Replaces the cached devices with the live ones, dropping the vanished ones"
+        live = {device.props.display_name: device for device in self.monitor.get_devices()}
+
+        for name in list(self.devices):
+            if name not in live and isinstance(self.devices[name], CachedDevice):
+                logger.info(f"Cached device is gone: {name}")
+                del self.devices[name]
+                self.cache['devices'].pop(name, None)
+                self.emit('device-removed', name)
+
+        for name, device in live.items():
+            self.cache_device(name, device)
+            self.on_device_added(device)
+
+    def on_device_monitor_message(self, bus, message):
+        # The int cast works around the bug described in
+        # https://bugzilla.gnome.org/show_bug.cgi?id=786948
+        # This didn't exist in more recent versions of gst/gst-python
+        t = int(message.type)
+
+        if t == int(Gst.MessageType.DEVICE_ADDED):
+            device = message.parse_device_added()
+            self.on_device_added(device)
+        elif t == int(Gst.MessageType.DEVICE_REMOVED):
+            device = message.parse_device_removed()
+            self.on_device_removed(device)
+
+    def on_device_added(self, device):
+        name = device.props.display_name
+        known = name in self.devices
+        if known and not isinstance(self.devices[name], CachedDevice):
+            return
+
+        logger.info(f"Discovered device: {name}")
+        self.devices[name] = device
+        if self.started:
+            self.cache_device(name, device)
+            self.save_cache()
+        # A cached device is already listed
+        if not known:
+            self.emit('device-added', name)
+
+    def on_device_removed(self, device):
+        name = device.props.display_name
+        logger.info(f"Device removed: {name}")
+
+        if name in self.devices:
+            del self.devices[name]
+        self.cache['devices'].pop(name, None)
+        self.save_cache()
+        self.emit('device-removed', name)
@@ -0,0 +1,211 @@
+import time, logging, threading
+
+import gi
+from gi.repository import Gst, GObject, GLib
+
+logger = logging.getLogger(__name__)
+
+# Recording formats, each sink picks one. Shared formats are encoded only
+# once whatever the number of sinks using it. The others start their stream
+# with a header written once and rewritten at its end, so each of their
+# sinks gets an encoder of its own.
+FORMAT_WAVPACK = 'wavpack'
+FORMAT_FLAC = 'flac'
+FORMAT_WAV = 'wav'
+FORMAT_PREVIEW = 'preview'
+# Formats are segmentable when every piece of the stream can be decoded on
+# its own, wav needs its header rewritten at the end of the file.
+FORMATS = {
+    FORMAT_WAVPACK: {'ext': 'wv', 'segmentable': True, 'shared': True},
+    FORMAT_FLAC: {'ext': 'flac', 'segmentable': True, 'shared': False},
+    FORMAT_WAV: {'ext': 'wav', 'segmentable': False, 'shared': False},
+    # Low bitrate stereo Opus, for quick listening
+    FORMAT_PREVIEW: {'ext': 'ogg', 'segmentable': True, 'shared': False},
+}
+PREVIEW_BITRATE = 64000
+
+# Let the pipeline pick the wavpack mode from the measured CPU headroom
+ENCODER_MODE_AUTO = 'auto'
+# Wavpack modes from the fastest to the highest compression ratio
+ENCODER_MODES = (1, 2, 3, 4)
+# The encoder must run this many times faster than real time to be picked,
+# leaving room for capture, the other threads and load spikes.
+ENCODER_HEADROOM = 3.0
+CALIBRATION_DURATION_S = 2
+CALIBRATION_TIMEOUT_S = 30
+CALIBRATION_SAMPLES_PER_BUFFER = 1024
+# The encoder is falling behind when one of the queues feeding it stays
+# this full
+INPUT_QUEUE_BEHIND_RATIO = 0.5
+STEP_DOWN_AFTER_S = 3
+
+
+def queue_fill_level(queue):
+    "How full a queue is, relative to the first of its limits it would reach"
+    levels = (
+        (queue.props.current_level_time, queue.props.max_size_time),
+        (queue.props.current_level_buffers, queue.props.max_size_buffers),
+        (queue.props.current_level_bytes, queue.props.max_size_bytes),
+    )
+    return max((level / limit for level, limit in levels if limit > 0), default=0)
+
+
+def measure_encoder_speed(caps, mode, md5):
+    """
+    Encodes CALIBRATION_DURATION_S of noise as fast as possible and returns
+    how many times faster than real time it ran, or None on failure.
+    """
+    structure = caps.get_structure(0)
+    _, rate = structure.get_int('rate')
+    num_buffers = max(1, int(CALIBRATION_DURATION_S * rate / CALIBRATION_SAMPLES_PER_BUFFER))
+    audio_duration = num_buffers * CALIBRATION_SAMPLES_PER_BUFFER / rate
+
+    pipeline = Gst.parse_launch(
+        f"audiotestsrc wave=pink-noise is-live=false num-buffers={num_buffers} "
+        f"samplesperbuffer={CALIBRATION_SAMPLES_PER_BUFFER} "
+        f"! capsfilter name=caps ! audioconvert "
+        f"! wavpackenc mode={mode} md5={'true' if md5 else 'false'} "
+        f"! fakesink sync=false"
+    )
+    pipeline.get_by_name('caps').props.caps = caps
+
+    started_at = time.monotonic()
+    pipeline.set_state(Gst.State.PLAYING)
+    message = pipeline.get_bus().timed_pop_filtered(
+        CALIBRATION_TIMEOUT_S * Gst.SECOND,
+        Gst.MessageType.EOS | Gst.MessageType.ERROR
+    )
+    elapsed = time.monotonic() - started_at
+    pipeline.set_state(Gst.State.NULL)
+
+    if message is None or message.type != Gst.MessageType.EOS:
+        return None
+    return audio_duration / elapsed
+
+
+def calibration_caps(caps):
+    "Picks a fixed format out of the caps a device advertises"
+    caps = caps.copy()
+    caps = caps.fixate()
+    if caps.is_empty() or not caps.is_fixed():
+        return None
+    return caps
+
+
+class EncoderSelector(GObject.Object):
+    @GObject.Signal(name='mode-selected', flags=GObject.SignalFlags.RUN_LAST,
+                    arg_types=(int,),
+                    return_type=None)
+    def mode_selected(self, *args):
+        pass
+
+    def __init__(self, pipeline):
+        """
+        Picks the wavpack mode of a pipeline: a calibration pass measures how
+        fast each mode encodes the capture format, and the slowest mode which
+        keeps ENCODER_HEADROOM is selected. While recording, the mode is
+        stepped down when the encoder can't keep up with the input.
+        """
+        super().__init__()
+
+        self.pipeline = pipeline
+        self.speeds = {}
+        self.calibrating = None
+        self.behind_since = None
+        self.watch_id = None
+
+        self.pipeline.connect('state-changed', self.on_pipeline_state_changed)
+
+    def calibrate(self, caps):
+        caps = calibration_caps(caps)
+        if caps is None:
+            logger.warning("Unable to calibrate the encoder for non fixed caps")
+            return
+
+        key = caps.to_string()
+        if key in self.speeds:
+            self.select_mode(self.speeds[key])
+            return
+        if self.calibrating == key:
+            return
+
+        self.calibrating = key
+        thread = threading.Thread(
+            target=self.calibration_thread,
+            args=(caps, key, self.pipeline.encoder_md5),
+            name='elkr-calibration',
+            daemon=True
+        )
+        thread.start()
+
+    def calibration_thread(self, caps, key, md5):
+        speeds = {}
+        for mode in ENCODER_MODES:
+            speed = measure_encoder_speed(caps, mode, md5)
+            logger.debug(f"Wavpack mode {mode} runs at {speed}x real time for {key}")
+            speeds[mode] = speed
+            # Higher modes are only slower
+            if speed is None or speed < ENCODER_HEADROOM:
+                break
+
+        GLib.idle_add(self.on_calibration_done, key, speeds)
+
+    def on_calibration_done(self, key, speeds):
+        self.speeds[key] = speeds
+        if self.calibrating == key:
+            self.calibrating = None
+            self.select_mode(speeds)
+
+        return GLib.SOURCE_REMOVE
+
+    def select_mode(self, speeds):
+        mode = ENCODER_MODES[0]
+        for candidate in ENCODER_MODES:
+            speed = speeds.get(candidate)
+            if speed is not None and speed >= ENCODER_HEADROOM:
+                mode = candidate
+
+        logger.info(f"Selected wavpack mode {mode}")
+        self.pipeline.set_encoder_mode(mode)
+        self.emit('mode-selected', mode)
+
+    def step_down(self):
+        if self.pipeline.pending_encoder_mode is not None:
+            # Already stepped down, waiting for the branches to be rebuilt
+            return
+
+        mode = self.pipeline.encoder_mode
+        if mode <= ENCODER_MODES[0]:
+            logger.warning("The encoder is falling behind at its fastest mode")
+            return
+
+        logger.warning(f"The encoder is falling behind, stepping down to mode {mode - 1}")
+        self.pipeline.set_encoder_mode(mode - 1)
+        self.emit('mode-selected', mode - 1)
+
+    def on_pipeline_state_changed(self, _, old_state, new_state):
+        if new_state == 'playing' and self.watch_id is None:
+            self.behind_since = None
+            self.watch_id = GLib.timeout_add_seconds(1, self.on_watch)
+        elif new_state != 'playing' and self.watch_id is not None:
+            GLib.source_remove(self.watch_id)
+            self.watch_id = None
+
+    def on_watch(self):
+        """
+        Watches the input queues and the queues of every wavpack encoder,
+        per branch and per channel, as any of them fills up when its
+        encoder can't keep up.
+        """
+        now = GLib.get_monotonic_time()
+        fill_level = max((queue_fill_level(queue) for queue in self.pipeline.encoder_queues()), default=0)
+        if fill_level >= INPUT_QUEUE_BEHIND_RATIO:
+            if self.behind_since is None:
+                self.behind_since = now
+            elif now - self.behind_since >= STEP_DOWN_AFTER_S * 1000000:
+                self.behind_since = None
+                self.step_down()
+        else:
+            self.behind_since = None
+
+        return GLib.SOURCE_CONTINUE
@@ -0,0 +1,448 @@
+import os, time, mmap, fcntl, ctypes, logging, threading
+from collections import deque
+
+import gi
+from gi.repository import Gst, GLib
+
+from .caps import stream_headers
+
+logger = logging.getLogger(__name__)
+
+# Write strategies of the destinations:
+# - filesink: the plain GStreamer filesink, buffered by libc
+# - flash: batches aligned to the erase block, preallocated extents
+# - auto: flash on the filesystems of SD cards and USB sticks, filesink otherwise
+WRITE_STRATEGY_FILESINK = 'filesink'
+WRITE_STRATEGY_FLASH = 'flash'
+WRITE_STRATEGY_AUTO = 'auto'
+WRITE_STRATEGIES = (WRITE_STRATEGY_FILESINK, WRITE_STRATEGY_FLASH, WRITE_STRATEGY_AUTO)
+FLASH_FILESYSTEMS = ('vfat', 'msdos', 'exfat')
+
+# Batch size when the erase block of the device isn't known
+FLASH_BATCH_BYTES = 4 * pow(1024, 2)
+# Smaller values reported by the kernel are sectors or pages, not erase blocks
+FLASH_MIN_ERASE_BLOCK_BYTES = 64 * 1024
+# Files grow by extents this large, trimmed once closed
+FLASH_PREALLOCATE_BYTES = 64 * pow(1024, 2)
+# O_DIRECT writes are aligned to this many bytes, in memory and in the file
+DIRECT_IO_ALIGN = 4096
+
+FALLOC_FL_KEEP_SIZE = 0x01
+
+libc = ctypes.CDLL(None, use_errno=True)
+fallocate = getattr(libc, 'fallocate64', libc.fallocate)
+fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+fallocate.restype = ctypes.c_int
+
+
+def mount_filesystem(path):
+    "The filesystem type of the mount holding path, from /proc/self/mountinfo"
+    path = os.path.realpath(path)
+    best, fstype = '', None
+    try:
+        with open('/proc/self/mountinfo') as f:
+            for line in f:
+                fields, _, rest = line.partition(' - ')
+                mount_point = fields.split()[4].replace('\\040', ' ')
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and \
+                        len(mount_point) >= len(best):
+                    best, fstype = mount_point, rest.split()[0]
+    except OSError:
+        return None
+    return fstype
+
+
+def erase_block_size(path):
+    """
+    The erase block of the device holding path as reported by the kernel,
+    or None. MMC devices report it, others may only report their discard
+    granularity, which is used when it is large enough to be one.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    device = os.path.realpath(f"/sys/dev/block/{os.major(st.st_dev)}:{os.minor(st.st_dev)}")
+    # The attributes are on the disk, not on its partitions
+    candidates = [device, os.path.dirname(device)]
+    for candidate in candidates:
+        for attribute in ('device/preferred_erase_size', 'queue/discard_granularity'):
+            try:
+                with open(os.path.join(candidate, attribute)) as f:
+                    size = int(f.read())
+            except (OSError, ValueError):
+                continue
+            if size >= FLASH_MIN_ERASE_BLOCK_BYTES:
+                return size
+    return None
+
+
+def resolve_write_strategy(strategy, path):
+    "The strategy writing to path, auto being resolved from its filesystem"
+    if strategy != WRITE_STRATEGY_AUTO:
+        return strategy
+    if mount_filesystem(os.path.dirname(path) or '.') in FLASH_FILESYSTEMS:
+        return WRITE_STRATEGY_FLASH
+    return WRITE_STRATEGY_FILESINK
+
+
+class FlashFile:
+    def __init__(self, path, batch_bytes, preallocate_bytes=FLASH_PREALLOCATE_BYTES, direct=False,
+                 fadvise=False):
+        """
+        A file written in batches ending on batch_bytes boundaries of the
+        file, so each write covers whole erase blocks once the filesystem
+        allocated the file contiguously, which the preallocation of large
+        extents helps with. The extents are allocated past the end of the
+        file and released when it is closed. With direct, the batches
+        bypass the page cache. With fadvise, the written ranges start their
+        writeback right away and leave the page cache.
+        """
+        self.path = path
+        self.batch_bytes = batch_bytes
+        self.preallocate_bytes = preallocate_bytes
+        self.fadvise = fadvise
+
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+        self.direct = False
+        self.aligned = None
+        if direct:
+            self.set_direct(True)
+        if fadvise:
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        # File offset the batch starts at, and the size of the file
+        self.position = 0
+        self.size = 0
+        self.allocated = 0
+        self.batch = bytearray()
+        # (end offset, pts) of the buffers not entirely written yet
+        self.pending = deque()
+        self.stats = {
+            'writes': 0,
+            'bytes': 0,
+            'preallocated_bytes': 0,
+            'max_write_s': 0.0,
+        }
+
+    def set_direct(self, direct):
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        try:
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, (flags | os.O_DIRECT) if direct else (flags & ~os.O_DIRECT))
+        except OSError as err:
+            logger.warning(f"Unable to {'enable' if direct else 'disable'} direct I/O on {self.path}: {err}")
+            return
+        self.direct = direct
+        if direct and self.aligned is None:
+            # Page aligned, as O_DIRECT requires
+            self.aligned = mmap.mmap(-1, self.batch_bytes)
+
+    def write(self, data, pts=Gst.CLOCK_TIME_NONE):
+        self.batch += data
+        if pts != Gst.CLOCK_TIME_NONE:
+            self.pending.append((self.position + len(self.batch), pts))
+
+        boundary = (self.position // self.batch_bytes + 1) * self.batch_bytes
+        while self.position + len(self.batch) >= boundary:
+            self.write_out(boundary - self.position)
+            boundary += self.batch_bytes
+
+    def write_out(self, n):
+        self.preallocate(self.position + n)
+        chunk = self.batch[:n]
+        if self.direct:
+            self.aligned[:n] = chunk
+            chunk = memoryview(self.aligned)[:n]
+
+        started_at = time.monotonic()
+        written = 0
+        try:
+            while written < n:
+                written += os.pwrite(self.fd, chunk[written:], self.position + written)
+        finally:
+            if self.direct:
+                chunk.release()
+        elapsed = time.monotonic() - started_at
+
+        if self.fadvise:
+            os.posix_fadvise(self.fd, self.position, n, os.POSIX_FADV_DONTNEED)
+        del self.batch[:n]
+        self.position += n
+        self.size = max(self.size, self.position)
+        while len(self.pending) > 0 and self.pending[0][0] <= self.position:
+            self.pending.popleft()
+
+        self.stats['writes'] += 1
+        self.stats['bytes'] += n
+        self.stats['max_write_s'] = max(self.stats['max_write_s'], elapsed)
+
+    def preallocate(self, end):
+        if self.preallocate_bytes <= 0 or end <= self.allocated:
+            return
+        allocate_to = (end // self.preallocate_bytes + 1) * self.preallocate_bytes
+        if fallocate(self.fd, FALLOC_FL_KEEP_SIZE, self.allocated, allocate_to - self.allocated) != 0:
+            err = ctypes.get_errno()
+            # Not supported, or no room left for a whole extent: the writes
+            # go on as they are
+            logger.info(f"Not preallocating {self.path} anymore: {os.strerror(err)}")
+            self.preallocate_bytes = 0
+            return
+        self.stats['preallocated_bytes'] += allocate_to - self.allocated
+        self.allocated = allocate_to
+
+    def flush(self):
+        "Writes what is batched, as much as direct I/O allows"
+        n = len(self.batch)
+        if self.direct:
+            n -= n % DIRECT_IO_ALIGN
+        if n > 0:
+            self.write_out(n)
+
+    def seek(self, offset):
+        "Moves to offset, for the encoders rewriting their headers once done"
+        if self.direct:
+            self.set_direct(False)
+        self.flush()
+        self.position = offset
+
+    @property
+    def unwritten_pts(self):
+        return self.pending[0][1] if len(self.pending) > 0 else None
+
+    def close(self):
+        "Writes the rest of the batch, then releases the extents allocated past the end"
+        try:
+            if self.direct:
+                self.set_direct(False)
+            self.flush()
+            os.ftruncate(self.fd, self.size)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+            if self.aligned is not None:
+                self.aligned.close()
+                self.aligned = None
+
+
+class FlashSink:
+    def __init__(self, location, batch_bytes=0, preallocate_bytes=FLASH_PREALLOCATE_BYTES,
+                 direct=False, fadvise=False, max_duration=0, max_size_bytes=0, on_segment_closed=None):
+        """
+        Writes the stream it receives through FlashFile. The element is a
+        fakesink with a probe doing the writes from its streaming thread.
+        When location is a pattern, a new file is started every
+        max_duration ns or max_size_bytes as multifilesink does, each
+        starting with the stream headers, and on_segment_closed(filename,
+        fields) is called with the closed ones. Otherwise it seeks as
+        filesink does. Write errors are posted as errors of the element.
+        batch_bytes is the erase block of the destination when 0.
+
+        Only whole batches reach the file before it is closed, sync() never
+        writes a partial one as that would break the alignment of all the
+        writes after it. Up to a batch of the stream is then only in memory:
+        a crash or an unplugged card loses it, on top of what a plain
+        filesink loses since its last fsync. At low bitrates a batch holds
+        many seconds, a smaller batch_bytes bounds the loss.
+        """
+        self.location = location
+        self.segmented = max_duration > 0 or max_size_bytes > 0
+        self.max_duration = max_duration
+        self.max_size_bytes = max_size_bytes
+        self.on_segment_closed = on_segment_closed
+        self.file_options = {
+            'preallocate_bytes': preallocate_bytes,
+            'direct': direct,
+            'fadvise': fadvise,
+        }
+        if batch_bytes <= 0:
+            batch_bytes = erase_block_size(os.path.dirname(location) or '.') or FLASH_BATCH_BYTES
+        if direct:
+            batch_bytes += -batch_bytes % DIRECT_IO_ALIGN
+        self.batch_bytes = batch_bytes
+
+        # Only guards the swaps of self.file, the writes are done outside
+        # of it by the streaming thread, the only one writing
+        self.lock = threading.Lock()
+        self.file = None
+        self.index = 0
+        self.file_start = None
+        self.file_end = None
+        self.headers = []
+        self.failed = False
+        self.stats = {
+            'batch_bytes': batch_bytes,
+            'writes': 0,
+            'bytes': 0,
+            'preallocated_bytes': 0,
+            'max_write_s': 0.0,
+        }
+        # What the other threads read, replaced as a whole by the streaming
+        # thread so a slow write never holds them
+        self.published_stats = dict(self.stats)
+        self.published_unwritten_pts = None
+
+        self.element = Gst.ElementFactory.make('fakesink', None)
+        self.element.props.sync = False
+        self.element.props.enable_last_sample = False
+        # Nothing to preroll, the writes happen in the probe
+        self.element.set_property('async', False)
+        self.element.get_static_pad('sink').add_probe(
+            Gst.PadProbeType.BUFFER | Gst.PadProbeType.EVENT_DOWNSTREAM | Gst.PadProbeType.QUERY_DOWNSTREAM,
+            self.on_probe
+        )
+
+    @property
+    def current_path(self):
+        return self.location % self.index if self.segmented else self.location
+
+    def on_probe(self, pad, info):
+        if self.failed:
+            return Gst.PadProbeReturn.OK
+
+        try:
+            if info.type & Gst.PadProbeType.BUFFER:
+                self.on_buffer(info.get_buffer())
+            elif info.type & Gst.PadProbeType.QUERY_DOWNSTREAM:
+                return self.on_query(info.get_query())
+            else:
+                self.on_event(info.get_event())
+            self.publish()
+        except OSError as err:
+            self.failed = True
+            logger.error(f"Unable to write {self.current_path}: {err}")
+            self.element.post_message(Gst.Message.new_error(
+                self.element,
+                GLib.Error.new_literal(Gst.resource_error_quark(), f"Unable to write {self.current_path}",
+                                       Gst.ResourceError.WRITE),
+                str(err)
+            ))
+        return Gst.PadProbeReturn.OK
+
+    def on_query(self, query):
+        if query.type != Gst.QueryType.SEEKING or self.segmented:
+            return Gst.PadProbeReturn.OK
+        format = query.parse_seeking()[0]
+        if format != Gst.Format.BYTES:
+            return Gst.PadProbeReturn.OK
+        query.set_seeking(Gst.Format.BYTES, True, 0, -1)
+        return Gst.PadProbeReturn.HANDLED
+
+    def on_event(self, event):
+        if event.type == Gst.EventType.STREAM_START:
+            self.open()
+        elif event.type == Gst.EventType.CAPS:
+            self.headers = stream_headers(event.parse_caps())
+        elif event.type == Gst.EventType.SEGMENT and not self.segmented:
+            segment = event.parse_segment()
+            if segment.format == Gst.Format.BYTES:
+                self.open()
+                if segment.start != self.file.position + len(self.file.batch):
+                    self.file.seek(segment.start)
+
+    def on_buffer(self, buf):
+        data = buf.extract_dup(0, buf.get_size())
+        self.open()
+        if self.segmented and self.file.size + len(self.file.batch) > 0 and \
+                not buf.has_flags(Gst.BufferFlags.HEADER) and self.should_rotate(buf, len(data)):
+            self.rotate()
+
+        if buf.pts != Gst.CLOCK_TIME_NONE:
+            if self.file_start is None:
+                self.file_start = buf.pts
+            if buf.duration != Gst.CLOCK_TIME_NONE:
+                self.file_end = buf.pts + buf.duration
+        self.file.write(data, buf.pts)
+
+    def should_rotate(self, buf, size):
+        if self.max_duration > 0:
+            return buf.pts != Gst.CLOCK_TIME_NONE and self.file_start is not None and \
+                buf.pts >= self.file_start + self.max_duration
+        return self.file.size + len(self.file.batch) + size > self.max_size_bytes
+
+    def open(self):
+        if self.file is None:
+            file = FlashFile(self.current_path, self.batch_bytes, **self.file_options)
+            with self.lock:
+                self.file = file
+
+    def rotate(self):
+        "Closes the current segment and starts the next one with the stream headers"
+        filename = self.current_path
+        fields = {'index': self.index}
+        if self.file_start is not None:
+            fields['timestamp'] = self.file_start
+            if self.file_end is not None:
+                fields['duration'] = self.file_end - self.file_start
+        self.close_file()
+
+        self.index += 1
+        self.file_start = None
+        self.file_end = None
+        self.open()
+        for header in self.headers:
+            self.file.write(header.extract_dup(0, header.get_size()))
+
+        if self.on_segment_closed is not None:
+            self.on_segment_closed(filename, fields)
+
+    def close_file(self):
+        with self.lock:
+            file = self.file
+            self.file = None
+        try:
+            file.close()
+        finally:
+            self.add_stats(file.stats)
+
+    def add_stats(self, stats):
+        for key in ('writes', 'bytes', 'preallocated_bytes'):
+            self.stats[key] += stats[key]
+        self.stats['max_write_s'] = max(self.stats['max_write_s'], stats['max_write_s'])
+
+    def publish(self):
+        "Publishes the stats and the unwritten pts, from the streaming thread"
+        stats = dict(self.stats)
+        file = self.file
+        if file is not None:
+            for key in ('writes', 'bytes', 'preallocated_bytes'):
+                stats[key] += file.stats[key]
+            stats['max_write_s'] = max(stats['max_write_s'], file.stats['max_write_s'])
+        self.published_stats = stats
+        self.published_unwritten_pts = None if file is None else file.unwritten_pts
+
+    @property
+    def unwritten_pts(self):
+        "The pts of the first buffer not entirely written to the file, or None"
+        return self.published_unwritten_pts
+
+    def sync(self):
+        "Flushes the batches already written to the storage, from any thread"
+        with self.lock:
+            if self.file is None or self.failed or self.file.position == 0:
+                return
+            try:
+                fd = os.dup(self.file.fd)
+            except OSError as err:
+                logger.warning(f"Unable to sync {self.current_path}: {err}")
+                return
+        # Outside of the lock, the streaming thread keeps writing meanwhile
+        try:
+            os.fsync(fd)
+        except OSError as err:
+            logger.warning(f"Unable to sync {self.current_path}: {err}")
+        finally:
+            os.close(fd)
+
+    def close(self):
+        "Closes the last file, once the element stopped"
+        if self.file is None:
+            return
+        try:
+            self.close_file()
+        except OSError as err:
+            logger.error(f"Unable to close {self.current_path}: {err}")
+        finally:
+            self.publish()
+
+    def get_stats(self):
+        return dict(self.published_stats)
@@ -0,0 +1,141 @@
+import logging, threading
+from collections import deque
+
+import gi
+from gi.repository import Gst
+
+logger = logging.getLogger(__name__)
+
+GATE_ATTACK_S = 0.1
+GATE_HANGOVER_S = 5
+GATE_PREROLL_S = 1
+# The gate opens a level interval or so after the attack, a gated pad holds
+# this much more than the pre-roll and the attack
+GATE_DECISION_MARGIN_S = 0.25
+
+
+class Gate:
+    def __init__(self, threshold_db, attack_s=GATE_ATTACK_S, hangover_s=GATE_HANGOVER_S,
+                 preroll_s=GATE_PREROLL_S):
+        """
+        Level activated gate of the raw audio of an input. It opens once the
+        peak stayed above threshold_db for attack_s, and closes after
+        hangover_s below it. It is fed the measurements of the input level
+        element from its streaming thread, and decides on the pts of the
+        buffers, so it doesn't matter how late they reach the gated pads.
+        When opening, the preroll_s of audio before the attack are let
+        through as well. The gated buffers keep their timestamps, the gaps
+        they leave are indexed in the take manifests.
+        """
+        self.threshold_db = threshold_db
+        self.attack = int(attack_s * Gst.SECOND)
+        self.hangover = int(hangover_s * Gst.SECOND)
+        self.preroll = int(preroll_s * Gst.SECOND)
+        self.hold = self.preroll + self.attack + int(GATE_DECISION_MARGIN_S * Gst.SECOND)
+
+        self.lock = threading.Lock()
+        self.open = False
+        self.above = 0
+        self.below = 0
+        self.onset = None
+        self.ports = {}
+        self.stats = {
+            'opened': 0,
+            'gated_buffers': 0,
+            'gated_bytes': 0,
+        }
+
+    def feed(self, structure):
+        "Called with each message of the level element, from its streaming thread"
+        ok, timestamp = structure.get_clock_time('timestamp')
+        ok_duration, duration = structure.get_clock_time('duration')
+        if not ok or not ok_duration:
+            return
+        peak = max(structure.get_value('peak'))
+
+        with self.lock:
+            if peak >= self.threshold_db:
+                if self.above == 0:
+                    self.onset = timestamp
+                self.above += duration
+                self.below = 0
+                if not self.open and self.above >= self.attack:
+                    self.transition(self.onset, True)
+            else:
+                self.above = 0
+                self.below += duration
+                if self.open and self.below >= self.hangover:
+                    self.transition(timestamp + duration, False)
+
+    def transition(self, pts, open):
+        logger.debug(f"Gate {'opening' if open else 'closing'} at {pts / Gst.SECOND:.3f}s")
+        self.open = open
+        if open:
+            self.stats['opened'] += 1
+        for port in self.ports.values():
+            port['transitions'].append((pts, open))
+
+    def watch(self, pad):
+        "Gates the buffers going through pad"
+        port = {
+            'open': self.open,
+            'opened_at': None,
+            'transitions': deque(),
+            'held': deque(),
+            'releasing': False,
+        }
+        with self.lock:
+            self.ports[pad] = port
+        port['probe'] = pad.add_probe(Gst.PadProbeType.BUFFER, self.on_buffer, port)
+
+    def unwatch(self, pad):
+        with self.lock:
+            port = self.ports.pop(pad, None)
+        if port is not None:
+            pad.remove_probe(port['probe'])
+
+    def on_buffer(self, pad, info, port):
+        if port['releasing']:
+            return Gst.PadProbeReturn.OK
+
+        buf = info.get_buffer()
+        if buf.pts == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+
+        with self.lock:
+            transitions = port['transitions']
+            while len(transitions) > 0 and transitions[0][0] <= buf.pts:
+                port['opened_at'], port['open'] = transitions.popleft()
+
+        held = port['held']
+        if not port['open']:
+            # Keep what the pre-roll and the attack may need once opening
+            held.append(buf)
+            while held[0].pts < buf.pts - self.hold:
+                self.count_gated(held.popleft())
+            return Gst.PadProbeReturn.DROP
+
+        if len(held) > 0:
+            # Sends the pre-roll ahead of this buffer, from its own probe
+            port['releasing'] = True
+            release_from = port['opened_at'] - self.preroll
+            while len(held) > 0:
+                held_buf = held.popleft()
+                if held_buf.pts < release_from:
+                    self.count_gated(held_buf)
+                elif pad.push(held_buf) != Gst.FlowReturn.OK:
+                    break
+            held.clear()
+            port['releasing'] = False
+
+        return Gst.PadProbeReturn.OK
+
+    def count_gated(self, buf):
+        self.stats['gated_buffers'] += 1
+        self.stats['gated_bytes'] += buf.get_size()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['open'] = self.open
+        return stats
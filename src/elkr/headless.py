@@ -0,0 +1,102 @@
+import signal, logging
+
+import gi
+from gi.repository import GLib
+
+from .pipeline import Pipeline
+from .devices import Devices
+from .control import ControlServer
+
+logger = logging.getLogger(__name__)
+
+# Seconds given to the files to be finalized before quitting anyway
+QUIT_TIMEOUT_S = 30
+
+
+class Headless:
+    def __init__(self, socket_path=None, devices=None, pipeline_options=None, debug=False):
+        """
+        Runs the recorder without any UI, driven from a plain GLib main loop
+        and controlled through the control socket. Each of the wanted devices
+        is captured by its own input, in order.
+        """
+        self.debug = debug
+        self.wanted_devices = devices or []
+        self.loop = GLib.MainLoop()
+        self.quitting = False
+        self.finalizing = set()
+
+        self.pipeline = Pipeline(**(pipeline_options or {}))
+        for _ in self.wanted_devices[1:]:
+            self.pipeline.add_input()
+        self.devices = Devices()
+        self.devices.connect('device-added', self.on_device_added)
+        self.control = ControlServer(self.pipeline, self.devices, socket_path)
+
+    def run(self):
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGINT, self.quit)
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGTERM, self.quit)
+
+        self.control.start()
+        self.devices.start()
+
+        logger.info("Running headless")
+        self.loop.run()
+
+    def quit(self):
+        """
+        Finalizes every file being recorded before stopping the pipeline, a
+        second signal stops it right away. The signal sources stay installed
+        for that second signal
+        """
+        if self.quitting:
+            logger.warning("Stopping without waiting for the files to be finalized")
+            self.stop()
+            return GLib.SOURCE_CONTINUE
+
+        logger.info("Stopping headless recorder")
+        self.quitting = True
+        self.control.stop()
+
+        self.finalizing = set(self.pipeline.filesinks)
+        if len(self.finalizing) == 0:
+            self.stop()
+            return GLib.SOURCE_CONTINUE
+
+        self.pipeline.connect('filesink-removed', self.on_filesink_removed)
+        for path in list(self.finalizing):
+            if not self.pipeline.filesinks[path]['removing']:
+                self.pipeline.remove_filesink(path)
+        GLib.timeout_add_seconds(QUIT_TIMEOUT_S, self.on_quit_timeout)
+
+        return GLib.SOURCE_CONTINUE
+
+    def on_filesink_removed(self, _, path):
+        self.finalizing.discard(path)
+        if len(self.finalizing) == 0:
+            self.stop()
+
+    def on_quit_timeout(self):
+        if len(self.finalizing) > 0:
+            logger.error(f"Files not finalized after {QUIT_TIMEOUT_S}s: {', '.join(sorted(self.finalizing))}")
+            self.stop()
+        return GLib.SOURCE_REMOVE
+
+    def stop(self):
+        if not self.loop.is_running():
+            return
+        self.pipeline.stop()
+        self.devices.stop()
+        self.control.stop()
+        if self.pipeline.verifier is not None:
+            self.pipeline.verifier.shutdown()
+        self.loop.quit()
+
+    def on_device_added(self, devices, name):
+        if name not in self.wanted_devices:
+            return
+
+        input = self.wanted_devices.index(name)
+        if self.pipeline.inputs[input]['device_name'] is None:
+            logger.info(f"Selecting device '{name}' for input {input}")
+            self.pipeline.select_device(devices[name], input)
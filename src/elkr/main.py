@@ -1,4 +1,4 @@
-import os, sys, logging
+import os, sys, logging, argparse
 
 try:
     import gi
@@ -6,8 +6,6 @@ try:
     gi.require_version('GLib', '2.0')
     gi.require_version('GObject', '2.0')
     gi.require_version('Gst', '1.0')
-    gi.require_version('Gtk', '4.0')
-    gi.require_version('Adw', '1' )
 
     from gi.repository import Gst
 except ImportError:
@@ -18,7 +16,11 @@ except ValueError as err:
     print(f"Error loading the GI library: {err}")
     sys.exit(1)
 
-from .app import App
+from .pipeline import SINK_POLICIES, SINK_POLICY_BLOCK, MONITOR_LATENCY_MS
+from .segments import SEGMENT_DURATION_S, SEGMENT_SIZE_BYTES, FSYNC_INTERVAL_S
+from .flash import WRITE_STRATEGIES, WRITE_STRATEGY_FILESINK, FLASH_PREALLOCATE_BYTES
+from .gate import GATE_ATTACK_S, GATE_HANGOVER_S, GATE_PREROLL_S
+from .encoder import ENCODER_MODE_AUTO, ENCODER_MODES, FORMATS, FORMAT_WAVPACK
 
 DEFAULT_GST_DEBUG_DUMP_DOT_DIR = "/tmp/elkr-pipelines"
 
@@ -41,6 +43,148 @@ def setup_gst_debug_dot_dir():
             os.makedirs(DEFAULT_GST_DEBUG_DUMP_DOT_DIR)
     return os.environ["GST_DEBUG_DUMP_DOT_DIR"]
 
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='elkr', description="ELK Recorder")
+    parser.add_argument('--headless', action='store_true',
+                        help="Run without UI, controlled through the control socket")
+    parser.add_argument('--socket', default=None,
+                        help="Path of the control socket (default: $XDG_RUNTIME_DIR/elkr.sock)")
+    parser.add_argument('--device', action='append', default=None,
+                        help="Name of an input device to select when it appears, repeat it to "
+                             "capture several devices at once (headless only)")
+    parser.add_argument('--sink-policy', default=SINK_POLICY_BLOCK, choices=SINK_POLICIES,
+                        help="What to do when a recording destination can't keep up")
+    parser.add_argument('--encoder-mode', default=ENCODER_MODE_AUTO,
+                        choices=[ENCODER_MODE_AUTO] + [str(m) for m in ENCODER_MODES],
+                        help="Wavpack mode, from 1 (fastest) to 4 (smallest files)")
+    parser.add_argument('--format', default=FORMAT_WAVPACK, choices=list(FORMATS.keys()),
+                        help="Default recording format")
+    parser.add_argument('--preroll', type=float, default=0, metavar='SECONDS',
+                        help="Start recordings with the audio captured this many seconds before")
+    parser.add_argument('--segment-duration', type=float, default=SEGMENT_DURATION_S, metavar='SECONDS',
+                        help="Start a new file every SECONDS, 0 to disable")
+    parser.add_argument('--segment-size', type=int, default=SEGMENT_SIZE_BYTES, metavar='BYTES',
+                        help="Start a new file every BYTES instead, when --segment-duration is 0")
+    parser.add_argument('--fsync-interval', type=int, default=FSYNC_INTERVAL_S, metavar='SECONDS',
+                        help="Flush the file being recorded to the storage every SECONDS, 0 to disable")
+    parser.add_argument('--write-strategy', default=WRITE_STRATEGY_FILESINK, choices=WRITE_STRATEGIES,
+                        help="How the files are written: by the GStreamer filesink, in batches aligned "
+                             "to the erase block of flash media, or flash on FAT/exFAT volumes only (auto)")
+    parser.add_argument('--write-batch', type=int, default=0, metavar='BYTES',
+                        help="Size of the flash writes, 0 for the erase block of the device. Up to "
+                             "that much of a recording is only in memory until written")
+    parser.add_argument('--preallocate', type=int, default=FLASH_PREALLOCATE_BYTES, metavar='BYTES',
+                        help="Grow the files written for flash by extents of BYTES, 0 to disable")
+    parser.add_argument('--direct-io', action='store_true',
+                        help="Write for flash bypassing the page cache")
+    parser.add_argument('--fadvise', action='store_true',
+                        help="Write back and drop from the page cache what is written for flash right away")
+    parser.add_argument('--thread-affinity', default=None, metavar='ROLE=CPUS;...',
+                        help="Pin the streaming threads of each role (capture, input, encoder, writer, "
+                             "monitor, other) to CPUs, e.g. 'capture=3;encoder=0-2'")
+    parser.add_argument('--capture-priority', type=int, default=None, metavar='PRIORITY',
+                        help="Run the capture threads with this SCHED_FIFO priority, from 1 to 99, "
+                             "or a negative nice value when not allowed")
+    parser.add_argument('--worker-nice', type=int, default=None, metavar='NICE',
+                        help="Nice value of the encoder and writer threads")
+    parser.add_argument('--caps', default=None,
+                        help="Capture this raw audio format instead of the native one of the device, "
+                             "e.g. 'audio/x-raw,format=S32LE,rate=96000'")
+    parser.add_argument('--no-passthrough', action='store_true',
+                        help="Always convert the captured audio, even when it is already accepted as is")
+    parser.add_argument('--pipewire-copy-fixed-version', default=None, metavar='VERSION',
+                        help="Only copy the buffers of PipeWire sources older than this release, "
+                             "e.g. '1.2.0', instead of always")
+    parser.add_argument('--split', action='store_true',
+                        help="Record one mono file per channel, each encoded on its own thread")
+    parser.add_argument('--monitor', default=None, metavar='HOST[:PORT]',
+                        help="Stream what is captured to HOST as RTP/Opus over UDP, for listening remotely")
+    parser.add_argument('--monitor-latency', type=float, default=MONITOR_LATENCY_MS, metavar='MS',
+                        help="Audio the monitor stream may hold back before dropping it")
+    parser.add_argument('--gate', type=float, default=None, metavar='DB',
+                        help="Only record while the peak level is above DB, e.g. -40")
+    parser.add_argument('--gate-attack', type=float, default=GATE_ATTACK_S, metavar='SECONDS',
+                        help="How long the level must stay above the gate threshold to open it")
+    parser.add_argument('--gate-hangover', type=float, default=GATE_HANGOVER_S, metavar='SECONDS',
+                        help="How long the level must stay below the gate threshold to close it")
+    parser.add_argument('--gate-preroll', type=float, default=GATE_PREROLL_S, metavar='SECONDS',
+                        help="Audio recorded before the gate opens")
+    parser.add_argument('--no-verify', action='store_true',
+                        help="Don't check the recordings once they are written")
+    parser.add_argument('--no-metrics', action='store_true',
+                        help="Disable the pipeline instrumentation")
+    parser.add_argument('--metrics-file', default=None,
+                        help="Periodically write Prometheus metrics to this file")
+
+    # Unknown arguments are left to Gst and Gtk
+    return parser.parse_known_args(argv[1:])
+
+def pipeline_options(args):
+    "Returns the Pipeline keyword arguments matching the command line"
+    encoder_mode = args.encoder_mode
+    if encoder_mode != ENCODER_MODE_AUTO:
+        encoder_mode = int(encoder_mode)
+
+    return {
+        'sink_policy': args.sink_policy,
+        'encoder_mode': encoder_mode,
+        'default_format': args.format,
+        'preroll_seconds': args.preroll,
+        'segment_duration_s': args.segment_duration,
+        'segment_size_bytes': args.segment_size,
+        'fsync_interval_s': args.fsync_interval,
+        'thread_affinity': args.thread_affinity,
+        'capture_priority': args.capture_priority,
+        'worker_nice': args.worker_nice,
+        'write_strategy': args.write_strategy,
+        'write_batch_bytes': args.write_batch,
+        'preallocate_bytes': args.preallocate,
+        'direct_io': args.direct_io,
+        'fadvise': args.fadvise,
+        'metrics': not args.no_metrics,
+        'metrics_file': args.metrics_file,
+        'capture_caps': args.caps,
+        'passthrough': not args.no_passthrough,
+        'pipewire_copy_fixed_version': args.pipewire_copy_fixed_version,
+        'verify': not args.no_verify,
+        'split_channels': args.split,
+        'monitor': args.monitor,
+        'monitor_latency_ms': args.monitor_latency,
+        'gate_threshold_db': args.gate,
+        'gate_attack_s': args.gate_attack,
+        'gate_hangover_s': args.gate_hangover,
+        'gate_preroll_s': args.gate_preroll,
+    }
+
+def run_headless(args):
+    from .headless import Headless
+
+    headless = Headless(
+        socket_path=args.socket,
+        devices=args.device,
+        pipeline_options=pipeline_options(args),
+        debug=debug_enabled()
+    )
+    headless.run()
+
+def run_gui(args, argv):
+    try:
+        gi.require_version('Gtk', '4.0')
+        gi.require_version('Adw', '1' )
+    except ValueError as err:
+        print(f"Error loading the GI library: {err}")
+        sys.exit(1)
+
+    from .app import App
+
+    app = App(
+        debug=debug_enabled(),
+        socket_path=args.socket,
+        pipeline_options=pipeline_options(args),
+        application_id="io.lta.elk-recorder"
+    )
+    app.run(argv)
+
 def main():
     logger = setup_logging()
 
@@ -49,7 +193,12 @@ def main():
     dst = setup_gst_debug_dot_dir()
     logger.debug(f"Dumping gst pipeline dot dumps to: {dst}")
 
-    Gst.init(sys.argv)
+    args, rest = parse_args(sys.argv)
+    argv = sys.argv[:1] + rest
+
+    Gst.init(argv)
 
-    app = App(debug=debug_enabled(), application_id="io.lta.elk-recorder")
-    app.run(sys.argv)
+    if args.headless:
+        run_headless(args)
+    else:
+        run_gui(args, argv)
@@ -0,0 +1,277 @@
+import os, time, logging
+
+import gi
+from gi.repository import Gst, GLib
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two latency queries, they go through the whole pipeline
+LATENCY_QUERY_INTERVAL_S = 5
+METRICS_FILE_INTERVAL_S = 5
+PROMETHEUS_PREFIX = 'elkr'
+
+
+def escape_label(value):
+    "Escapes a Prometheus label value"
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def new_counter():
+    return {'buffers': 0, 'bytes': 0, 'media_time': 0}
+
+
+class Metrics:
+    def __init__(self, pipeline):
+        """
+        Low overhead instrumentation of a Pipeline. Pad probes count buffers,
+        bytes and media time at the named elements, the queues levels are
+        read when collecting, and the QoS/xrun events come from the bus.
+        The time spent in the probes themselves is accounted in probe_cpu_s.
+        """
+        self.pipeline = pipeline
+        self.counters = {}
+        self.encoders = {}
+        self.probe_time = 0.0
+        self.qos_events = {}
+        self.xruns = 0
+        self.latency = None
+        self.latency_queried_at = 0
+        self.last_collect = None
+        self.file_id = None
+
+        for input in pipeline.inputs:
+            self.watch_input(input)
+
+    def watch_input(self, input):
+        name = self.pipeline.input_name(input, 'input-queue')
+        self.watch_pad(name, self.pipeline[name].get_static_pad('src'))
+
+    def unwatch_input(self, input):
+        self.counters.pop(self.pipeline.input_name(input, 'input-queue'), None)
+
+    def watch_pad(self, name, pad):
+        self.counters[name] = new_counter()
+        pad.add_probe(Gst.PadProbeType.BUFFER, self.on_buffer, self.counters[name])
+
+    def watch_encoder(self, fmt, first, last):
+        """
+        Measures the encoding chain of a format, from the sink pad of its
+        first element to the src pad of its last one, which all run in the
+        streaming thread of the format queue.
+        """
+        encoder = {'busy': 0.0, 'media_time': 0, 'entered_at': None}
+        self.encoders[fmt] = encoder
+        self.watch_pad(f"{fmt}-encoder", last.get_static_pad('src'))
+
+        first.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, self.on_encoder_in, encoder)
+        last.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self.on_encoder_out, encoder)
+
+    def unwatch_encoder(self, fmt):
+        self.encoders.pop(fmt, None)
+        self.counters.pop(f"{fmt}-encoder", None)
+
+    def on_buffer(self, pad, info, counter):
+        started_at = time.perf_counter()
+        buf = info.get_buffer()
+        counter['buffers'] += 1
+        counter['bytes'] += buf.get_size()
+        if buf.duration != Gst.CLOCK_TIME_NONE:
+            counter['media_time'] += buf.duration
+        self.probe_time += time.perf_counter() - started_at
+        return Gst.PadProbeReturn.OK
+
+    def on_encoder_in(self, pad, info, encoder):
+        encoder['entered_at'] = time.perf_counter()
+        buf = info.get_buffer()
+        if buf.duration != Gst.CLOCK_TIME_NONE:
+            encoder['media_time'] += buf.duration
+        return Gst.PadProbeReturn.OK
+
+    def on_encoder_out(self, pad, info, encoder):
+        entered_at = encoder['entered_at']
+        if entered_at is not None:
+            encoder['busy'] += time.perf_counter() - entered_at
+            encoder['entered_at'] = None
+        return Gst.PadProbeReturn.OK
+
+    def on_bus_message(self, message):
+        t = message.type
+
+        if t == Gst.MessageType.QOS:
+            name = message.src.get_name()
+            self.qos_events[name] = self.qos_events.get(name, 0) + 1
+        elif t == Gst.MessageType.WARNING:
+            # Audio sources report overruns as warnings
+            if message.src in self.pipeline.sources().values():
+                self.xruns += 1
+
+    def query_latency(self):
+        query = Gst.Query.new_latency()
+        if self.pipeline.pipeline.query(query):
+            live, min_latency, max_latency = query.parse_latency()
+            self.latency = {
+                'live': live,
+                'min_s': min_latency / Gst.SECOND,
+                'max_s': None if max_latency == Gst.CLOCK_TIME_NONE else max_latency / Gst.SECOND,
+            }
+
+    def queue_levels(self):
+        queues = {}
+        for name, element in self.pipeline.elements.items():
+            if name.endswith('-queue'):
+                queues[name] = element
+        # By full path, takes on different volumes share their file names
+        for path, h in self.pipeline.filesinks.items():
+            queues[path] = h['queue']
+
+        levels = {}
+        for name, queue in queues.items():
+            levels[name] = {
+                'buffers': queue.props.current_level_buffers,
+                'bytes': queue.props.current_level_bytes,
+                'time_s': queue.props.current_level_time / Gst.SECOND,
+            }
+        return levels
+
+    def collect(self):
+        "Returns a snapshot of every metric, rates are computed since the previous call"
+        now = time.monotonic()
+        if now - self.latency_queried_at >= LATENCY_QUERY_INTERVAL_S:
+            self.latency_queried_at = now
+            if self.pipeline.current_state == Gst.State.PLAYING:
+                self.query_latency()
+
+        counters = {name: dict(counter) for name, counter in self.counters.items()}
+        for path, h in self.pipeline.filesinks.items():
+            stats = h['stats']
+            counters[path] = {
+                'buffers': stats['buffers_out'],
+                'bytes': stats['bytes_out'],
+            }
+
+        rates = {}
+        if self.last_collect is not None:
+            last_at, last_counters = self.last_collect
+            elapsed = now - last_at
+            for name, counter in counters.items():
+                last = last_counters.get(name)
+                if last is None or elapsed <= 0:
+                    continue
+                rates[name] = {
+                    'buffers_per_s': (counter['buffers'] - last['buffers']) / elapsed,
+                    'bytes_per_s': (counter['bytes'] - last['bytes']) / elapsed,
+                }
+        self.last_collect = (now, counters)
+
+        encoders = {}
+        for fmt, encoder in self.encoders.items():
+            media_time = encoder['media_time'] / Gst.SECOND
+            encoders[fmt] = {
+                'busy_s': encoder['busy'],
+                'media_s': media_time,
+                'rtf': encoder['busy'] / media_time if media_time > 0 else None,
+            }
+
+        return {
+            'state': self.pipeline.current_state.value_nick,
+            'counters': counters,
+            'rates': rates,
+            'queues': self.queue_levels(),
+            'encoders': encoders,
+            'latency': self.latency,
+            'qos_events': dict(self.qos_events),
+            'xruns': self.xruns,
+            'filesinks': {path: self.pipeline.filesink_stats(path) for path in self.pipeline.filesinks},
+            'monitor': self.pipeline.monitor_stats(),
+            'gates': {input: self.pipeline.gate_stats(input) for input in self.pipeline.inputs},
+            'threads': self.pipeline.thread_stats(),
+            'probe_cpu_s': self.probe_time,
+        }
+
+    def to_prometheus(self, snapshot=None):
+        "Formats a snapshot in the Prometheus text exposition format"
+        if snapshot is None:
+            snapshot = self.collect()
+        p = PROMETHEUS_PREFIX
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {p}_{name} {help}")
+            lines.append(f"# TYPE {p}_{name} {kind}")
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label_str = ','.join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+                lines.append(f"{p}_{name}{{{label_str}}} {value}")
+
+        counters = snapshot['counters']
+        metric('buffers_total', 'counter', "Buffers seen at an element",
+               [({'element': n}, c['buffers']) for n, c in counters.items()])
+        metric('bytes_total', 'counter', "Bytes seen at an element",
+               [({'element': n}, c['bytes']) for n, c in counters.items()])
+
+        queues = snapshot['queues']
+        metric('queue_level_bytes', 'gauge', "Bytes waiting in a queue",
+               [({'queue': n}, q['bytes']) for n, q in queues.items()])
+        metric('queue_level_seconds', 'gauge', "Media time waiting in a queue",
+               [({'queue': n}, q['time_s']) for n, q in queues.items()])
+
+        encoders = snapshot['encoders']
+        metric('encoder_rtf', 'gauge', "Encoding time over encoded media time",
+               [({'format': f}, e['rtf']) for f, e in encoders.items()])
+
+        sinks = snapshot['filesinks']
+        metric('filesink_dropped_buffers_total', 'counter', "Buffers a filesink never wrote",
+               [({'sink': n}, s['dropped_buffers']) for n, s in sinks.items()])
+        metric('filesink_fill_ratio', 'gauge', "Fill level of a filesink queue",
+               [({'sink': n}, s['fill_level']) for n, s in sinks.items()])
+        metric('filesink_failed', 'gauge', "Whether a filesink lost its destination",
+               [({'sink': n}, int(s['failed'])) for n, s in sinks.items()])
+        spills = {n: s['spill'] for n, s in sinks.items() if s['spill'] is not None}
+        metric('filesink_spill_bytes', 'gauge', "Audio of a failed filesink held in RAM",
+               [({'sink': n}, s['bytes']) for n, s in spills.items()])
+        metric('filesink_spill_dropped_bytes_total', 'counter', "Audio dropped from a full spill",
+               [({'sink': n}, s['dropped_bytes']) for n, s in spills.items()])
+        metric('filesink_spill_drained_bytes_total', 'counter', "Spilled audio written after resuming",
+               [({'sink': n}, s['drained_bytes']) for n, s in spills.items()])
+
+        gates = {n: g for n, g in snapshot['gates'].items() if g is not None}
+        metric('gate_open', 'gauge', "Whether the level gate of an input lets the audio through",
+               [({'input': n}, int(g['open'])) for n, g in gates.items()])
+        metric('gate_gated_bytes_total', 'counter', "Raw audio not recorded while the gate was closed",
+               [({'input': n}, g['gated_bytes']) for n, g in gates.items()])
+
+        monitor = snapshot['monitor']
+        metric('monitor_overruns_total', 'counter', "Times the monitor queue dropped audio for a slow listener",
+               [({}, monitor['overruns'] if monitor else None)])
+
+        metric('thread_cpu_seconds_total', 'counter', "CPU time of the streaming threads by role",
+               [({'role': r}, s) for r, s in snapshot['threads']['cpu_s'].items()])
+
+        latency = snapshot['latency']
+        metric('latency_seconds', 'gauge', "Minimum latency of the pipeline",
+               [({}, latency['min_s'] if latency else None)])
+        metric('qos_events_total', 'counter', "QoS messages posted by an element",
+               [({'element': n}, c) for n, c in snapshot['qos_events'].items()])
+        metric('xruns_total', 'counter', "Overruns reported by the source",
+               [({}, snapshot['xruns'])])
+        metric('probe_cpu_seconds_total', 'counter', "Time spent in the metrics probes",
+               [({}, snapshot['probe_cpu_s'])])
+
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path, interval_s=METRICS_FILE_INTERVAL_S):
+        "Periodically writes the metrics to path, for the node exporter textfile collector"
+        self.file_path = path
+        self.file_id = GLib.timeout_add_seconds(interval_s, self.on_write_file)
+
+    def on_write_file(self):
+        tmp = f"{self.file_path}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.to_prometheus())
+            os.replace(tmp, self.file_path)
+        except OSError as err:
+            logger.warning(f"Unable to write metrics to {self.file_path}: {err}")
+
+        return GLib.SOURCE_CONTINUE
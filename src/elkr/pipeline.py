@@ -1,11 +1,105 @@
-import logging
+import os, re, logging, threading
+from collections import deque
 
 import gi
 from gi.repository import Gst, GObject, GLib, GstAudio
 
+from .segments import SegmentWriter, finalizer, SEGMENT_DURATION_S, SEGMENT_SIZE_BYTES, FSYNC_INTERVAL_S
+from .metrics import Metrics
+from .verify import Verifier
+from .spill import Spill
+from .gate import Gate, GATE_ATTACK_S, GATE_HANGOVER_S, GATE_PREROLL_S
+from .caps import (
+    native_caps, pinned_caps, accepted_by, pipewire_needs_copy, parse_version, caps_channels, stream_headers
+)
+from .storage import channel_path, RECORD_DIR_NAME
+from .catalog import catalog_for
+from .threads import (
+    ThreadPolicy, parse_affinity, THREAD_ROLE_CAPTURE, THREAD_ROLE_INPUT, THREAD_ROLE_ENCODER,
+    THREAD_ROLE_WRITER, THREAD_ROLE_MONITOR, THREAD_ROLE_OTHER
+)
+from .flash import (
+    resolve_write_strategy, WRITE_STRATEGIES, WRITE_STRATEGY_FILESINK, WRITE_STRATEGY_FLASH,
+    FLASH_PREALLOCATE_BYTES
+)
+from .encoder import (
+    EncoderSelector, ENCODER_MODE_AUTO, FORMATS, FORMAT_WAVPACK, FORMAT_FLAC, FORMAT_WAV,
+    FORMAT_PREVIEW, PREVIEW_BITRATE
+)
+
 logger = logging.getLogger(__name__)
 
-FILESINK_QUEUE_SIZE_BYTES = 32 * pow(1024, 1)
+FILESINK_QUEUE_SIZE_BYTES = 2 * pow(1024, 2)
+FILESINK_SPILL_SIZE_BYTES = 256 * pow(1024, 2)
+# A sink whose queue stays above this fill ratio is falling behind
+FILESINK_FULL_RATIO = 0.9
+# Isolating a sink flushes its queue down to this ratio
+FILESINK_ISOLATED_RATIO = 0.5
+# Once isolated, a sink is reconnected when its queue drained below this ratio
+FILESINK_DRAINED_RATIO = 0.25
+# Number of seconds a sink may fall behind before being isolated, well below
+# the second of audio the queues upstream of the tees hold
+FILESINK_ISOLATE_AFTER_S = 0.3
+# Interval between two checks of the sink queues in ms
+FILESINK_WATCHDOG_MS = 100
+# Number of seconds a removed sink has to drain its queue before being torn down
+FILESINK_DRAIN_TIMEOUT_S = 10
+# Seconds of audio kept after leaving a sink queue, in case the write failed
+FILESINK_RETAIN_S = 2
+# How often the drain of a resumed sink checks whether it failed again
+SPILL_POLL_S = 0.5
+
+# Back-pressure policies of the per sink queues:
+# - block: a full queue blocks the encoder-tee, until the sink gets isolated
+# - leak: a full queue drops its oldest buffers, leaving gaps in the file
+# - spill: like block, but with a queue of FILESINK_SPILL_SIZE_BYTES in RAM
+SINK_POLICY_BLOCK = 'block'
+SINK_POLICY_LEAK = 'leak'
+SINK_POLICY_SPILL = 'spill'
+SINK_POLICIES = (SINK_POLICY_BLOCK, SINK_POLICY_LEAK, SINK_POLICY_SPILL)
+
+# Interval between two level measurements. The meters coalesce them anyway,
+# this only bounds the number of bus messages.
+LEVEL_INTERVAL_MS = 50
+
+# Extra room in the pre-roll queue, absorbing scheduling jitter
+PREROLL_MARGIN_S = 0.5
+
+# A value from 1 to 4, with 1 being the fastest and 4 the highest compression ratio
+ENCODER_MODE = 4
+
+# The elements fed by an input when its audioconvert is bypassed
+PASSTHROUGH_ELEMENTS = ('level', 'wavpackenc')
+
+# Sinks started together only keep the audio captured after this delay, so
+# every input has data reaching them by then and their files start aligned.
+SINK_ALIGN_DELAY_S = 0.2
+
+# Network monitor: RTP/Opus over UDP of what is being captured
+MONITOR_PORT = 5004
+MONITOR_BITRATE = 128000
+# Audio the monitor queue holds before dropping the oldest, the smallest
+# Opus frame fitting twice in it is used
+MONITOR_LATENCY_MS = 20
+MONITOR_FRAME_SIZES_MS = (2.5, 5, 10, 20, 40, 60)
+MONITOR_PAYLOAD_TYPE = 96
+
+
+def parse_monitor_address(address):
+    "Parses a HOST[:PORT] monitor destination"
+    host, sep, port = address.rpartition(':')
+    if len(sep) == 0:
+        return address, MONITOR_PORT
+    if len(host) == 0 or not port.isdigit():
+        raise ValueError(f"Invalid monitor port in '{address}'")
+    return host, int(port)
+
+
+def monitor_frame_size(latency_ms):
+    "The Opus frame duration in ms for a monitor latency"
+    fitting = [size for size in MONITOR_FRAME_SIZES_MS if size * 2 <= latency_ms]
+    return fitting[-1] if len(fitting) > 0 else MONITOR_FRAME_SIZES_MS[0]
+
 
 class Pipeline(GObject.Object):
     @GObject.Signal(name='state-changed', flags=GObject.SignalFlags.RUN_LAST,
@@ -15,32 +109,685 @@ class Pipeline(GObject.Object):
         # print("State changed signal", args)
         pass
 
-    def __init__(self):
+    @GObject.Signal(name='filesink-isolated', flags=GObject.SignalFlags.RUN_LAST,
+                    arg_types=(str, bool),
+                    return_type=None)
+    def filesink_isolated(self, *args):
+        pass
+
+    @GObject.Signal(name='filesink-removed', flags=GObject.SignalFlags.RUN_LAST,
+                    arg_types=(str,),
+                    return_type=None)
+    def filesink_removed(self, *args):
+        pass
+
+    @GObject.Signal(name='filesink-failed', flags=GObject.SignalFlags.RUN_LAST,
+                    arg_types=(str,),
+                    return_type=None)
+    def filesink_failed(self, *args):
+        pass
+
+    @GObject.Signal(name='filesink-resumed', flags=GObject.SignalFlags.RUN_LAST,
+                    arg_types=(str, str),
+                    return_type=None)
+    def filesink_resumed(self, *args):
+        pass
+
+    def __init__(self, sink_policy=SINK_POLICY_BLOCK,
+                 encoder_mode=ENCODER_MODE_AUTO, encoder_md5=False, default_format=FORMAT_WAVPACK,
+                 preroll_seconds=0, segment_duration_s=SEGMENT_DURATION_S,
+                 segment_size_bytes=SEGMENT_SIZE_BYTES, fsync_interval_s=FSYNC_INTERVAL_S,
+                 metrics=True, metrics_file=None, capture_caps=None, passthrough=True,
+                 verify=True, split_channels=False, monitor=None, monitor_latency_ms=MONITOR_LATENCY_MS,
+                 gate_threshold_db=None, gate_attack_s=GATE_ATTACK_S, gate_hangover_s=GATE_HANGOVER_S,
+                 gate_preroll_s=GATE_PREROLL_S, write_strategy=WRITE_STRATEGY_FILESINK, write_batch_bytes=0,
+                 preallocate_bytes=FLASH_PREALLOCATE_BYTES, direct_io=False, fadvise=False,
+                 thread_affinity=None, capture_priority=None, worker_nice=None,
+                 pipewire_copy_fixed_version=None):
         "Create the ELK Recorder pipeline"
         super().__init__()
 
+        # None captures the native format of the devices
+        self.capture_caps = None if capture_caps is None else pinned_caps(capture_caps)
+        self.passthrough = passthrough
+        # PipeWire sources always copy their buffers, unless given the
+        # release fixing them, as a tuple or its '1.2.0' form
+        if isinstance(pipewire_copy_fixed_version, str):
+            pipewire_copy_fixed_version = parse_version(pipewire_copy_fixed_version)
+        self.pipewire_copy_fixed_version = pipewire_copy_fixed_version
+        # Record one mono file per channel instead of an interleaved one
+        self.split_channels = split_channels
+
+        self.segment_duration_s = segment_duration_s
+        self.segment_size_bytes = segment_size_bytes
+        self.fsync_interval_s = fsync_interval_s
+
+        if write_strategy not in WRITE_STRATEGIES:
+            raise ValueError(f"Unknown write strategy '{write_strategy}'")
+        self.write_strategy = write_strategy
+        # How the sinks using the flash strategy write, 0 batches by erase block
+        self.flash_options = {
+            'batch_bytes': write_batch_bytes,
+            'preallocate_bytes': preallocate_bytes,
+            'direct': direct_io,
+            'fadvise': fadvise,
+        }
+
+        self.preroll_seconds = preroll_seconds
+
+        # Applied by the streaming threads as they start, thread_affinity
+        # being a dict of CPU sets by role or its 'role=cpus;...' form
+        if isinstance(thread_affinity, str):
+            thread_affinity = parse_affinity(thread_affinity)
+        self.thread_policy = ThreadPolicy(thread_affinity, capture_priority, worker_nice)
+        self.monitor_latency_ms = monitor_latency_ms
+        self.monitor = None
+
+        # Level activated recording, None records everything
+        self.gate_options = None
+        if gate_threshold_db is not None:
+            self.gate_options = {
+                'threshold_db': gate_threshold_db,
+                'attack_s': gate_attack_s,
+                'hangover_s': gate_hangover_s,
+                'preroll_s': gate_preroll_s,
+            }
+
+        if default_format not in FORMATS:
+            raise ValueError(f"Unknown format '{default_format}'")
+        self.default_format = default_format
+
+        self.encoder_selector = None
+        if encoder_mode == ENCODER_MODE_AUTO:
+            encoder_mode = ENCODER_MODE
+            self.encoder_selector = EncoderSelector(self)
+        self.encoder_mode = encoder_mode
+        self.pending_encoder_mode = None
+        self.encoder_md5 = encoder_md5
+
+        if sink_policy not in SINK_POLICIES:
+            raise ValueError(f"Unknown sink policy '{sink_policy}'")
+        self.sink_policy = sink_policy
+        self.watchdog_id = None
+
         self.pipeline = Gst.ElementFactory.make("pipeline", 'elkr-pipeline')
         self.bus = self.pipeline.get_bus()
         self.bus.add_signal_watch()
         self.bus.connect('message', self.on_bus_message)
+        # Write errors are handled from the failing thread, before the
+        # error reaches the rest of the pipeline
+        self.bus.enable_sync_message_emission()
+        self.bus.connect('sync-message::error', self.on_sync_error)
+        self.bus.connect('sync-message::element', self.on_sync_element)
+        self.bus.connect('sync-message::stream-status', self.on_stream_status)
+        # Elements of the failed filesinks, whose errors are expected
+        self.failed_elements = set()
         self.elements = {}
         self.filesinks = {}
+        # Numbers the branches encoding for a single take
+        self.private_branches = 0
+        # Each input is a source branch ending with its own raw-tee, they all
+        # share the pipeline clock
+        self.inputs = {}
+        # Cached pipeline state, kept up to date from the bus messages so we
+        # never have to block on get_state() from the main thread.
+        self.state = Gst.State.NULL
+        self.pending_state = Gst.State.VOID_PENDING
+        self.state_callbacks = []
+        self.finalize_lock = threading.Lock()
+        self.verifier = Verifier() if verify else None
+        if self.verifier is not None:
+            self.verifier.connect('verified', self.on_take_verified)
+        self.metrics = None
         self.build_pipeline()
 
+        if metrics:
+            self.metrics = Metrics(self)
+            for idx, inp in self.inputs.items():
+                for fmt in inp['formats']:
+                    self.watch_format_branch(fmt, idx)
+            if metrics_file is not None:
+                self.metrics.write_file(metrics_file)
+
+        if monitor is not None:
+            self.start_monitor(*parse_monitor_address(monitor))
+
     def build_pipeline(self):
-        self.make_and_add('capsfilter', 'src-caps')
-        self.make_and_add('queue', 'input-queue')
-        self.make_and_add('audioconvert', 'audioconvert')
-        self.add(self.make_encoder(), 'encoder')
-        self.make_and_add('tee', 'encoder-tee')
-        self.make_and_add('fakesink', 'blackhole')
+        self.build_input(0)
+
+    def input_name(self, input, name):
+        "The first input keeps the historical element names"
+        return name if input == 0 else f"in{input}-{name}"
+
+    def build_input(self, input):
+        """
+        Builds the src-caps ! input-queue ! audioconvert ! level ! raw-tee
+        chain of an input. Its input-queue starts a streaming thread of its
+        own, so the inputs are captured and encoded in parallel.
+        """
+        logger.debug(f"Building input {input}")
+        chain = ['src-caps', 'input-queue', 'audioconvert', 'level', 'raw-tee']
+        if self.preroll_seconds > 0:
+            # The live-tee feeds the monitor before the pre-roll delay
+            chain[chain.index('raw-tee'):chain.index('raw-tee')] = ['live-tee', 'preroll-queue']
+        names = [self.input_name(input, name) for name in chain]
+
+        for kind, name in zip(chain, names):
+            if kind == 'preroll-queue':
+                self.make_preroll_queue(name)
+            elif kind == 'src-caps':
+                self.make_and_add('capsfilter', name)
+            elif kind == 'input-queue':
+                self.make_and_add('queue', name)
+            elif kind in ('raw-tee', 'live-tee'):
+                self.make_and_add('tee', name)
+            else:
+                element = self.make_and_add(kind, name)
+                if kind == 'level':
+                    element.props.interval = LEVEL_INTERVAL_MS * Gst.MSECOND
+                    element.props.post_messages = True
+
+        for upstream, downstream in zip(names, names[1:]):
+            self[upstream].link(self[downstream])
+
+        self.inputs[input] = {
+            'elements': names,
+            'device_name': None,
+            'bypass_convert': False,
+            'levels': None,
+            'gate': None if self.gate_options is None else Gate(**self.gate_options),
+            'formats': {},
+        }
+
+        # The wavpack branch always exists, the others are built on demand.
+        # In split mode it needs the channel count, and waits for the source.
+        if not self.split_channels:
+            self.build_format_branch(FORMAT_WAVPACK, input)
+
+        return self.inputs[input]
+
+    def add_input(self):
+        "Adds an input to the stopped pipeline and returns its index"
+        if self.current_state != Gst.State.NULL or self.in_transition:
+            logger.warning("Trying to add an input while pipeline is not stopped")
+            return None
+
+        input = max(self.inputs) + 1
+        self.build_input(input)
+        if self.metrics is not None:
+            self.metrics.watch_input(input)
+        return input
+
+    def remove_input(self, input):
+        "Removes an input and its format branches from the stopped pipeline"
+        if self.current_state != Gst.State.NULL or self.in_transition:
+            logger.warning("Trying to remove an input while pipeline is not stopped")
+            return
+        if input == 0 or input not in self.inputs:
+            logger.error(f"Trying to remove input {input}")
+            return
+        if any(h['input'] == input for h in self.filesinks.values()):
+            logger.error(f"Input {input} still has filesinks")
+            return
+
+        logger.debug(f"Removing input {input}")
+        if self.monitor is not None and self.monitor['input'] == input:
+            self.stop_monitor()
+        if self.metrics is not None:
+            self.metrics.unwatch_input(input)
+        for fmt in list(self.inputs[input]['formats']):
+            self.remove_format_branch(fmt, input)
+
+        source = self.input_name(input, 'source')
+        if source in self.elements:
+            self[source].set_state(Gst.State.NULL)
+            self.remove(source)
+
+        for name in self.inputs.pop(input)['elements']:
+            self[name].set_state(Gst.State.NULL)
+            self.remove(name)
+
+    def sources(self):
+        "Returns the source element of each input, by input index"
+        return {
+            input: self.elements[self.input_name(input, 'source')]
+            for input in self.inputs
+            if self.input_name(input, 'source') in self.elements
+        }
+
+    @property
+    def device_name(self):
+        "The name of the device captured by the first input"
+        return self.inputs[0]['device_name']
+
+    @property
+    def formats(self):
+        "The format branches of the first input"
+        return self.inputs[0]['formats']
+
+    def make_preroll_queue(self, name='preroll-queue'):
+        """
+        The pre-roll is a delay line: this queue always holds the last
+        preroll_seconds of audio before letting it reach the encoders, so a
+        filesink attached now starts with the audio captured preroll_seconds
+        ago, with its original timestamps, and continues seamlessly with the
+        live data. The queue storage is a fixed ring of buffer references and
+        its size is bounded by max-size-time.
+        """
+        queue = self.make_and_add('queue', name)
+        queue.props.min_threshold_time = int(self.preroll_seconds * Gst.SECOND)
+        queue.props.max_size_time = int((self.preroll_seconds + PREROLL_MARGIN_S) * Gst.SECOND)
+        queue.props.max_size_bytes = 0
+        queue.props.max_size_buffers = 0
+        return queue
+
+    def preroll_stats(self, input=0):
+        name = self.input_name(input, 'preroll-queue')
+        if name not in self.elements:
+            return None
+
+        queue = self[name]
+        return {
+            'seconds': self.preroll_seconds,
+            'level_time': queue.props.current_level_time / Gst.SECOND,
+            'level_bytes': queue.props.current_level_bytes,
+        }
+
+    def format_element_name(self, fmt, name, input=0):
+        "The wavpack branch elements keep their historical names"
+        if fmt == FORMAT_WAVPACK:
+            name = 'blackhole' if name == 'blackhole' else f"encoder-{name}"
+        else:
+            name = f"{fmt}-{name}"
+        return self.input_name(input, name)
+
+    def make_format_chain(self, fmt):
+        "Returns the elements encoding raw audio to fmt, as (element, name) tuples"
+        if fmt == FORMAT_WAVPACK:
+            return [(self.make_encoder(), 'encoder')]
+        elif fmt == FORMAT_FLAC:
+            return [
+                (Gst.ElementFactory.make('audioconvert', None), 'flac-convert'),
+                (Gst.ElementFactory.make('flacenc', None), 'flac-encoder'),
+            ]
+        elif fmt == FORMAT_WAV:
+            return [
+                (Gst.ElementFactory.make('audioconvert', None), 'wav-convert'),
+                (Gst.ElementFactory.make('wavenc', None), 'wav-encoder'),
+            ]
+        elif fmt == FORMAT_PREVIEW:
+            caps = Gst.ElementFactory.make('capsfilter', None)
+            caps.props.caps = Gst.Caps.from_string('audio/x-raw,rate=48000,channels=[1,2]')
+            encoder = Gst.ElementFactory.make('opusenc', None)
+            encoder.props.bitrate = PREVIEW_BITRATE
+            return [
+                (Gst.ElementFactory.make('audioconvert', None), 'preview-convert'),
+                (Gst.ElementFactory.make('audioresample', None), 'preview-resample'),
+                (caps, 'preview-caps'),
+                (encoder, 'preview-encoder'),
+                (Gst.ElementFactory.make('oggmux', None), 'preview-mux'),
+            ]
+        raise ValueError(f"Unknown format '{fmt}'")
+
+    def build_encoding_chain(self, fmt, queue_name, tee_name, blackhole_name, element_name):
+        """
+        Builds a queue ! encoder ! tee ! blackhole chain, the encoder
+        elements being named with element_name(name). Returns the chain
+        elements and their names.
+        """
+        queue = self.make_and_add('queue', queue_name)
+        chain = [queue]
+        names = [queue_name]
+        for element, name in self.make_format_chain(fmt):
+            name = element_name(name)
+            self.add(element, name)
+            chain.append(element)
+            names.append(name)
+        tee = self.make_and_add('tee', tee_name)
+        blackhole = self.make_and_add('fakesink', blackhole_name)
+        # The blackhole only keeps the tee linked, it must never throttle it
+        blackhole.props.sync = False
+        chain += [tee, blackhole]
+        names += [tee_name, blackhole_name]
+
+        for upstream, downstream in zip(chain, chain[1:]):
+            upstream.link(downstream)
+
+        return chain, names
 
-        self['src-caps'].link(self['input-queue'])
+    def private_key(self, key):
+        "A key of its own for a branch encoding a single take"
+        self.private_branches += 1
+        return f"{key}-take{self.private_branches}"
 
-        self['input-queue'].link(self['audioconvert'])
-        self['audioconvert'].link(self['encoder'])
-        self['encoder'].link(self['encoder-tee'])
-        self['encoder-tee'].link(self['blackhole'])
+    def build_format_branch(self, fmt, input=0, key=None):
+        """
+        Builds the raw-tee ! queue ! encoder ! tee branch of a format, the
+        filesinks of that format are then attached to its tee. With a key,
+        the branch is private to the sinks of a take: nothing flows into it
+        until release_branch(), so they get the stream from its start.
+        """
+        private = key is not None
+        if not private:
+            key = fmt
+        logger.debug(f"Building the {key} encoding branch of input {input}")
+
+        if private:
+            names = [self.input_name(input, f"{key}-{name}") for name in ('queue', 'tee', 'blackhole')]
+            element_name = lambda name: self.input_name(input, f"{key}-{name}")
+        else:
+            names = [self.format_element_name(fmt, name, input) for name in ('queue', 'tee', 'blackhole')]
+            element_name = lambda name: self.input_name(input, name)
+        chain, names = self.build_encoding_chain(fmt, *names, element_name)
+
+        raw_pad, raw_block = self.link_raw_pad(chain[0], input, private)
+
+        for element in reversed(chain):
+            element.sync_state_with_parent()
+
+        formats = self.inputs[input]['formats']
+        formats[key] = {
+            'format': fmt,
+            'tee': chain[-2],
+            'raw_pad': raw_pad,
+            'raw_block': raw_block,
+            'private': private,
+            'elements': names,
+            # The encoding chain, between the queue and the tee
+            'encoders': {key: (names[1], names[-3])},
+            'sinks': 0,
+        }
+        if self.metrics is not None:
+            self.watch_format_branch(key, input)
+
+        return formats[key]
+
+    def link_raw_pad(self, queue, input, blocked=False):
+        "Feeds the queue of a branch from the raw-tee of an input, returns the pad and its block probe"
+        raw_pad = self[self.input_name(input, 'raw-tee')].request_pad_simple('src_%u')
+        if self.inputs[input]['gate'] is not None:
+            self.inputs[input]['gate'].watch(raw_pad)
+        raw_block = None
+        if blocked:
+            raw_block = raw_pad.add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM, self.on_tee_pad_blocked)
+        raw_pad.link(queue.get_static_pad('sink'))
+        return raw_pad, raw_block
+
+    def release_branch(self, branch):
+        "Lets the audio into a private branch, once its sinks are attached"
+        if branch['raw_block'] is not None:
+            branch['raw_pad'].remove_probe(branch['raw_block'])
+            branch['raw_block'] = None
+
+    def end_private_branch(self, input, key):
+        """
+        Ends the stream of a private branch once all its sinks are being
+        removed: EOS goes through its encoders, which rewrite their headers
+        before it reaches the sinks.
+        """
+        branch = self.inputs[input]['formats'][key]
+        if branch.get('ending') or any(
+            not h['removing'] for h in self.filesinks.values()
+            if h['input'] == input and h['branch'] == key
+        ):
+            return
+        branch['ending'] = True
+        self.release_branch(branch)
+        branch['raw_pad'].add_probe(Gst.PadProbeType.IDLE, self.on_raw_pad_idle, branch)
+
+    def on_raw_pad_idle(self, pad, info, branch):
+        queue_pad = self[branch['elements'][0]].get_static_pad('sink')
+        pad.unlink(queue_pad)
+        queue_pad.send_event(Gst.Event.new_eos())
+        return Gst.PadProbeReturn.REMOVE
+
+    def split_key(self, fmt):
+        return f"{fmt}-split"
+
+    def build_split_branch(self, fmt, input, channels, key=None):
+        """
+        Builds the raw-tee ! queue ! deinterleave branch of a format, with a
+        queue ! encoder ! tee chain per channel. Each channel is encoded in
+        the streaming thread of its own queue, so the encoding of a multi
+        channel input is spread over the cores. With a key the branch is
+        private, as with build_format_branch().
+        """
+        private = key is not None
+        if not private:
+            key = self.split_key(fmt)
+        logger.debug(f"Building the {key} encoding branch of input {input} for {channels} channels")
+
+        queue = self.make_and_add('queue', self.input_name(input, f"{key}-queue"))
+        deinterleave = self.make_and_add('deinterleave', self.input_name(input, f"{key}-deinterleave"))
+        queue.link(deinterleave)
+        elements = [queue, deinterleave]
+        names = [queue.get_name(), deinterleave.get_name()]
+        tees = []
+        channel_queues = []
+        encoders = {}
+
+        for channel in range(channels):
+            prefix = self.input_name(input, f"{key}-ch{channel:02}")
+            chain, chain_names = self.build_encoding_chain(
+                fmt,
+                f"{prefix}-queue",
+                f"{prefix}-tee",
+                f"{prefix}-blackhole",
+                lambda name: f"{prefix}-{name}"
+            )
+            elements += chain
+            names += chain_names
+            channel_queues.append(chain[0])
+            tees.append(chain[-2])
+            encoders[f"{key}-ch{channel:02}"] = (chain_names[1], chain_names[-3])
+
+        # The channel pads only appear once the caps are known
+        deinterleave.connect('pad-added', self.on_deinterleave_pad_added, channel_queues)
+
+        raw_pad, raw_block = self.link_raw_pad(queue, input, private)
+
+        for element in reversed(elements):
+            element.sync_state_with_parent()
+
+        formats = self.inputs[input]['formats']
+        formats[key] = {
+            'format': fmt,
+            'tees': tees,
+            'channels': channels,
+            'raw_pad': raw_pad,
+            'raw_block': raw_block,
+            'private': private,
+            'elements': names,
+            'encoders': encoders,
+            'sinks': 0,
+        }
+        if self.metrics is not None:
+            self.watch_format_branch(key, input)
+
+        return formats[key]
+
+    def on_deinterleave_pad_added(self, deinterleave, pad, channel_queues):
+        # The pads are named src_<channel>
+        channel = int(pad.get_name().rpartition('_')[2])
+        if channel >= len(channel_queues):
+            logger.error(f"Unexpected channel {channel} out of {deinterleave.get_name()}")
+            return
+        pad.link(channel_queues[channel].get_static_pad('sink'))
+
+    def update_split_branch(self, input, caps):
+        "Makes the split wavpack branch of an input match the captured channels"
+        formats = self.inputs[input]['formats']
+        key = self.split_key(FORMAT_WAVPACK)
+        channels = caps_channels(caps)
+
+        branch = formats.get(key)
+        if branch is not None:
+            if branch['channels'] == channels:
+                return
+            if branch['sinks'] > 0:
+                logger.warning(f"Input {input} changed channels while recording")
+                return
+            self.remove_format_branch(key, input)
+
+        if channels is None:
+            logger.warning(f"Unknown channel count for input {input}, recording interleaved")
+            if FORMAT_WAVPACK not in formats:
+                self.build_format_branch(FORMAT_WAVPACK, input)
+            return
+
+        self.build_split_branch(FORMAT_WAVPACK, input, channels)
+
+    def input_channels(self, input=0):
+        "The number of channels captured by an input, when known"
+        return caps_channels(self[self.input_name(input, 'src-caps')].props.caps)
+
+    def watch_format_branch(self, key, input=0):
+        for name, (first, last) in self.inputs[input]['formats'][key]['encoders'].items():
+            self.metrics.watch_encoder(self.input_name(input, name), self[first], self[last])
+
+    def remove_format_branch(self, key, input=0):
+        logger.debug(f"Removing the {key} encoding branch of input {input}")
+        branch = self.inputs[input]['formats'].pop(key)
+        if self.metrics is not None:
+            for name in branch['encoders']:
+                self.metrics.unwatch_encoder(self.input_name(input, name))
+
+        if self.inputs[input]['gate'] is not None:
+            self.inputs[input]['gate'].unwatch(branch['raw_pad'])
+        self[self.input_name(input, 'raw-tee')].release_request_pad(branch['raw_pad'])
+        for name in branch['elements']:
+            self[name].set_state(Gst.State.NULL)
+            self.remove(name)
+
+    def prune_format_branches(self):
+        "Removes the unused on demand branches, while the pipeline is stopped"
+        permanent = self.split_key(FORMAT_WAVPACK) if self.split_channels else FORMAT_WAVPACK
+        for input, inp in self.inputs.items():
+            for key, branch in list(inp['formats'].items()):
+                if key != permanent and branch['sinks'] == 0:
+                    self.remove_format_branch(key, input)
+
+    def start_monitor(self, host, port=MONITOR_PORT, input=0, latency_ms=None):
+        """
+        Streams an input to host:port as RTP/Opus over UDP, for listening to
+        it remotely. The branch is fed before the pre-roll delay and the
+        encoders, through a leaky queue holding latency_ms of audio, so a
+        slow listener only loses audio of its own.
+        """
+        if self.monitor is not None:
+            logger.error(f"Already monitoring to {self.monitor['host']}:{self.monitor['port']}")
+            return None
+        if input not in self.inputs:
+            logger.error(f"Unknown input {input} to monitor")
+            return None
+        if latency_ms is None:
+            latency_ms = self.monitor_latency_ms
+        frame_size = monitor_frame_size(latency_ms)
+        logger.info(f"Monitoring input {input} to {host}:{port}, {frame_size}ms frames")
+
+        queue = Gst.ElementFactory.make('queue', None)
+        queue.props.leaky = 2
+        queue.props.max_size_buffers = 0
+        queue.props.max_size_bytes = 0
+        queue.props.max_size_time = int(latency_ms * Gst.MSECOND)
+
+        caps = Gst.ElementFactory.make('capsfilter', None)
+        caps.props.caps = Gst.Caps.from_string('audio/x-raw,rate=48000,channels=[1,2]')
+        encoder = Gst.ElementFactory.make('opusenc', None)
+        encoder.props.bitrate = MONITOR_BITRATE
+        Gst.util_set_object_arg(encoder, 'audio-type', 'restricted-lowdelay')
+        Gst.util_set_object_arg(encoder, 'frame-size', f"{frame_size:g}")
+        payloader = Gst.ElementFactory.make('rtpopuspay', None)
+        payloader.props.pt = MONITOR_PAYLOAD_TYPE
+        udpsink = Gst.ElementFactory.make('udpsink', None)
+        udpsink.props.host = host
+        udpsink.props.port = port
+        # Never wait for the clock nor for a preroll, the queue paces it
+        udpsink.props.sync = False
+        udpsink.set_property('async', False)
+
+        chain = [
+            (queue, 'monitor-queue'),
+            (Gst.ElementFactory.make('audioconvert', None), 'monitor-convert'),
+            (Gst.ElementFactory.make('audioresample', None), 'monitor-resample'),
+            (caps, 'monitor-caps'),
+            (encoder, 'monitor-encoder'),
+            (payloader, 'monitor-payloader'),
+            (udpsink, 'monitor-sink'),
+        ]
+        names = []
+        for element, name in chain:
+            name = self.input_name(input, name)
+            self.add(element, name)
+            names.append(name)
+        for (upstream, _), (downstream, _) in zip(chain, chain[1:]):
+            upstream.link(downstream)
+
+        tee_name = 'live-tee' if self.preroll_seconds > 0 else 'raw-tee'
+        tee = self[self.input_name(input, tee_name)]
+        tee_pad = tee.request_pad_simple('src_%u')
+        block_id = tee_pad.add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM, self.on_tee_pad_blocked)
+        tee_pad.link(queue.get_static_pad('sink'))
+        for element, _ in reversed(chain):
+            element.sync_state_with_parent()
+        tee_pad.remove_probe(block_id)
+
+        self.monitor = {
+            'host': host,
+            'port': port,
+            'input': input,
+            'latency_ms': latency_ms,
+            'frame_size_ms': frame_size,
+            'tee': tee,
+            'tee_pad': tee_pad,
+            'elements': names,
+            'overruns': 0,
+        }
+        queue.connect('overrun', self.on_monitor_overrun, self.monitor)
+        return self.monitor
+
+    def on_monitor_overrun(self, queue, monitor):
+        # Called from the streaming thread each time the leaky queue drops
+        monitor['overruns'] += 1
+
+    def stop_monitor(self):
+        if self.monitor is None:
+            return
+        logger.info(f"Stopping the monitor to {self.monitor['host']}:{self.monitor['port']}")
+        monitor = self.monitor
+        self.monitor = None
+
+        if self.current_state != Gst.State.PLAYING:
+            self.remove_monitor(monitor)
+        else:
+            monitor['tee_pad'].add_probe(Gst.PadProbeType.IDLE, self.on_monitor_pad_idle, monitor)
+
+    def on_monitor_pad_idle(self, pad, info, monitor):
+        pad.unlink(self[monitor['elements'][0]].get_static_pad('sink'))
+        GLib.idle_add(self.remove_monitor, monitor)
+        return Gst.PadProbeReturn.REMOVE
+
+    def remove_monitor(self, monitor):
+        tee_pad = monitor['tee_pad']
+        if tee_pad.is_linked():
+            tee_pad.unlink(tee_pad.get_peer())
+        monitor['tee'].release_request_pad(tee_pad)
+        for name in monitor['elements']:
+            self[name].set_state(Gst.State.NULL)
+            self.remove(name)
+
+        return GLib.SOURCE_REMOVE
+
+    def monitor_stats(self):
+        if self.monitor is None:
+            return None
+        queue = self[self.monitor['elements'][0]]
+        stats = {
+            key: self.monitor[key]
+            for key in ('host', 'port', 'input', 'latency_ms', 'frame_size_ms', 'overruns')
+        }
+        stats['queued_s'] = queue.props.current_level_time / Gst.SECOND
+        return stats
 
 
     def __getitem__(self, name):
@@ -53,6 +800,10 @@ class Pipeline(GObject.Object):
         self.elements[name] = element
         self.pipeline.add(element)
 
+    def remove(self, name):
+        element = self.elements.pop(name)
+        self.pipeline.remove(element)
+
     def make_and_add(self, kind, name):
         name = name.replace('_', '-')
 
@@ -63,56 +814,266 @@ class Pipeline(GObject.Object):
 
     def make_encoder(self):
         element = Gst.ElementFactory.make("wavpackenc", None)
-        element.props.md5 = True
-        # A value from 1 to 4, with 1 being the fastest and 4 the highest compression ratio
-        element.props.mode = 4
+        # The encoder is shared by the takes and never sees the end of one,
+        # an MD5 of its whole stream matches no file. The takes are checked
+        # against the SHA-256 taken by the Verifier instead
+        element.props.md5 = self.encoder_md5
+        element.props.mode = self.encoder_mode
         return element
 
     @property
     def current_state(self):
-        (_, current_state, pending_state) = self.pipeline.get_state(Gst.CLOCK_TIME_NONE)
-        return current_state
+        return self.state
+
+    @property
+    def in_transition(self):
+        return self.pending_state != Gst.State.VOID_PENDING
+
+    @property
+    def running_time(self):
+        "The pipeline running time in ns, read from its clock without any query, or -1"
+        clock = self.pipeline.get_clock()
+        if clock is None or self.current_state != Gst.State.PLAYING:
+            return -1
+        return clock.get_time() - self.pipeline.get_base_time()
 
     @property
     def current_position(self):
         _, position = self.pipeline.query_position(Gst.Format.TIME)
         return position
 
-    def select_device(self, device):
-        if self.current_state != Gst.State.NULL:
+    @property
+    def can_record(self):
+        "Whether start() would begin recording right away"
+        return (
+            self.device_name is not None and not self.in_transition and
+            self.current_state in (Gst.State.NULL, Gst.State.READY)
+        )
+
+    def negotiated_caps(self, input=0):
+        "The caps captured by an input, once the pipeline is running"
+        return self[self.input_name(input, 'src-caps')].get_static_pad('src').get_current_caps()
+
+    def select_device(self, device, input=0):
+        if self.current_state not in (Gst.State.NULL, Gst.State.READY) or self.in_transition:
             logger.warning("Trying to change device while pipeline is not stopped")
             return
-
-        if 'source' in self.elements and self.elements['source'] is not None:
-            old_src = self.elements.pop('source')
-            old_src.unlink(self['src-caps'])
-            self.pipeline.remove(old_src)
+        if input not in self.inputs:
+            logger.error(f"Trying to select a device for non existent input {input}")
+            return
 
         new_src = device.create_element()
+        if new_src is None:
+            logger.error(f"Unable to create a source for {device.props.display_name}")
+            return
 
-        # Work around a bug in gstreamer pipewire implementation
-        if new_src.__class__.__name__ == 'GstPipeWireSrc':
+        # Work around a bug in older gstreamer pipewire implementations
+        if new_src.__class__.__name__ == 'GstPipeWireSrc' and pipewire_needs_copy(self.pipewire_copy_fixed_version):
             logger.debug("Pipewire source, enabling 'always-copy' property")
             new_src.props.always_copy = True
 
-        self.add(new_src, 'source')
-        new_src.link(self['src-caps'])
+        caps = self.capture_caps
+        if caps is None:
+            caps = native_caps(device.get_caps())
+        logger.debug(f"Capturing {device.props.display_name} as {caps.to_string() if caps else 'any'}")
 
-    def start(self):
-        self.pipeline.set_state(Gst.State.PLAYING)
+        self.select_source(new_src, device.props.display_name, caps, input)
 
-    def stop(self):
-        state = self.current_state
-        res = self.pipeline.set_state(Gst.State.NULL)
-        if res == Gst.StateChangeReturn.SUCCESS:
-            self.emit(
-                'state-changed',
-                state.value_nick,
-                Gst.State.NULL.value_nick
-            )
+        if self.encoder_selector is not None and input == 0 and caps is not None:
+            self.encoder_selector.calibrate(caps)
+
+    def set_encoder_mode(self, mode):
+        """
+        Changes the wavpack mode. The encoder only reads it when starting, so
+        while running the wavpack branches are rebuilt instead, right away
+        when no sink uses them, or once their last sink is finalized.
+        """
+        self.encoder_mode = mode
+        if self.current_state == Gst.State.NULL and not self.in_transition:
+            self.pending_encoder_mode = None
+            for inp in self.inputs.values():
+                for branch in inp['formats'].values():
+                    if branch['format'] != FORMAT_WAVPACK:
+                        continue
+                    for first, _ in branch['encoders'].values():
+                        self[first].props.mode = mode
+            return
+
+        self.pending_encoder_mode = mode
+        for input, inp in self.inputs.items():
+            for key, branch in inp['formats'].items():
+                if branch['sinks'] == 0 and self.stale_branch(branch):
+                    self.rebuild_format_branch(key, input)
+        if self.pending_encoder_mode is not None:
+            logger.info(f"Wavpack mode {mode} will be used once the current takes end")
+
+    def stale_branch(self, branch):
+        "Whether a wavpack branch runs another mode than the current one"
+        return branch['format'] == FORMAT_WAVPACK and any(
+            self[first].props.mode != self.encoder_mode for first, _ in branch['encoders'].values()
+        )
+
+    def rebuild_format_branch(self, key, input=0):
+        """
+        Replaces a shared branch without sinks by a new one, once nothing
+        flows through its raw-tee pad. The pad stays blocked until the main
+        loop rebuilds the branch.
+        """
+        branch = self.inputs[input]['formats'][key]
+        if branch.get('rebuilding'):
+            return
+        branch['rebuilding'] = True
+        branch['raw_pad'].add_probe(Gst.PadProbeType.IDLE, self.on_stale_raw_pad_idle, key, input)
+
+    def on_stale_raw_pad_idle(self, pad, info, key, input):
+        GLib.idle_add(self.on_stale_branch_blocked, key, input, info.id)
+        return Gst.PadProbeReturn.OK
 
-    def pause(self):
-        self.pipeline.set_state(Gst.State.PAUSED)
+    def on_stale_branch_blocked(self, key, input, probe_id):
+        branch = self.inputs[input]['formats'].get(key) if input in self.inputs else None
+        if branch is None:
+            return GLib.SOURCE_REMOVE
+        branch['rebuilding'] = False
+        if branch['sinks'] > 0:
+            # A sink was added meanwhile, the branch waits for its end
+            branch['raw_pad'].remove_probe(probe_id)
+            return GLib.SOURCE_REMOVE
+
+        logger.info(f"Rebuilding the {key} encoding branch of input {input} in wavpack mode {self.encoder_mode}")
+        branch['raw_pad'].unlink(self[branch['elements'][0]].get_static_pad('sink'))
+        self.remove_format_branch(key, input)
+        if 'channels' in branch:
+            self.build_split_branch(branch['format'], input, branch['channels'])
+        else:
+            self.build_format_branch(branch['format'], input)
+
+        if not any(
+            self.stale_branch(branch) for inp in self.inputs.values() for branch in inp['formats'].values()
+        ):
+            self.pending_encoder_mode = None
+        return GLib.SOURCE_REMOVE
+
+    def encoder_queues(self):
+        "The queues falling behind when the wavpack encoders can't keep up"
+        queues = []
+        for input, inp in self.inputs.items():
+            queues.append(self[self.input_name(input, 'input-queue')])
+            for branch in inp['formats'].values():
+                if branch['format'] == FORMAT_WAVPACK:
+                    queues += [self[name] for name in branch['elements'] if name.endswith('queue')]
+        return queues
+
+    def select_source(self, new_src, name, caps=None, input=0):
+        """
+        Plugs a source element in front of an input, replacing the current
+        one. Optionally restricts the capture format to caps.
+        """
+        source = self.input_name(input, 'source')
+        src_caps = self[self.input_name(input, 'src-caps')]
+        if source in self.elements and self.elements[source] is not None:
+            old_src = self.elements.pop(source)
+            old_src.unlink(src_caps)
+            old_src.set_state(Gst.State.NULL)
+            self.pipeline.remove(old_src)
+
+        src_caps.props.caps = caps
+        self.add(new_src, source)
+        new_src.link(src_caps)
+        # The pipeline may already be READY
+        new_src.sync_state_with_parent()
+        self.inputs[input]['device_name'] = name
+
+        bypass = self.passthrough and caps is not None and accepted_by(caps, PASSTHROUGH_ELEMENTS)
+        self.set_convert_bypass(input, bypass)
+
+        if self.split_channels:
+            self.update_split_branch(input, caps)
+
+    def set_convert_bypass(self, input, bypass):
+        """
+        Takes the audioconvert of an input out of the path when the captured
+        format is already accepted downstream, so the buffers flow from the
+        source to the encoders untouched. The other formats convert in their
+        own branch.
+        """
+        inp = self.inputs[input]
+        if inp['bypass_convert'] == bypass:
+            return
+
+        upstream = self[self.input_name(input, 'input-queue')]
+        convert = self[self.input_name(input, 'audioconvert')]
+        downstream = self[self.input_name(input, 'level')]
+
+        if bypass:
+            logger.debug(f"Bypassing the audioconvert of input {input}")
+            upstream.unlink(convert)
+            convert.unlink(downstream)
+            upstream.link(downstream)
+            convert.set_locked_state(True)
+            convert.set_state(Gst.State.NULL)
+        else:
+            logger.debug(f"Restoring the audioconvert of input {input}")
+            upstream.unlink(downstream)
+            upstream.link(convert)
+            convert.link(downstream)
+            convert.set_locked_state(False)
+            convert.sync_state_with_parent()
+
+        inp['bypass_convert'] = bypass
+
+    def set_state_async(self, state, callback=None):
+        """
+        Requests a state change without waiting for it to complete. The
+        optional callback is called from the main loop as callback(success)
+        once the pipeline reached the requested state or failed to.
+        """
+        if callback is not None:
+            self.state_callbacks.append((state, callback))
+
+        res = self.pipeline.set_state(state)
+        if res == Gst.StateChangeReturn.FAILURE:
+            logger.error(f"Unable to change pipeline state to {state.value_nick}")
+            self.pending_state = Gst.State.VOID_PENDING
+            self.complete_state_callbacks(False)
+        elif state == Gst.State.NULL:
+            # The bus is flushing when going to NULL, so the STATE_CHANGED
+            # messages never reach us.
+            self.update_state(Gst.State.NULL, Gst.State.VOID_PENDING)
+        elif self.state != state:
+            self.pending_state = state
+
+        return res
+
+    def update_state(self, new_state, pending_state):
+        old_state = self.state
+        self.state = new_state
+        self.pending_state = pending_state
+
+        if new_state == Gst.State.NULL:
+            if self.pending_encoder_mode is not None:
+                self.set_encoder_mode(self.pending_encoder_mode)
+            self.prune_format_branches()
+
+        if old_state != new_state:
+            self.emit('state-changed', old_state.value_nick, new_state.value_nick)
+        if pending_state == Gst.State.VOID_PENDING:
+            self.complete_state_callbacks(True)
+
+    def complete_state_callbacks(self, success):
+        callbacks = self.state_callbacks
+        self.state_callbacks = []
+
+        for state, callback in callbacks:
+            callback(success and state == self.state)
+
+    def start(self, callback=None):
+        self.set_state_async(Gst.State.PLAYING, callback)
+
+    def stop(self, callback=None):
+        self.set_state_async(Gst.State.NULL, callback)
+
+    def pause(self, callback=None):
+        self.set_state_async(Gst.State.PAUSED, callback)
 
     def dump_dot(self):
         Gst.debug_bin_to_dot_file_with_ts(self.pipeline, Gst.DebugGraphDetails.ALL, 'pipeline')
@@ -120,61 +1081,906 @@ class Pipeline(GObject.Object):
     def on_bus_message(self, bus, message):
         t = message.type
 
+        if self.metrics is not None:
+            self.metrics.on_bus_message(message)
+
         if t == Gst.MessageType.STATE_CHANGED:
             state = message.parse_state_changed()
             if message.src == self.pipeline:
                 logger.debug(f"Pipeline state change from {state.oldstate} to {state.newstate}")
-                self.emit('state-changed', state.oldstate.value_nick, state.newstate.value_nick)
+                self.update_state(state.newstate, state.pending)
+        elif t == Gst.MessageType.ASYNC_DONE:
+            if message.src == self.pipeline:
+                # The async transition is over, refresh the cache without blocking
+                (_, current_state, pending_state) = self.pipeline.get_state(0)
+                logger.debug(f"Pipeline async state change done: {current_state}")
+                self.update_state(current_state, pending_state)
+        elif t == Gst.MessageType.ELEMENT:
+            structure = message.get_structure()
+            if structure is None:
+                return
+            if structure.get_name() == 'GstMultiFileSink':
+                self.on_segment_closed(message.src, structure)
+            elif structure.get_name() == 'level':
+                self.on_level(message.src, structure)
+        elif t == Gst.MessageType.ERROR:
+            err, debug = message.parse_error()
+            if message.src in self.failed_elements:
+                logger.warning(f"Filesink error from {message.src.get_name()}: {err.message}")
+                return
+            logger.error(f"Error from {message.src.get_name()}: {err.message} ({debug})")
+            if self.in_transition:
+                self.pending_state = Gst.State.VOID_PENDING
+                self.complete_state_callbacks(False)
 
-    def add_filesink(self, path):
-        logger.debug(f"Adding a filesink to {path}")
+    def on_level(self, level, structure):
+        """
+        Coalesces the level measurements until someone takes them, keeping
+        the loudest values so that short peaks are never missed.
+        """
+        inp = next(
+            (inp for input, inp in self.inputs.items()
+             if self.elements.get(self.input_name(input, 'level')) == level),
+            None
+        )
+        if inp is None:
+            return
+
+        peak = list(structure.get_value('peak'))
+        rms = list(structure.get_value('rms'))
+
+        levels = inp['levels']
+        if levels is None or len(levels['peak']) != len(peak):
+            inp['levels'] = {'peak': peak, 'rms': rms}
+        else:
+            levels['peak'] = [max(a, b) for a, b in zip(levels['peak'], peak)]
+            levels['rms'] = [max(a, b) for a, b in zip(levels['rms'], rms)]
+
+    def on_sync_element(self, bus, message):
+        "Feeds the gates with the level measurements, from the input threads"
+        structure = message.get_structure()
+        if structure is None or structure.get_name() != 'level':
+            return
+        for input, inp in list(self.inputs.items()):
+            if inp['gate'] is not None and \
+                    self.elements.get(self.input_name(input, 'level')) == message.src:
+                inp['gate'].feed(structure)
+                return
+
+    def on_stream_status(self, bus, message):
+        "Called from the streaming threads as they start and stop their tasks"
+        status, owner = message.parse_stream_status()
+        if status == Gst.StreamStatusType.ENTER:
+            self.thread_policy.enter(self.thread_role(owner), owner.get_name())
+        elif status == Gst.StreamStatusType.LEAVE:
+            self.thread_policy.leave()
+
+    def thread_role(self, element):
+        "The role of the streaming thread started by element"
+        factory = element.get_factory()
+        if factory is not None and factory.get_name() == 'appsrc':
+            # Only the resumed filesinks use one
+            return THREAD_ROLE_WRITER
+        if not any(True for _ in element.iterate_sink_pads()):
+            return THREAD_ROLE_CAPTURE
+
+        name = element.get_name()
+        if self.elements.get(name) is element:
+            name = re.sub(r'^in\d+-', '', name)
+            if name in ('input-queue', 'preroll-queue'):
+                return THREAD_ROLE_INPUT
+            if name == 'monitor-queue':
+                return THREAD_ROLE_MONITOR
+            if name.endswith('queue'):
+                return THREAD_ROLE_ENCODER
+        elif factory is not None and factory.get_name() in ('queue', 'queue2'):
+            # The sink queues are the only unnamed ones
+            return THREAD_ROLE_WRITER
+        return THREAD_ROLE_OTHER
 
-        sink = Gst.ElementFactory.make("filesink", None)
-        sink.props.location = path
+    def thread_stats(self):
+        return self.thread_policy.get_stats()
+
+    def gate_stats(self, input=0):
+        gate = self.inputs[input]['gate']
+        return None if gate is None else gate.get_stats()
+
+    def take_levels(self, input=0):
+        "Returns the per channel peak/RMS levels in dB since the last call, or None"
+        inp = self.inputs.get(input)
+        if inp is None:
+            return None
+        levels = inp['levels']
+        inp['levels'] = None
+        return levels
+
+    def on_segment_closed(self, sink, structure):
+        for h in self.filesinks.values():
+            if h['filesink'] == sink:
+                h['writer'].on_segment_closed(structure)
+                return
+
+    def make_sink_queue(self, policy):
+        """
+        Returns a (queue, max_size_bytes) tuple for a sink branch following
+        the given back-pressure policy.
+        """
+        # A plain queue keeps the buffers as they are. The temp file ring
+        # buffer of queue2 would re-chunk them, losing their timestamps and
+        # flags, which the retained buffers and the headers rely on
         queue = Gst.ElementFactory.make("queue", None)
+        max_size_bytes = FILESINK_QUEUE_SIZE_BYTES
+        if policy == SINK_POLICY_SPILL:
+            max_size_bytes = FILESINK_SPILL_SIZE_BYTES
+        elif policy == SINK_POLICY_LEAK:
+            # Drop the oldest buffers when the queue is full, preventing to
+            # block the whole pipeline if a filesink is too slow.
+            queue.props.leaky = 2
+
+        # Limit the size of the queue in bytes only
+        queue.props.max_size_buffers = 0
+        queue.props.max_size_time = 0
+        queue.props.max_size_bytes = max_size_bytes
+
+        return queue, max_size_bytes
+
+    def add_filesink(self, path, policy=None, format=None, input=0, start_at=None, channel=None,
+                     write_strategy=None, branch_key=None):
+        """
+        Records the input to path, or only one of its channels. When start_at
+        is a running time, the buffers before it are dropped so the file
+        starts there. write_strategy overrides the one of the pipeline. The
+        formats that aren't shared get a private branch, or the one of
+        branch_key, released by the caller.
+        """
+        logger.debug(f"Adding a filesink to {path}")
+
+        if policy is None:
+            policy = self.sink_policy
+        if policy not in SINK_POLICIES:
+            logger.error(f"Unknown sink policy '{policy}' for {path}")
+            return
+        if format is None:
+            format = self.default_format
+        if format not in FORMATS:
+            logger.error(f"Unknown format '{format}' for {path}")
+            return
+        if input not in self.inputs:
+            logger.error(f"Unknown input {input} for {path}")
+            return
+        if write_strategy is None:
+            write_strategy = self.write_strategy
+        if write_strategy not in WRITE_STRATEGIES:
+            logger.error(f"Unknown write strategy '{write_strategy}' for {path}")
+            return
+
+        shared = FORMATS[format]['shared']
+        built = None
+        if branch_key is not None:
+            key = branch_key
+            branch = self.inputs[input]['formats'].get(key)
+            if branch is None:
+                logger.error(f"No {key} branch on input {input} for {path}")
+                return
+        elif channel is None:
+            key = format if shared else self.private_key(format)
+            branch = self.inputs[input]['formats'].get(key)
+            if branch is None:
+                branch = built = self.build_format_branch(format, input, None if shared else key)
+        else:
+            key = self.split_key(format) if shared else self.private_key(self.split_key(format))
+            branch = self.inputs[input]['formats'].get(key)
+            if branch is None:
+                channels = self.input_channels(input)
+                if channels is None:
+                    logger.error(f"Unknown channel count of input {input} for {path}")
+                    return
+                branch = built = self.build_split_branch(format, input, channels, None if shared else key)
 
-        # Limit the size of the queue in bytes
-        # queue.props.max_size_buffers = 0
-        # queue.props.max_size_bytes = FILESINK_QUEUE_SIZE_BYTES
-        # Drop new buffers when queue is full, preventing to block the whole pipeline if
-        # a filesink is to slow.
-        # queue.props.leaky = 1
+        h = self.attach_filesink(path, branch, key, policy, format, input, start_at, channel, write_strategy)
+        if built is not None and built['private']:
+            if h is None:
+                self.remove_format_branch(key, input)
+            else:
+                self.release_branch(built)
+        return h
+
+    def attach_filesink(self, path, branch, key, policy, format, input, start_at, channel, write_strategy):
+        "Attaches a sink branch recording to path to the tee of a format branch"
+        if channel is None:
+            tee = branch['tee']
+        elif channel >= branch['channels']:
+            logger.error(f"Input {input} has no channel {channel} for {path}")
+            return
+        else:
+            tee = branch['tees'][channel]
+
+        writer = self.make_writer(path, format, write_strategy)
+        sink = writer.sink
+        queue, max_size_bytes = self.make_sink_queue(policy)
 
         self.pipeline.add(sink)
         self.pipeline.add(queue)
 
-        tee_pad = self['encoder-tee'].request_pad_simple('src_%u')
+        tee_pad = tee.request_pad_simple('src_%u')
         if tee_pad is None:
             logger.error(f"Unable to request tee_pad for {path}")
+            self.pipeline.remove(sink)
+            self.pipeline.remove(queue)
             return
+
+        # Keep the data away from the new branch until it is linked and
+        # running, the tee then sends it the sticky events before any buffer.
+        block_id = tee_pad.add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM, self.on_tee_pad_blocked)
+
         queue_pad = queue.get_static_pad('sink')
+        queue.link(sink)
+        sink.sync_state_with_parent()
+        queue.sync_state_with_parent()
+
         if (Gst.Pad.link(tee_pad, queue_pad) != 0):
             logger.error(f"Unable to link filesink pads for file {path}")
+            tee_pad.remove_probe(block_id)
+            tee.release_request_pad(tee_pad)
+            for element in (queue, sink):
+                element.set_state(Gst.State.NULL)
+                self.pipeline.remove(element)
             return
+        tee_pad.remove_probe(block_id)
 
-        queue.link(sink)
-        sink.set_state(Gst.State.PLAYING)
-        queue.set_state(Gst.State.PLAYING)
+        h = self.make_filesink_handle(writer, queue, max_size_bytes, tee, tee_pad, policy, start_at)
+        h.update({
+            'input': input,
+            'format': format,
+            'branch': key,
+            'channel': channel,
+            'write_strategy': write_strategy,
+        })
+        self.watch_filesink(path, h)
+        branch['sinks'] += 1
+
+        return h
 
-        self.filesinks[path] = {
-            'filesink': sink,
+    def make_writer(self, path, format, write_strategy):
+        flash_options = None
+        if resolve_write_strategy(write_strategy, path) == WRITE_STRATEGY_FLASH:
+            flash_options = self.flash_options
+        return SegmentWriter(
+            path,
+            format,
+            duration_s=self.segment_duration_s,
+            size_bytes=self.segment_size_bytes,
+            fsync_interval_s=self.fsync_interval_s,
+            segmentable=FORMATS[format]['segmentable'],
+            flash_options=flash_options
+        )
+
+    def make_filesink_handle(self, writer, queue, max_size_bytes, tee, tee_pad, policy, start_at=None):
+        return {
+            'filesink': writer.sink,
+            'writer': writer,
             'queue': queue,
-            'tee_pad': tee_pad
+            'tee': tee,
+            'tee_pad': tee_pad,
+            'policy': policy,
+            'max_size_bytes': max_size_bytes,
+            'isolated': False,
+            'behind_since': None,
+            'removing': False,
+            'finalizing': False,
+            'started_at': self.running_time,
+            'start_at': start_at,
+            # Failover: the buffers that may not be written yet, the headers
+            # the take started with, the spill holding the audio while there
+            # is no destination, and the appsrc draining it once there is one
+            'lock': threading.Lock(),
+            'retained': deque(),
+            'retained_headers': [],
+            'failed': False,
+            'torn_down': threading.Event(),
+            'spill': None,
+            'divert_probe': None,
+            'appsrc': None,
+            'drain_thread': None,
+            'drain_pending': None,
+            'stats': {
+                'buffers_in': 0,
+                'bytes_in': 0,
+                'buffers_out': 0,
+                'bytes_out': 0,
+                'gaps': [],
+                'first_pts': None,
+                'last_end': None,
+            },
+        }
+
+    def watch_filesink(self, path, h):
+        queue = h['queue']
+        queue.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, self.on_sink_queue_in, h)
+        queue.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self.on_sink_queue_out, h)
+        self.filesinks[path] = h
+
+        if self.watchdog_id is None:
+            self.watchdog_id = GLib.timeout_add(FILESINK_WATCHDOG_MS, self.on_filesinks_watchdog)
+
+    def aligned_start(self):
+        "The running time sinks started now together should begin at, or None"
+        running_time = self.running_time
+        if running_time < 0:
+            return None
+        return max(0, running_time - int(self.preroll_seconds * Gst.SECOND) +
+                   int(SINK_ALIGN_DELAY_S * Gst.SECOND))
+
+    def add_filesinks(self, sinks, policy=None, format=None):
+        """
+        Starts recording several inputs at once. sinks maps each input to
+        the path of its file. The files all start with the audio captured
+        at the same running time, so they are aligned to the buffer.
+        """
+        start_at = self.aligned_start()
+        return {
+            input: self.add_filesink(path, policy, format, input, start_at)
+            for input, path in sinks.items()
+        }
+
+    def add_split_filesinks(self, path, policy=None, format=None, input=0):
+        """
+        Records each channel of an input to its own mono file, named after
+        path with the channel number. Returns the paths by channel, or None.
+        """
+        if format is None:
+            format = self.default_format
+        branch = self.inputs[input]['formats'].get(self.split_key(format))
+        channels = branch['channels'] if branch is not None else self.input_channels(input)
+        if channels is None:
+            logger.error(f"Unknown channel count of input {input} for {path}")
+            return None
+
+        # The files of a take not encoded in a shared format share their
+        # private branch
+        key = None
+        if not FORMATS[format]['shared']:
+            key = self.private_key(self.split_key(format))
+            branch = self.build_split_branch(format, input, channels, key)
+
+        start_at = self.aligned_start()
+        paths = {channel: channel_path(path, channel) for channel in range(channels)}
+        for channel, channel_file in paths.items():
+            self.add_filesink(channel_file, policy, format, input, start_at, channel, branch_key=key)
+
+        if key is not None:
+            if branch['sinks'] == 0:
+                self.remove_format_branch(key, input)
+            else:
+                self.release_branch(branch)
+        return paths
+
+    def on_sink_queue_in(self, pad, info, h):
+        buf = info.get_buffer()
+
+        start_at = h['start_at']
+        if start_at is not None and buf.pts != Gst.CLOCK_TIME_NONE and \
+                not buf.has_flags(Gst.BufferFlags.HEADER):
+            if buf.pts < start_at:
+                return Gst.PadProbeReturn.DROP
+            h['start_at'] = None
+
+        stats = h['stats']
+        with h['lock']:
+            if buf.pts != Gst.CLOCK_TIME_NONE and not buf.has_flags(Gst.BufferFlags.HEADER):
+                h['retained'].append(buf)
+            elif stats['buffers_in'] == len(h['retained_headers']):
+                # The headers a stream starts with have no timestamp, and
+                # nothing would ever trim them. Untimed buffers coming later,
+                # like the header rewritten at EOS, aren't retained at all
+                h['retained_headers'].append(buf)
+
+        stats['buffers_in'] += 1
+        stats['bytes_in'] += buf.get_size()
+        return Gst.PadProbeReturn.OK
+
+    def on_sink_queue_out(self, pad, info, h):
+        buf = info.get_buffer()
+
+        # Keep what is still queued, what the flash sink still batches and
+        # the last FILESINK_RETAIN_S seconds written, in case the sink fails
+        # writing them. The batch only reaches the file once complete
+        if buf.pts != Gst.CLOCK_TIME_NONE:
+            unwritten_pts = h['writer'].unwritten_pts
+            if unwritten_pts is not None:
+                unwritten_pts = min(buf.pts, unwritten_pts)
+            else:
+                unwritten_pts = buf.pts
+            retain_from = unwritten_pts - FILESINK_RETAIN_S * Gst.SECOND
+            with h['lock']:
+                retained = h['retained']
+                while len(retained) > 0 and retained[0].pts < retain_from:
+                    retained.popleft()
+
+        stats = h['stats']
+        stats['buffers_out'] += 1
+        stats['bytes_out'] += buf.get_size()
+
+        # Mark the holes left by leaked or isolated buffers
+        if buf.pts != Gst.CLOCK_TIME_NONE:
+            if stats['first_pts'] is None:
+                stats['first_pts'] = buf.pts
+            last_end = stats['last_end']
+            if last_end is not None and buf.pts > last_end + Gst.MSECOND:
+                if self.inputs[h['input']]['gate'] is None:
+                    logger.warning(f"Gap of {(buf.pts - last_end) / Gst.SECOND:.3f}s in a filesink")
+                stats['gaps'].append((last_end, buf.pts))
+            if buf.duration != Gst.CLOCK_TIME_NONE:
+                stats['last_end'] = buf.pts + buf.duration
+
+        return Gst.PadProbeReturn.OK
+
+    def filesink_fill_level(self, h):
+        return h['queue'].props.current_level_bytes / h['max_size_bytes']
+
+    def filesink_stats(self, path):
+        "Returns the buffer accounting of the filesink recording to path"
+        h = self.filesinks[path]
+        stats = h['stats']
+        queue = h['queue']
+
+        in_flight_buffers = queue.props.current_level_buffers
+        in_flight_bytes = queue.props.current_level_bytes
+        spill = None if h['spill'] is None else h['spill'].stats()
+        if h['failed']:
+            # What the failed branch held went back to the spill
+            in_flight_buffers = stats['buffers_in'] - stats['buffers_out']
+            in_flight_bytes = stats['bytes_in'] - stats['bytes_out']
+        return {
+            'input': h['input'],
+            'channel': h['channel'],
+            'format': h['format'],
+            'policy': h['policy'],
+            'isolated': h['isolated'],
+            'fill_level': self.filesink_fill_level(h),
+            'buffers_written': stats['buffers_out'],
+            'bytes_written': stats['bytes_out'],
+            'dropped_buffers': max(0, stats['buffers_in'] - stats['buffers_out'] - in_flight_buffers),
+            'dropped_bytes': max(0, stats['bytes_in'] - stats['bytes_out'] - in_flight_bytes),
+            'gaps': len(stats['gaps']),
+            'failed': h['failed'],
+            'spill': spill,
+            'flash': None if h['writer'].flash is None else h['writer'].flash.get_stats(),
         }
 
+    def filesink_duration(self, path, running_time=None):
+        """
+        Returns the media duration written by a filesink in ns, from the
+        timestamps of its buffers, so it matches the file contents. Before the
+        first buffer it falls back to the running time since it was added.
+        """
+        h = self.filesinks[path]
+        stats = h['stats']
+        if stats['first_pts'] is not None and stats['last_end'] is not None:
+            return stats['last_end'] - stats['first_pts']
+
+        if running_time is None:
+            running_time = self.running_time
+        if running_time < 0 or h['started_at'] < 0:
+            return None
+        return running_time - h['started_at']
+
+    def isolate_filesink(self, path, h):
+        logger.warning(f"Filesink to {path} is falling behind, isolating it")
+        # A probe upstream couldn't release the tee thread already waiting
+        # for room in the full queue. Made leaky, the queue drops its oldest
+        # buffers instead, and shrinking it flushes the backlog and wakes
+        # that thread up
+        queue = h['queue']
+        queue.props.leaky = 2
+        queue.props.max_size_bytes = int(h['max_size_bytes'] * FILESINK_ISOLATED_RATIO)
+        h['isolated'] = True
+        self.emit('filesink-isolated', path, True)
+
+    def reconnect_filesink(self, path, h):
+        logger.info(f"Filesink to {path} caught up, reconnecting it")
+        queue = h['queue']
+        queue.props.leaky = 0
+        queue.props.max_size_bytes = h['max_size_bytes']
+        h['isolated'] = False
+        self.emit('filesink-isolated', path, False)
+
+    def on_filesinks_watchdog(self):
+        if len(self.filesinks) == 0:
+            self.watchdog_id = None
+            return GLib.SOURCE_REMOVE
+
+        now = GLib.get_monotonic_time()
+        for path, h in list(self.filesinks.items()):
+            # A resumed sink is fed from its spill, which absorbs its delays,
+            # and a leaky queue never blocks the tee
+            if h['removing'] or h['failed'] or h['appsrc'] is not None or h['policy'] == SINK_POLICY_LEAK:
+                continue
+            fill_level = self.filesink_fill_level(h)
+
+            if h['isolated']:
+                if fill_level < FILESINK_DRAINED_RATIO:
+                    self.reconnect_filesink(path, h)
+            elif fill_level >= FILESINK_FULL_RATIO:
+                if h['behind_since'] is None:
+                    h['behind_since'] = now
+                elif now - h['behind_since'] >= FILESINK_ISOLATE_AFTER_S * 1000000:
+                    h['behind_since'] = None
+                    self.isolate_filesink(path, h)
+            else:
+                h['behind_since'] = None
+
+        return GLib.SOURCE_CONTINUE
+
     def remove_filesink(self, path):
         logger.debug(f"Removing a filesink to {path}")
 
-        if path not in self.filesinks:
+        if path not in self.filesinks or self.filesinks[path]['removing']:
             logger.error(f"Trying to remove a non existent filesink to {path}")
             return
+
+        if self.preroll_seconds > 0 and self.current_state == Gst.State.PLAYING:
+            # The audio reaching the sinks is preroll_seconds late, keep the
+            # branch a bit longer so the file ends with what was heard when
+            # the recording was stopped.
+            self.filesinks[path]['removing'] = True
+            GLib.timeout_add(int(self.preroll_seconds * 1000), self.detach_filesink, path)
+        else:
+            self.detach_filesink(path)
+
+    def on_tee_pad_blocked(self, pad, info):
+        return Gst.PadProbeReturn.OK
+
+    def detach_filesink(self, path):
+        """
+        Detaches a sink branch without disturbing the others: once its tee
+        pad is idle the branch is unlinked and EOS is sent through its queue,
+        so everything queued reaches the file. The teardown then happens in a
+        worker thread and 'filesink-removed' is emitted when the file is
+        finalized.
+        """
+        h = self.filesinks[path]
+        h['removing'] = True
+
+        if h['spill'] is not None:
+            self.detach_spilling_filesink(path, h)
+        elif self.current_state != Gst.State.PLAYING:
+            h['tee_pad'].unlink(h['queue'].get_static_pad('sink'))
+            self.start_filesink_finalization(path, h)
+        else:
+            h['filesink'].get_static_pad('sink').add_probe(
+                Gst.PadProbeType.EVENT_DOWNSTREAM, self.on_filesink_event, path
+            )
+            if self.inputs[h['input']]['formats'][h['branch']]['private']:
+                # The EOS must go through the encoders
+                self.end_private_branch(h['input'], h['branch'])
+            else:
+                h['tee_pad'].add_probe(Gst.PadProbeType.IDLE, self.on_tee_pad_idle, path)
+            GLib.timeout_add_seconds(FILESINK_DRAIN_TIMEOUT_S, self.on_filesink_drain_timeout, path)
+
+        return GLib.SOURCE_REMOVE
+
+    def on_tee_pad_idle(self, pad, info, path):
+        h = self.filesinks[path]
+        queue_pad = h['queue'].get_static_pad('sink')
+
+        pad.unlink(queue_pad)
+        queue_pad.send_event(Gst.Event.new_eos())
+
+        return Gst.PadProbeReturn.REMOVE
+
+    def on_filesink_event(self, pad, info, path):
+        if info.get_event().type != Gst.EventType.EOS:
+            return Gst.PadProbeReturn.OK
+
+        # Everything before the EOS has been written. Drop it, it must not
+        # reach the pipeline and we can't tear down the branch from its own
+        # streaming thread.
+        self.start_filesink_finalization(path, self.filesinks[path])
+        return Gst.PadProbeReturn.DROP
+
+    def on_filesink_drain_timeout(self, path):
+        h = self.filesinks.get(path)
+        if h is not None and not h['finalizing']:
+            logger.warning(f"Filesink to {path} did not drain in time, forcing its removal")
+            self.start_filesink_finalization(path, h)
+
+        return GLib.SOURCE_REMOVE
+
+    def start_filesink_finalization(self, path, h):
+        with self.finalize_lock:
+            if h['finalizing']:
+                return
+            h['finalizing'] = True
+
+        thread = threading.Thread(
+            target=self.finalize_filesink,
+            args=(path, h),
+            name='elkr-sink-teardown',
+            daemon=True
+        )
+        thread.start()
+
+    def finalize_filesink(self, path, h):
+        h['tee'].release_request_pad(h['tee_pad'])
+
+        if h['failed']:
+            # The branch is being torn down already
+            h['torn_down'].wait()
+        else:
+            if h['appsrc'] is not None:
+                h['appsrc'].unlink(h['queue'])
+                h['appsrc'].set_state(Gst.State.NULL)
+                self.pipeline.remove(h['appsrc'])
+            h['queue'].unlink(h['filesink'])
+
+            h['queue'].set_state(Gst.State.NULL)
+            h['filesink'].set_state(Gst.State.NULL)
+            self.pipeline.remove(h['queue'])
+            self.pipeline.remove(h['filesink'])
+            self.close_writer(h)
+
+        GLib.idle_add(self.on_filesink_finalized, path)
+
+    def close_writer(self, h):
+        """
+        Closes the file of a sink, describing the take in its manifest with
+        the gaps left in it, then adds it to the catalog of its directory.
+        """
+        writer = h['writer']
+        stats = h['stats']
+        if len(stats['gaps']) > 0:
+            writer.index_gaps(stats['first_pts'], stats['gaps'])
+
+        duration_s = None
+        if stats['first_pts'] is not None and stats['last_end'] is not None:
+            gaps = sum(end - start for start, end in stats['gaps'])
+            duration_s = (stats['last_end'] - stats['first_pts'] - gaps) / Gst.SECOND
+        writer.describe(
+            device=self.inputs[h['input']]['device_name'],
+            channel=h['channel'],
+            duration_s=duration_s
+        )
+        writer.close().result()
+        self.catalog_take(writer.path, writer.manifest)
+
+    def catalog_take(self, path, manifest):
+        "Catalogs a take recorded by elkr, from the finalizer thread"
+        record_dir = os.path.dirname(path)
+        if os.path.basename(record_dir) != RECORD_DIR_NAME:
+            return
+        finalizer.submit(
+            catalog_for(record_dir).add_take, path, manifest,
+            device=manifest.get('device'),
+            channel=manifest.get('channel'),
+            duration_s=manifest.get('duration_s')
+        )
+
+    def on_take_verified(self, verifier, path, ok):
+        record_dir = os.path.dirname(path)
+        if os.path.basename(record_dir) == RECORD_DIR_NAME:
+            finalizer.submit(catalog_for(record_dir).refresh_checksum, path)
+
+    def on_filesink_finalized(self, path):
         h = self.filesinks.pop(path)
+        branch = self.inputs[h['input']]['formats'][h['branch']]
+        branch['sinks'] -= 1
+        if branch['private'] and branch['sinks'] == 0:
+            self.remove_format_branch(h['branch'], h['input'])
+        elif branch['sinks'] == 0 and self.current_state != Gst.State.NULL and self.stale_branch(branch):
+            self.rebuild_format_branch(h['branch'], h['input'])
+        self.forget_failed_elements(h)
+        logger.debug(f"Filesink to {path} finalized")
+
+        if self.verifier is not None:
+            record_dir = os.path.dirname(path)
+            files = [os.path.join(record_dir, f) for f in h['writer'].segments]
+            self.verifier.verify(path, files, h['format'], h['writer'].checksums)
+        self.emit('filesink-removed', path)
+
+        return GLib.SOURCE_REMOVE
+
+    def filesink_of(self, element):
+        "Returns the (path, handle) of the filesink branch an element belongs to"
+        for path, h in list(self.filesinks.items()):
+            if element in (h['filesink'], h['queue'], h['appsrc']):
+                return path, h
+        return None, None
+
+    def on_sync_error(self, bus, message):
+        "Called from the thread of the failing element"
+        path, h = self.filesink_of(message.src)
+        if h is None:
+            return
+        if h['removing']:
+            # Too late to save anything, the file ends here
+            self.failed_elements.add(message.src)
+            self.start_filesink_finalization(path, h)
+        else:
+            self.fail_filesink(path, h)
+
+    def fail_filesink(self, path, h=None):
+        """
+        Diverts the audio of a filesink that can't write anymore into a
+        bounded spill, so neither the audio nor the other branches are lost
+        while waiting for resume_filesink(). Safe to call from any thread, for
+        instance as soon as the volume of the sink disappeared.
+        """
+        if h is None:
+            h = self.filesinks[path]
+
+        with self.finalize_lock:
+            if h['failed'] or h['finalizing']:
+                return
+            h['failed'] = True
+        self.failed_elements.update(e for e in (h['filesink'], h['queue'], h['appsrc']) if e is not None)
+
+        with h['lock']:
+            if h['spill'] is None:
+                h['spill'] = Spill(FILESINK_SPILL_SIZE_BYTES)
+                h['divert_probe'] = h['tee_pad'].add_probe(
+                    Gst.PadProbeType.BUFFER, self.on_diverted_buffer, h['spill']
+                )
+
+        GLib.idle_add(self.on_filesink_failed, path, h)
 
-        self['encoder-tee'].unlink(h['queue'])
-        self['encoder-tee'].release_request_pad(h['tee_pad'])
+    def on_diverted_buffer(self, pad, info, spill):
+        spill.push(info.get_buffer())
+        return Gst.PadProbeReturn.DROP
+
+    def on_filesink_failed(self, path, h):
+        logger.warning(f"Filesink to {path} failed, spilling its audio")
+        thread = threading.Thread(
+            target=self.teardown_failed_filesink,
+            args=(h,),
+            name='elkr-sink-teardown',
+            daemon=True
+        )
+        thread.start()
+        self.emit('filesink-failed', path)
+
+        return GLib.SOURCE_REMOVE
+
+    def teardown_failed_filesink(self, h):
+        """
+        Removes the elements of a failed sink. What it had not written for
+        sure is then put back in front of the spill, so the take resumes
+        without a gap, overlapping the failed file by up to FILESINK_RETAIN_S.
+        """
+        if h['appsrc'] is not None:
+            # Unblocks the drain thread, which keeps the buffer it was pushing
+            h['appsrc'].set_state(Gst.State.NULL)
+            h['drain_thread'].join()
+            h['appsrc'].unlink(h['queue'])
+            self.pipeline.remove(h['appsrc'])
+        else:
+            h['tee_pad'].unlink(h['queue'].get_static_pad('sink'))
         h['queue'].unlink(h['filesink'])
 
         h['queue'].set_state(Gst.State.NULL)
         h['filesink'].set_state(Gst.State.NULL)
         self.pipeline.remove(h['queue'])
         self.pipeline.remove(h['filesink'])
+
+        with h['lock']:
+            unwritten = list(h['retained'])
+            h['retained'].clear()
+        if h['drain_pending'] is not None:
+            unwritten.append(h['drain_pending'])
+            h['drain_pending'] = None
+        h['spill'].requeue(unwritten)
+
+        self.close_writer(h)
+        h['torn_down'].set()
+        # After the errors the failed elements already posted
+        GLib.idle_add(self.forget_failed_elements, h)
+
+    def forget_failed_elements(self, h):
+        self.failed_elements.difference_update((h['filesink'], h['queue'], h['appsrc']))
+        return GLib.SOURCE_REMOVE
+
+    def resume_filesink(self, path, new_path):
+        """
+        Continues the take of a failed filesink into new_path, first with the
+        spilled audio and then live. The new branch is fed by an appsrc from
+        the spill, the tee keeps diverting to it. Returns the new handle.
+        """
+        h = self.filesinks.get(path)
+        if h is None or not h['failed'] or h['removing']:
+            logger.error(f"Trying to resume filesink to {path} which didn't fail")
+            return None
+
+        caps = h['tee_pad'].get_current_caps()
+        appsrc = Gst.ElementFactory.make('appsrc', None)
+        appsrc.props.caps = caps
+        appsrc.props.format = Gst.Format.TIME
+        appsrc.props.is_live = False
+        # The drain thread waits for room, the spill absorbs the backlog
+        appsrc.props.block = True
+        appsrc.props.max_bytes = FILESINK_QUEUE_SIZE_BYTES
+
+        writer = self.make_writer(new_path, h['format'], h['write_strategy'])
+        queue, max_size_bytes = self.make_sink_queue(h['policy'])
+        for element in (appsrc, queue, writer.sink):
+            self.pipeline.add(element)
+        appsrc.link(queue)
+        queue.link(writer.sink)
+        for element in (writer.sink, queue, appsrc):
+            element.sync_state_with_parent()
+
+        new_h = self.make_filesink_handle(writer, queue, max_size_bytes, h['tee'], h['tee_pad'], h['policy'])
+        new_h.update({
+            'input': h['input'],
+            'format': h['format'],
+            'branch': h['branch'],
+            'channel': h['channel'],
+            'write_strategy': h['write_strategy'],
+            'spill': h['spill'],
+            'divert_probe': h['divert_probe'],
+            'appsrc': appsrc,
+        })
+        # The handle of the failed sink is replaced, keeping the sink count
+        del self.filesinks[path]
+        self.watch_filesink(new_path, new_h)
+
+        # Formats without headers in their caps, like WAV, only have the ones
+        # the failed sink received
+        headers = stream_headers(caps)
+        if len(headers) == 0:
+            with h['lock']:
+                headers = list(h['retained_headers'])
+        new_h['drain_thread'] = threading.Thread(
+            target=self.drain_spill,
+            args=(new_h, h['torn_down'], headers),
+            name='elkr-spill-drain',
+            daemon=True
+        )
+        new_h['drain_thread'].start()
+
+        logger.info(f"Resuming filesink to {path} into {new_path}")
+        self.emit('filesink-resumed', path, new_path)
+        return new_h
+
+    def drain_spill(self, h, torn_down, headers):
+        """
+        Feeds a resumed sink from its spill, starting with the stream headers
+        of the format. Waits for the failed branch to be torn down first, as
+        it puts back in the spill what it may not have written.
+        """
+        spill = h['spill']
+        appsrc = h['appsrc']
+        torn_down.wait()
+
+        pending = deque(headers)
+        while True:
+            buf = pending.popleft() if len(pending) > 0 else spill.pop(SPILL_POLL_S)
+            if buf is None:
+                if h['failed']:
+                    return
+                if spill.drained:
+                    appsrc.emit('end-of-stream')
+                    return
+                continue
+            if appsrc.emit('push-buffer', buf) != Gst.FlowReturn.OK:
+                h['drain_pending'] = buf
+                return
+
+    def detach_spilling_filesink(self, path, h):
+        "Stops feeding the spill of a failed or resumed sink"
+        # The divert probe stays until the tee pad is released, dropping
+        # what the closed spill doesn't take anymore
+        h['spill'].close()
+
+        if h['failed']:
+            lost = h['spill'].stats()['bytes']
+            if lost > 0:
+                logger.warning(f"Filesink to {path} removed before resuming, {lost} spilled bytes are lost")
+            self.start_filesink_finalization(path, h)
+        elif self.current_state != Gst.State.PLAYING:
+            self.start_filesink_finalization(path, h)
+        else:
+            # The drain thread sends EOS once the spill is empty
+            h['filesink'].get_static_pad('sink').add_probe(
+                Gst.PadProbeType.EVENT_DOWNSTREAM, self.on_filesink_event, path
+            )
+            GLib.timeout_add_seconds(FILESINK_DRAIN_TIMEOUT_S, self.on_filesink_drain_timeout, path)
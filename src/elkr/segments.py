@@ -0,0 +1,224 @@
+import os, json, hashlib, logging
+from concurrent.futures import ThreadPoolExecutor
+
+import gi
+from gi.repository import Gst, GLib
+
+from .flash import FlashSink
+
+logger = logging.getLogger(__name__)
+
+# A new segment is started every SEGMENT_DURATION_S seconds, or every
+# SEGMENT_SIZE_BYTES bytes when set. 0 disables segmentation.
+SEGMENT_DURATION_S = 10 * 60
+SEGMENT_SIZE_BYTES = 0
+# How often the segment being written is flushed to the storage
+FSYNC_INTERVAL_S = 5
+MANIFEST_SUFFIX = '.manifest.json'
+HASH_BLOCK_BYTES = pow(1024, 2)
+
+# multifilesink 'next-file' modes
+NEXT_FILE_MAX_SIZE = 4
+NEXT_FILE_MAX_DURATION = 5
+
+# A single worker, so the manifests are written in order
+finalizer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='elkr-finalizer')
+
+
+def segment_pattern(path):
+    root, ext = os.path.splitext(path)
+    return f"{root}-%05d{ext}"
+
+
+def manifest_path(path):
+    root, _ = os.path.splitext(path)
+    return f"{root}{MANIFEST_SUFFIX}"
+
+
+def fsync_path(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(HASH_BLOCK_BYTES):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_manifest(path, manifest):
+    "Atomically replaces the manifest at path"
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fsync_path(os.path.dirname(path) or '.')
+
+
+class SegmentWriter:
+    def __init__(self, path, format, duration_s=SEGMENT_DURATION_S, size_bytes=SEGMENT_SIZE_BYTES,
+                 fsync_interval_s=FSYNC_INTERVAL_S, segmentable=True, flash_options=None):
+        """
+        Writes a take as a sequence of independent segment files, rotated on
+        buffer boundaries so no sample is lost or duplicated between them.
+        Each closed segment is synced to the storage and appended to the
+        take manifest, from a worker thread, so segments can be post
+        processed while the recording goes on. With flash_options, the
+        files are written by a FlashSink using them instead of the
+        GStreamer sinks.
+        """
+        self.path = path
+        self.manifest_path = manifest_path(path)
+        self.fsync_interval_s = fsync_interval_s
+        self.segmented = segmentable and (duration_s > 0 or size_bytes > 0)
+        self.manifest = {
+            'take': os.path.basename(path),
+            'format': format,
+            'complete': False,
+            'segments': [],
+        }
+        # Written with the last segment, from the finalizer thread
+        self.summary = {}
+
+        self.flash = None
+        if flash_options is not None:
+            self.flash = FlashSink(
+                segment_pattern(path) if self.segmented else path,
+                max_duration=int(duration_s * Gst.SECOND) if self.segmented else 0,
+                max_size_bytes=size_bytes if self.segmented and duration_s <= 0 else 0,
+                on_segment_closed=self.segment_closed,
+                **flash_options
+            )
+            self.sink = self.flash.element
+        elif self.segmented:
+            self.sink = Gst.ElementFactory.make('multifilesink', None)
+            self.sink.props.location = segment_pattern(path)
+            self.sink.props.post_messages = True
+            if duration_s > 0:
+                self.sink.props.next_file = NEXT_FILE_MAX_DURATION
+                self.sink.props.max_file_duration = int(duration_s * Gst.SECOND)
+            else:
+                self.sink.props.next_file = NEXT_FILE_MAX_SIZE
+                self.sink.props.max_file_size = size_bytes
+        else:
+            self.sink = Gst.ElementFactory.make('filesink', None)
+            self.sink.props.location = path
+
+        self.fsync_id = None
+        if fsync_interval_s > 0:
+            self.fsync_id = GLib.timeout_add_seconds(fsync_interval_s, self.on_fsync)
+
+    @property
+    def current_segment(self):
+        if self.flash is not None:
+            return self.flash.current_path
+        if self.segmented:
+            return self.sink.props.location % self.sink.props.index
+        return self.path
+
+    @property
+    def segments(self):
+        return [s['file'] for s in self.manifest['segments']]
+
+    @property
+    def checksums(self):
+        "The sha256 of each finalized segment, by file name"
+        return {s['file']: s.get('sha256') for s in self.manifest['segments']}
+
+    @property
+    def segment_index(self):
+        return self.flash.index if self.flash is not None else self.sink.props.index
+
+    @property
+    def unwritten_pts(self):
+        "The pts of the first buffer the sink holds back, None when it writes them as they come"
+        return None if self.flash is None else self.flash.unwritten_pts
+
+    def on_fsync(self):
+        if self.flash is not None:
+            finalizer.submit(self.flash.sync)
+        else:
+            finalizer.submit(fsync_path, self.current_segment)
+        return GLib.SOURCE_CONTINUE
+
+    def on_segment_closed(self, structure):
+        "Handles the message multifilesink posts when closing a segment"
+        self.segment_closed(structure.get_string('filename'), {
+            field: structure.get_value(field)
+            for field in ('index', 'timestamp', 'duration', 'running-time')
+            if structure.has_field(field)
+        })
+
+    def segment_closed(self, filename, fields):
+        segment = {'file': os.path.basename(filename)}
+        segment.update(fields)
+
+        logger.debug(f"Segment closed: {filename}")
+        finalizer.submit(self.finalize_segment, filename, segment, False)
+
+    def index_gaps(self, first_pts, gaps):
+        """
+        Adds the gaps of the take to its manifest, each with the time in the
+        take it happens at and the audio time it lasted, in seconds. The take
+        is seamless otherwise, this maps it back to the capture time.
+        """
+        index = []
+        skipped = 0
+        for gap_start, gap_end in gaps:
+            index.append({
+                'take_s': (gap_start - first_pts - skipped) / Gst.SECOND,
+                'pts_s': gap_start / Gst.SECOND,
+                'duration_s': (gap_end - gap_start) / Gst.SECOND,
+            })
+            skipped += gap_end - gap_start
+        self.describe(gaps=index)
+
+    def describe(self, **fields):
+        "Adds fields describing the take to the manifest written with the last segment"
+        self.summary.update(fields)
+
+    def close(self):
+        "Finalizes the last segment, the sink must have been stopped"
+        if self.fsync_id is not None:
+            GLib.source_remove(self.fsync_id)
+            self.fsync_id = None
+
+        filename = self.current_segment
+        segment = {'file': os.path.basename(filename)}
+        if self.segmented:
+            segment['index'] = self.segment_index
+        return finalizer.submit(self.finalize_segment, filename, segment, True)
+
+    def finalize_segment(self, filename, segment, last):
+        if last and self.flash is not None:
+            self.flash.close()
+        fsync_path(filename)
+        try:
+            segment['bytes'] = os.path.getsize(filename)
+        except FileNotFoundError:
+            segment['bytes'] = 0
+        # What was written, for the verification to read back later
+        try:
+            segment['sha256'] = sha256_file(filename)
+        except OSError as err:
+            logger.warning(f"Unable to hash {filename}: {err}")
+            segment['sha256'] = None
+
+        self.manifest['segments'].append(segment)
+        self.manifest['complete'] = last
+        if last:
+            self.manifest.update(self.summary)
+        try:
+            write_manifest(self.manifest_path, self.manifest)
+        except OSError as err:
+            logger.error(f"Unable to write manifest {self.manifest_path}: {err}")
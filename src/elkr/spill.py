@@ -0,0 +1,83 @@
+import logging, threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class Spill:
+    def __init__(self, max_bytes):
+        """
+        Bounded FIFO of encoded buffers, filled from a streaming thread while
+        a destination can't be written and drained by another thread once it
+        can. When full, the oldest buffers are dropped and accounted.
+        """
+        self.max_bytes = max_bytes
+        self.buffers = deque()
+        self.bytes = 0
+        self.dropped_buffers = 0
+        self.dropped_bytes = 0
+        self.drained_buffers = 0
+        self.drained_bytes = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def push(self, buf):
+        size = buf.get_size()
+        with self.cond:
+            if self.closed:
+                return
+            self.buffers.append(buf)
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self.buffers) > 1:
+                dropped = self.buffers.popleft()
+                self.bytes -= dropped.get_size()
+                self.dropped_buffers += 1
+                self.dropped_bytes += dropped.get_size()
+            self.cond.notify()
+
+    @property
+    def drained(self):
+        with self.cond:
+            return self.closed and len(self.buffers) == 0
+
+    def pop(self, timeout=None):
+        """
+        Waits for the next buffer. Returns None once closed and empty, or
+        when nothing came within timeout.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.buffers) > 0 or self.closed, timeout)
+            if len(self.buffers) == 0:
+                return None
+            buf = self.buffers.popleft()
+            size = buf.get_size()
+            self.bytes -= size
+            self.drained_buffers += 1
+            self.drained_bytes += size
+            return buf
+
+    def requeue(self, buffers):
+        "Puts buffers back in front of the spill, in order"
+        with self.cond:
+            for buf in reversed(buffers):
+                self.buffers.appendleft(buf)
+                self.bytes += buf.get_size()
+            self.cond.notify()
+
+    def close(self):
+        "No more buffers will be pushed, pop() returns None once drained"
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'buffers': len(self.buffers),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'dropped_buffers': self.dropped_buffers,
+                'dropped_bytes': self.dropped_bytes,
+                'drained_buffers': self.drained_buffers,
+                'drained_bytes': self.drained_bytes,
+            }
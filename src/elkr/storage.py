@@ -0,0 +1,167 @@
+import os, time, logging, datetime, threading
+from collections import deque
+
+import gi
+from gi.repository import GLib
+
+logger = logging.getLogger(__name__)
+
+RECORD_DIR_NAME = 'elk-recorder'
+
+# The write benchmark run when a volume gets mounted
+PROBE_SIZE_BYTES = 32 * pow(1024, 2)
+PROBE_BLOCK_BYTES = pow(1024, 2)
+PROBE_FILE_NAME = '.elkr-write-probe'
+# Number of one second samples of the rolling write rate
+WRITE_RATE_WINDOW_S = 30
+
+
+def make_record_dir(root):
+    "Returns the recording directory of a volume mounted at root, creating it if needed"
+    record_dir = os.path.join(root, RECORD_DIR_NAME)
+
+    if not os.path.exists(record_dir):
+        os.mkdir(record_dir)
+
+    return record_dir
+
+
+def channel_path(path, channel):
+    "The path of the file recording a single channel of the take at path"
+    root, ext = os.path.splitext(path)
+    return f"{root}-ch{channel + 1:02}{ext}"
+
+
+def make_record_path(record_dir, ext="wv", attempts=23, channels=None, catalog=None):
+    """
+    Returns the path of a file to point the filesink to. The file name
+    includes a timestamps to prevent collision, but if the file already exists, it
+    attempts to find unique file names a few times. With a channel count,
+    the per channel files of the take must not exist either.
+
+    With the catalog of record_dir, the names are allocated by the catalog,
+    so the first attempt is almost always the right one.
+
+    Returns None if no unique file name was available
+    """
+    now = datetime.datetime.now()
+    stem = f"elkr-{now.strftime('%y%m%d-%H%M%S')}"
+
+    for attempt in range(attempts):
+        name = None if catalog is None else catalog.allocate_name(stem)
+        if name is None:
+            name = stem if attempt == 0 else f"{stem}-{attempt}"
+        path = os.path.join(record_dir, f"{name}.{ext}")
+
+        if os.path.exists(path):
+            continue
+        if channels is None or not any(
+                os.path.exists(channel_path(path, channel)) for channel in range(channels)):
+            return path
+
+
+def make_resume_path(record_dir, path, attempts=23):
+    """
+    Returns the path continuing the take of a file whose volume failed, in
+    record_dir. The file is named after the failed one, with a resume number.
+
+    Returns None if no unique file name was available
+    """
+    root, ext = os.path.splitext(os.path.basename(path))
+    for attempt in range(1, attempts + 1):
+        resume_path = os.path.join(record_dir, f"{root}-r{attempt}{ext}")
+        if not os.path.exists(resume_path):
+            return resume_path
+
+
+def make_take_paths(record_dir, inputs, ext="wv", catalog=None):
+    """
+    Returns the paths recording each of the inputs to the same take, by input.
+    The first input gets the usual file name, the others add their index to it.
+
+    Returns None if no unique take name was available
+    """
+    path = make_record_path(record_dir, ext, catalog=catalog)
+    if path is None:
+        return None
+
+    stem = path[:-len(ext) - 1]
+    paths = {
+        input: path if input == 0 else f"{stem}-in{input}.{ext}"
+        for input in inputs
+    }
+    if any(os.path.exists(p) for p in paths.values()):
+        return None
+    return paths
+
+
+def free_space(path):
+    "Returns the number of bytes available to us on the filesystem holding path"
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def probe_write_speed(record_dir, size=PROBE_SIZE_BYTES, block_size=PROBE_BLOCK_BYTES):
+    """
+    Measures the sustained write speed of a directory in bytes per second by
+    writing and syncing a temporary file. Incompressible data is used so
+    compressing filesystems or controllers don't fool the measure.
+    """
+    path = os.path.join(record_dir, PROBE_FILE_NAME)
+    block = os.urandom(block_size)
+    written = 0
+
+    started_at = time.monotonic()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while written < size:
+            written += os.write(fd, block)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+        os.unlink(path)
+    elapsed = time.monotonic() - started_at
+
+    return written / elapsed
+
+
+def probe_write_speed_async(record_dir, callback):
+    """
+    Runs probe_write_speed() in a worker thread, callback is called from the
+    main loop with the speed, or None if the probe failed.
+    """
+    def probe():
+        try:
+            speed = probe_write_speed(record_dir)
+        except OSError as err:
+            logger.warning(f"Unable to probe the write speed of {record_dir}: {err}")
+            speed = None
+        GLib.idle_add(callback, speed)
+
+    thread = threading.Thread(target=probe, name='elkr-write-probe', daemon=True)
+    thread.start()
+
+
+class WriteRate:
+    def __init__(self, window=WRITE_RATE_WINDOW_S):
+        "Rolling rate of a growing byte counter"
+        self.samples = deque(maxlen=window)
+
+    def add(self, total_bytes, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.samples.append((now, total_bytes))
+
+    def reset(self):
+        self.samples.clear()
+
+    @property
+    def rate(self):
+        "Bytes per second over the window, None until there are two samples"
+        if len(self.samples) < 2:
+            return None
+
+        (first_at, first_bytes), (last_at, last_bytes) = self.samples[0], self.samples[-1]
+        if last_at <= first_at:
+            return None
+        return (last_bytes - first_bytes) / (last_at - first_at)
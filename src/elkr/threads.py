@@ -0,0 +1,181 @@
+import os, time, ctypes, logging, threading
+
+logger = logging.getLogger(__name__)
+
+# Roles of the streaming threads:
+# - capture: the threads of the sources, reading the devices
+# - input: the input and pre-roll queues, converting and metering
+# - encoder: the queues of the encoding branches
+# - writer: the queues of the filesinks, and the appsrc of the resumed ones
+# - monitor: the network monitor queue
+THREAD_ROLE_CAPTURE = 'capture'
+THREAD_ROLE_INPUT = 'input'
+THREAD_ROLE_ENCODER = 'encoder'
+THREAD_ROLE_WRITER = 'writer'
+THREAD_ROLE_MONITOR = 'monitor'
+THREAD_ROLE_OTHER = 'other'
+THREAD_ROLES = (
+    THREAD_ROLE_CAPTURE, THREAD_ROLE_INPUT, THREAD_ROLE_ENCODER, THREAD_ROLE_WRITER,
+    THREAD_ROLE_MONITOR, THREAD_ROLE_OTHER
+)
+THREAD_ROLE_PREFIXES = {
+    THREAD_ROLE_CAPTURE: 'cap',
+    THREAD_ROLE_INPUT: 'in',
+    THREAD_ROLE_ENCODER: 'enc',
+    THREAD_ROLE_WRITER: 'wr',
+    THREAD_ROLE_MONITOR: 'mon',
+    THREAD_ROLE_OTHER: 'gst',
+}
+# The kernel keeps 15 characters of a thread name
+THREAD_NAME_MAX = 15
+# Tried for the capture threads when real time scheduling isn't allowed
+CAPTURE_FALLBACK_NICE = -10
+
+PR_SET_NAME = 15
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+
+def parse_cpus(cpus):
+    "Parses a CPU list such as '0-1,3' into a set"
+    result = set()
+    for part in cpus.split(','):
+        first, _, last = part.strip().partition('-')
+        result.update(range(int(first), int(last or first) + 1))
+    return result
+
+
+def parse_affinity(affinity):
+    "Parses 'role=cpus;role=cpus', e.g. 'capture=3;encoder=0-2', into a dict"
+    result = {}
+    for item in affinity.split(';'):
+        if item.strip() == '':
+            continue
+        role, _, cpus = item.partition('=')
+        role = role.strip()
+        if role not in THREAD_ROLES:
+            raise ValueError(f"Unknown thread role '{role}'")
+        result[role] = parse_cpus(cpus)
+    return result
+
+
+def thread_cpu_s(tid):
+    "CPU time of a thread of this process, or None once it is gone"
+    try:
+        with open(f"/proc/self/task/{tid}/stat") as f:
+            # The fields after the command name, which may contain spaces
+            fields = f.read().rpartition(')')[2].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class ThreadPolicy:
+    def __init__(self, affinity=None, capture_priority=None, worker_nice=None):
+        """
+        Applied by the streaming threads to themselves when they start a
+        task, from the stream-status messages. Each thread is named after
+        its role and the element owning it. With affinity, a dict of CPU
+        sets by role, the threads of a role are pinned to its CPUs and the
+        others to the rest. capture_priority is the SCHED_FIFO priority of
+        the capture threads, which fall back to a negative nice when real
+        time scheduling isn't allowed. worker_nice is the nice value of the
+        encoder and writer threads. What can't be applied is logged once
+        and left as is. The CPU time of the threads is accounted by role.
+        """
+        self.affinity = affinity or {}
+        self.capture_priority = capture_priority
+        self.worker_nice = worker_nice
+        # Where the threads without a role of their own may run
+        self.default_cpus = os.sched_getaffinity(0)
+        if len(self.affinity) > 0:
+            pinned = set().union(*self.affinity.values())
+            self.default_cpus = (self.default_cpus - pinned) or self.default_cpus
+
+        self.lock = threading.Lock()
+        # Threads running a task, by native id
+        self.threads = {}
+        # CPU time of the tasks that are over, by role
+        self.cpu_s = {role: 0.0 for role in THREAD_ROLES}
+        self.warned = set()
+
+    def warn_once(self, key, message):
+        if key not in self.warned:
+            self.warned.add(key)
+            logger.warning(message)
+
+    def enter(self, role, owner_name):
+        "Called from a streaming thread starting a task"
+        tid = threading.get_native_id()
+        name = f"{THREAD_ROLE_PREFIXES[role]}:{owner_name}"[:THREAD_NAME_MAX]
+        libc.prctl(PR_SET_NAME, name.encode(), 0, 0, 0)
+
+        applied = {}
+        if len(self.affinity) > 0:
+            cpus = self.affinity.get(role, self.default_cpus)
+            try:
+                os.sched_setaffinity(0, cpus)
+                applied['cpus'] = sorted(cpus)
+            except OSError as err:
+                self.warn_once(('affinity', role), f"Unable to pin the {role} threads to {sorted(cpus)}: {err}")
+        applied.update(self.set_priority(role))
+
+        with self.lock:
+            self.threads[tid] = {
+                'name': name,
+                'role': role,
+                'owner': owner_name,
+                'cpu_at_enter': time.thread_time(),
+                'applied': applied,
+            }
+        logger.debug(f"Streaming thread {tid} entering as {name}: {applied}")
+
+    def set_priority(self, role):
+        # Pooled threads may have run a task of another role before
+        if role == THREAD_ROLE_CAPTURE and self.capture_priority is not None:
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.capture_priority))
+                return {'sched': 'fifo', 'priority': self.capture_priority}
+            except OSError as err:
+                self.warn_once('fifo', f"Real time scheduling of the capture threads is not allowed: {err}")
+            nice = CAPTURE_FALLBACK_NICE
+        elif role in (THREAD_ROLE_ENCODER, THREAD_ROLE_WRITER) and self.worker_nice is not None:
+            nice = self.worker_nice
+        elif self.capture_priority is None and self.worker_nice is None:
+            return {}
+        else:
+            nice = 0
+
+        try:
+            if os.sched_getscheduler(0) != os.SCHED_OTHER:
+                os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+            return {'sched': 'other', 'nice': nice}
+        except OSError as err:
+            self.warn_once(('nice', nice), f"Unable to set the nice value of the {role} threads to {nice}: {err}")
+            return {}
+
+    def leave(self):
+        "Called from a streaming thread done with its task"
+        with self.lock:
+            thread = self.threads.pop(threading.get_native_id(), None)
+            if thread is not None:
+                self.cpu_s[thread['role']] += time.thread_time() - thread['cpu_at_enter']
+
+    def get_stats(self):
+        with self.lock:
+            threads = {tid: dict(thread) for tid, thread in self.threads.items()}
+            cpu_s = dict(self.cpu_s)
+
+        for tid, thread in threads.items():
+            # Both clocks count the CPU time of the thread since it started
+            total = thread_cpu_s(tid)
+            cpu_at_enter = thread.pop('cpu_at_enter')
+            thread['cpu_s'] = None if total is None else max(0.0, total - cpu_at_enter)
+            if thread['cpu_s'] is not None:
+                cpu_s[thread['role']] += thread['cpu_s']
+
+        return {
+            'threads': threads,
+            'cpu_s': cpu_s,
+        }
@@ -0,0 +1,57 @@
+import logging
+
+import gi
+from gi.repository import Gst, GObject, GLib
+
+logger = logging.getLogger(__name__)
+
+TICK_INTERVAL_MS = 1000
+
+
+class Ticker(GObject.Object):
+    @GObject.Signal(name='tick', flags=GObject.SignalFlags.RUN_LAST,
+                    arg_types=(GObject.TYPE_INT64,),
+                    return_type=None)
+    def tick(self, *args):
+        pass
+
+    def __init__(self, pipeline):
+        """
+        The single UI timer. It reads the pipeline running time once per tick
+        and emits it to every clock, or -1 when the pipeline stops. It only
+        runs while the pipeline is playing and someone is looking.
+        """
+        super().__init__()
+
+        self.pipeline = pipeline
+        self.visible = True
+        self.source_id = None
+
+        self.pipeline.connect('state-changed', self.on_pipeline_state_changed)
+
+    @property
+    def running(self):
+        return self.source_id is not None
+
+    def set_visible(self, visible):
+        self.visible = visible
+        self.update()
+
+    def on_pipeline_state_changed(self, _, old_state, new_state):
+        self.update()
+
+    def update(self):
+        wanted = self.visible and self.pipeline.current_state == Gst.State.PLAYING
+
+        if wanted and not self.running:
+            self.source_id = GLib.timeout_add(TICK_INTERVAL_MS, self.on_tick)
+            self.on_tick()
+        elif not wanted and self.running:
+            GLib.source_remove(self.source_id)
+            self.source_id = None
+            if self.pipeline.current_state != Gst.State.PLAYING:
+                self.emit('tick', -1)
+
+    def on_tick(self):
+        self.emit('tick', self.pipeline.running_time)
+        return GLib.SOURCE_CONTINUE
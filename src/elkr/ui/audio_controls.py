@@ -4,6 +4,7 @@ import gi
 from gi.repository import GLib, Gtk, Adw, Gst
 
 from .clock import Clock
+from .meters import Meters
 
 logger = logging.getLogger(__name__)
 
@@ -14,9 +15,8 @@ class AudioControls(Gtk.Box):
         super().__init__(*args, **kwargs)
 
         self.app = app
-        self.devices = {}
         self.make_device_dropdown()
-        self.make_device_monitor()
+        self.make_meters()
         self.app.pipeline.connect('state-changed', self.on_pipeline_state_changed)
 
         self.control_label = Gtk.Label.new()
@@ -28,16 +28,28 @@ class AudioControls(Gtk.Box):
         self.append(self.row)
         self.make_time_counter()
         self.make_buttons()
+        # Selecting a cached device needs the buttons
+        self.make_device_monitor()
 
     def make_device_monitor(self):
-        self.monitor = Gst.DeviceMonitor.new()
-        self.monitor.add_filter("Audio/Source", None)
+        # Start with the devices known from the last run, the live ones are
+        # reconciled when the monitor starts
+        selected = self.app.devices.selected
+        names = self.app.devices.names()
 
-        monitor_bus = self.monitor.get_bus()
-        monitor_bus.add_signal_watch()
-        monitor_bus.connect('message', self.on_device_monitor_message)
+        # The dropdown selects the first item it gets, which must not be
+        # remembered in place of the last used device
+        model = self.device_dropdown.get_model()
+        with self.device_dropdown.handler_block(self.device_selected_id):
+            for name in names:
+                model.append(name)
+            self.device_dropdown.props.selected = Gtk.INVALID_LIST_POSITION
 
-        self.monitor.start()
+        if selected in names:
+            self.device_dropdown.props.selected = names.index(selected)
+
+        self.app.devices.connect('device-added', self.on_device_added)
+        self.app.devices.connect('device-removed', self.on_device_removed)
 
     def make_device_dropdown(self):
         self.device_dropdown_label = Gtk.Label.new()
@@ -50,13 +62,18 @@ class AudioControls(Gtk.Box):
         # self.device_dropdown = Gtk.ComboBoxText()
         self.device_dropdown = Gtk.DropDown.new_from_strings([])
         # self.device_dropdown.props.sensitive = False
-        self.device_dropdown.connect("notify::selected", self.on_device_selected)
+        self.device_selected_id = self.device_dropdown.connect("notify::selected", self.on_device_selected)
         self.append(self.device_dropdown)
 
+    def make_meters(self):
+        self.meters = Meters(self.app.pipeline)
+        self.meters.props.margin_top = 4
+        self.append(self.meters)
+
     def make_time_counter(self):
         self.clock = Clock()
         self.row.append(self.clock)
-        GLib.timeout_add_seconds(1, self.update_time_counter)
+        self.app.ticker.connect('tick', self.on_tick)
 
     def make_buttons(self):
         self.stop_button = Gtk.Button.new_from_icon_name('media-playback-stop')
@@ -74,16 +91,11 @@ class AudioControls(Gtk.Box):
             self.row.append(self.dump_button)
         self.dump_button.connect('clicked', self.dump_button_clicked)
 
-    def update_time_counter(self):
-        pos = self.app.pipeline.current_position
-
-        if pos == -1:
+    def on_tick(self, ticker, running_time):
+        if running_time < 0:
             self.clock.set_time_in_seconds()
         else:
-            self.clock.set_time_in_seconds(pos // Gst.SECOND)
-
-        # The callback will be removed if we return a falsy value
-        return True
+            self.clock.set_time_in_seconds(running_time // Gst.SECOND)
 
     def rec_button_clicked(self, button):
         logger.debug('rec_button_clicked')
@@ -97,49 +109,38 @@ class AudioControls(Gtk.Box):
         logger.debug('Requested pipeline dump')
         self.app.pipeline.dump_dot()
 
-    def on_device_monitor_message(self, bus, message):
-        # The int cast works around the bug described in
-        # https://bugzilla.gnome.org/show_bug.cgi?id=786948
-        # This didn't exist in more recent versions of gst/gst-python
-        t = int(message.type)
-
-        if t == int(Gst.MessageType.DEVICE_ADDED):
-            device = message.parse_device_added()
-            self.on_device_added(device)
-        elif t == int(Gst.MessageType.DEVICE_REMOVED):
-            device = message.parse_device_removed()
-            self.on_device_removed(device)
-
-    def on_device_added(self, device):
-        name = device.props.display_name
-        logger.info(f"Discovered device: {name}")
-        self.devices[name] = device
+    def on_device_added(self, devices, name):
         self.device_dropdown.get_model().append(name)
 
-    def on_device_removed(self, device):
-        name = device.props.display_name
-        logger.info(f"Device removed: {name}")
-
-        idx = 0
-        for row in self.device_dropdown.get_model():
-            if row[0] == name:
-                self.device_dropdown.get_model().remove(idx)
-            idx += 1
-
-        del self.devices[name]
+    def on_device_removed(self, devices, name):
+        model = self.device_dropdown.get_model()
+        for idx in range(model.get_n_items()):
+            if model.get_string(idx) == name:
+                model.remove(idx)
+                break
 
     def on_device_selected(self, *args):
-        name = self.device_dropdown.props.selected_item.props.string
+        item = self.device_dropdown.props.selected_item
+        if item is None:
+            return
+        name = item.props.string
         logger.debug(f"Selected device '{name}'")
 
-        if name not in self.devices:
+        if name not in self.app.devices:
             logger.error(f"Device {name} not found")
             return
+        if name == self.app.pipeline.device_name:
+            return
 
-        device = self.devices[name]
+        device = self.app.devices[name]
         self.app.pipeline.select_device(device)
+        self.app.devices.remember(name)
         self.rec_button.props.sensitive = True
 
+        # Open the device now so pressing record only has to start it
+        if self.app.pipeline.current_state == Gst.State.NULL:
+            self.app.pipeline.set_state_async(Gst.State.READY)
+
     def on_pipeline_state_changed(self, _, old_state, new_state):
         logger.debug(f"State changed to {new_state}")
 
@@ -148,8 +149,10 @@ class AudioControls(Gtk.Box):
             self.rec_button.props.sensitive = True
             self.stop_button.props.sensitive = False
         elif new_state == 'ready':
-            self.rec_button.props.sensitive = False
-            self.stop_button.props.sensitive = True
+            # Resting in READY means the device is open and waiting
+            idle = not self.app.pipeline.in_transition
+            self.rec_button.props.sensitive = idle
+            self.stop_button.props.sensitive = not idle
         elif new_state == 'paused':
             self.rec_button.props.sensitive = False
             self.stop_button.props.sensitive = True
@@ -157,5 +160,9 @@ class AudioControls(Gtk.Box):
         elif new_state == 'playing':
             self.rec_button.props.sensitive = False
             self.stop_button.props.sensitive = True
+            self.app.devices.remember(
+                self.app.pipeline.device_name,
+                self.app.pipeline.negotiated_caps()
+            )
         else:
             logger.error(f"Unknown pipeline state: {new_state}")
@@ -19,6 +19,10 @@ class MainWindow(Gtk.ApplicationWindow):
         self.main_vbox.append(self.audio_controls)
         self.main_vbox.append(self.volumes)
 
+        # Nobody looks at the clocks while the window is hidden
+        self.connect('map', lambda _: self.app.ticker.set_visible(True))
+        self.connect('unmap', lambda _: self.app.ticker.set_visible(False))
+
     @property
     def app(self):
         return self.props.application
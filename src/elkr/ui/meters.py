@@ -0,0 +1,152 @@
+import logging
+
+import gi
+from gi.repository import GLib, Gtk
+
+logger = logging.getLogger(__name__)
+
+METER_FPS = 30
+METER_FLOOR_DB = -60.0
+# Peaks above this level are considered clipping
+CLIP_DB = -0.1
+CLIP_HOLD_FRAMES = 2 * METER_FPS
+# An input whose RMS stays below this level looks dead
+SILENCE_DB = -90.0
+CHANNEL_SPACING = 1
+
+RMS_COLOR = (0.2, 0.7, 0.3)
+PEAK_COLOR = (0.9, 0.8, 0.2)
+CLIP_COLOR = (0.9, 0.1, 0.1)
+SILENCE_COLOR = (0.4, 0.4, 0.4)
+BACKGROUND_COLOR = (0.1, 0.1, 0.1)
+
+
+def db_to_ratio(db):
+    if db <= METER_FLOOR_DB:
+        return 0.0
+    return min(1.0, (db - METER_FLOOR_DB) / -METER_FLOOR_DB)
+
+
+def meter_bars(levels, width):
+    "The (rms, peak, silent) bar of each channel, in pixels of width"
+    return [
+        (
+            int(db_to_ratio(rms) * width),
+            int(db_to_ratio(peak) * width),
+            rms < SILENCE_DB,
+        )
+        for peak, rms in zip(levels['peak'], levels['rms'])
+    ]
+
+
+def hold_clips(peaks, clips):
+    "The frames left showing the clip of each channel, one frame later"
+    if len(clips) != len(peaks):
+        clips = [0] * len(peaks)
+    return [
+        CLIP_HOLD_FRAMES if peak >= CLIP_DB else max(0, hold - 1)
+        for peak, hold in zip(peaks, clips)
+    ]
+
+
+def decay_clips(clips):
+    "The frames left showing the clip of each channel, one frame without levels later"
+    return [max(0, hold - 1) for hold in clips]
+
+
+def draw_meters(cr, width, height, bars, clips):
+    "Draws the bars on a Cairo context, without any widget"
+    cr.set_source_rgb(*BACKGROUND_COLOR)
+    cr.paint()
+
+    channels = len(bars)
+    if channels == 0:
+        return
+
+    bar_height = max(1, (height - CHANNEL_SPACING * (channels - 1)) / channels)
+    for idx, (rms, peak, silent) in enumerate(bars):
+        y = idx * (bar_height + CHANNEL_SPACING)
+
+        if silent:
+            cr.set_source_rgb(*SILENCE_COLOR)
+            cr.rectangle(0, y, width, bar_height)
+            cr.fill()
+            continue
+
+        cr.set_source_rgb(*RMS_COLOR)
+        cr.rectangle(0, y, rms, bar_height)
+        cr.fill()
+
+        cr.set_source_rgb(*(CLIP_COLOR if clips[idx] > 0 else PEAK_COLOR))
+        cr.rectangle(max(0, peak - 2), y, 2, bar_height)
+        cr.fill()
+
+
+class Meters(Gtk.DrawingArea):
+    def __init__(self, pipeline, *args, **kwargs):
+        """
+        Per channel peak/RMS meters of every input, one under the other. The
+        levels coalesced by the pipeline are read METER_FPS times per second,
+        and the widget is only redrawn when a bar moved by at least a pixel
+        or a clip indicator changed. The clips are held for CLIP_HOLD_FRAMES
+        frames, whether new levels came or not.
+        """
+        super().__init__(*args, **kwargs)
+
+        self.pipeline = pipeline
+        # By input
+        self.bars = {}
+        self.clips = {}
+        self.frame_id = None
+
+        self.set_content_height(48)
+        self.set_hexpand(True)
+        self.set_draw_func(self.on_draw)
+
+        self.pipeline.connect('state-changed', self.on_pipeline_state_changed)
+
+    def on_pipeline_state_changed(self, _, old_state, new_state):
+        if new_state == 'playing' and self.frame_id is None:
+            self.frame_id = GLib.timeout_add(1000 // METER_FPS, self.on_frame)
+        elif new_state != 'playing' and self.frame_id is not None:
+            GLib.source_remove(self.frame_id)
+            self.frame_id = None
+            self.bars = {}
+            self.clips = {}
+            self.queue_draw()
+
+    def on_frame(self):
+        changed = False
+        inputs = sorted(self.pipeline.inputs)
+        for input in list(self.bars):
+            if input not in inputs:
+                del self.bars[input]
+                del self.clips[input]
+                changed = True
+
+        for input in inputs:
+            old_clips = self.clips.get(input, [])
+            levels = self.pipeline.take_levels(input)
+            if levels is None:
+                # The clips decay every frame, even without new levels
+                bars = self.bars.get(input, [])
+                clips = decay_clips(old_clips)
+            else:
+                bars = meter_bars(levels, self.get_width())
+                clips = hold_clips(levels['peak'], old_clips)
+
+            if [c > 0 for c in clips] != [c > 0 for c in old_clips] or bars != self.bars.get(input):
+                changed = True
+            self.bars[input] = bars
+            self.clips[input] = clips
+
+        if changed:
+            self.queue_draw()
+
+        return GLib.SOURCE_CONTINUE
+
+    def on_draw(self, area, cr, width, height):
+        inputs = sorted(self.bars)
+        bars = [bar for input in inputs for bar in self.bars[input]]
+        clips = [hold for input in inputs for hold in self.clips[input]]
+        draw_meters(cr, width, height, bars, clips)
@@ -0,0 +1,107 @@
+import os, time, logging
+
+import gi
+from gi.repository import GLib, Gtk
+
+logger = logging.getLogger(__name__)
+
+BROWSE_ICON = 'system-search'
+LIST_WIDTH = 420
+LIST_HEIGHT = 320
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '--:--:--'
+    seconds = int(seconds)
+    return f"{seconds // 3600:02}:{(seconds % 3600) // 60:02}:{seconds % 60:02}"
+
+
+def format_size(size):
+    return f"{(size or 0) / pow(1024, 2):.1f} MiB"
+
+
+class TakeBrowser(Gtk.MenuButton):
+    def __init__(self, *args, **kw):
+        """
+        Button opening a searchable list of the takes of a volume, read from
+        its catalog. The list is only filled while shown.
+        """
+        super().__init__(*args, **kw)
+        self.set_icon_name(BROWSE_ICON)
+        self.catalog = None
+        # Only the results of the last search are shown
+        self.searches = 0
+
+        self.search_entry = Gtk.SearchEntry.new()
+        self.search_entry.connect('search-changed', lambda _: self.refresh())
+
+        self.list_box = Gtk.ListBox.new()
+        self.list_box.set_selection_mode(Gtk.SelectionMode.NONE)
+        scrolled = Gtk.ScrolledWindow.new()
+        scrolled.set_size_request(LIST_WIDTH, LIST_HEIGHT)
+        scrolled.set_child(self.list_box)
+
+        box = Gtk.Box.new(Gtk.Orientation.VERTICAL, 4)
+        box.append(self.search_entry)
+        box.append(scrolled)
+
+        popover = Gtk.Popover.new()
+        popover.set_child(box)
+        popover.connect('show', lambda _: self.refresh())
+        self.set_popover(popover)
+
+        self.set_catalog(None)
+
+    def set_catalog(self, catalog):
+        self.catalog = catalog
+        self.props.sensitive = catalog is not None
+
+    def refresh(self):
+        "Searches the catalog from its worker thread, the list is filled once done"
+        if not self.get_popover().get_visible():
+            return
+
+        self.searches += 1
+        if self.catalog is None:
+            self.show_takes(self.searches, [])
+            return
+        search = self.searches
+        self.catalog.search_async(
+            self.search_entry.get_text(),
+            lambda takes: GLib.idle_add(self.show_takes, search, takes)
+        )
+
+    def show_takes(self, search, takes):
+        if search != self.searches or not self.get_popover().get_visible():
+            return GLib.SOURCE_REMOVE
+
+        child = self.list_box.get_first_child()
+        while child is not None:
+            self.list_box.remove(child)
+            child = self.list_box.get_first_child()
+
+        for take in takes:
+            self.list_box.append(self.make_row(take))
+        return GLib.SOURCE_REMOVE
+
+    def make_row(self, take):
+        created = '' if take['created'] is None else time.strftime('%Y-%m-%d %H:%M', time.localtime(take['created']))
+        details = [
+            created,
+            format_duration(take['duration_s']),
+            format_size(take['bytes']),
+            take['device'] or '',
+        ]
+        if take['gaps']:
+            details.append(f"{take['gaps']} gaps")
+        if not take['complete']:
+            details.append("incomplete")
+
+        label = Gtk.Label.new()
+        label.set_xalign(0)
+        label.set_markup(
+            f"{GLib.markup_escape_text(os.path.splitext(take['take'])[0])}\n"
+            f"<span size=\"small\">{GLib.markup_escape_text(' - '.join(d for d in details if d))}</span>"
+        )
+        return label
@@ -1,15 +1,28 @@
-import os, logging, datetime
+import os, logging
 
 import gi
-from gi.repository import Gtk, Gst, Gio
+from gi.repository import GLib, Gtk, Gst, Gio
 
 from .clock import Clock
+from .takes import TakeBrowser
+from ..storage import (
+    make_record_dir, make_record_path, make_resume_path, free_space, probe_write_speed_async, WriteRate
+)
+from ..encoder import FORMATS
+from ..catalog import catalog_for, drop_catalog
 
 logger = logging.getLogger(__name__)
 
 RECORD_ICON = 'media-record'
 STOP_ICON = 'media-playback-stop'
 
+# Warn when the volume will be full within this many seconds
+REMAINING_WARNING_S = 15 * 60
+# Warn when the volume can't write at least this many times the recorded rate
+WRITE_SPEED_MARGIN = 2.0
+# Warn when the sink queue gets this full, the volume is falling behind
+FILL_LEVEL_WARNING = 0.5
+
 class Volume(Gtk.Box):
     def __init__(self, parent, volume, *args, **kwargs):
         kwargs['orientation'] = Gtk.Orientation.HORIZONTAL
@@ -19,14 +32,47 @@ class Volume(Gtk.Box):
         self.parent = parent
         self.volume = volume
         self.record_path = None
+        # Every file of the take, one per channel in split mode
+        self.record_paths = []
+        # Paths of the recordings still being written after being stopped
+        self.finalizing = set()
+        # Paths of the recordings being verified, and the failed ones
+        self.verifying = set()
+        self.failed = set()
         self.clock = None
-        self.recorded_at = None
+        self.write_speed = None
+        self.probing = False
+        self.indexing = False
+        self.write_rate = WriteRate()
+        # The files the write rate is the total of
+        self.rate_paths = []
 
         self.label = Gtk.Label.new(self.name)
         self.append(self.label)
 
         self.make_buttons()
 
+        self.status_label = Gtk.Label.new()
+        self.append(self.status_label)
+
+        self.filesink_removed_id = self.pipeline.connect('filesink-removed', self.on_filesink_removed)
+        self.verifier_ids = []
+        if self.pipeline.verifier is not None:
+            self.verifier_ids = [
+                self.pipeline.verifier.connect('progress', self.on_verify_progress),
+                self.pipeline.verifier.connect('verified', self.on_verified),
+            ]
+
+    @property
+    def pipeline(self):
+        return self.parent.app.pipeline
+
+    def on_removed(self):
+        self.forget_catalog()
+        self.pipeline.disconnect(self.filesink_removed_id)
+        for handler_id in self.verifier_ids:
+            self.pipeline.verifier.disconnect(handler_id)
+
     def make_buttons(self):
         self.mount_btn = Gtk.Button.new()
         self.mount_btn.set_label("Mount")
@@ -42,6 +88,9 @@ class Volume(Gtk.Box):
         self.record_btn.connect('clicked', self.on_record_btn_clicked)
         self.append(self.record_btn)
 
+        self.browse_btn = TakeBrowser()
+        self.append(self.browse_btn)
+
         self.on_changed()
 
     @property
@@ -62,7 +111,66 @@ class Volume(Gtk.Box):
 
     def on_changed(self):
         self.mount_btn.props.sensitive = self.mountable and not self.mounted
-        self.eject_btn.props.sensitive = self.mounted and self.ejectable
+        self.eject_btn.props.sensitive = (
+            self.mounted and self.ejectable and self.record_path is None and
+            len(self.finalizing) == 0 and len(self.verifying) == 0
+        )
+
+        if self.mounted and self.write_speed is None and not self.probing:
+            self.start_write_probe()
+        if self.mounted and self.browse_btn.catalog is None and not self.indexing:
+            self.start_reindex()
+        elif not self.mounted:
+            self.forget_catalog()
+
+    @property
+    def root(self):
+        return self.volume.get_mount().get_root().get_path()
+
+    def start_write_probe(self):
+        self.probing = True
+        try:
+            record_dir = make_record_dir(self.root)
+        except OSError as err:
+            logger.warning(f"Unable to create the recording directory on {self.name}: {err}")
+            self.probing = False
+            return
+
+        logger.debug(f"Probing the write speed of {self.name}")
+        probe_write_speed_async(record_dir, self.on_write_probe_done)
+
+    def start_reindex(self):
+        "Catches up with the takes recorded elsewhere or by an older version"
+        try:
+            record_dir = make_record_dir(self.root)
+        except OSError as err:
+            logger.warning(f"Unable to index the takes on {self.name}: {err}")
+            return
+
+        self.indexing = True
+        catalog_for(record_dir).reindex_async(lambda result: GLib.idle_add(self.on_reindexed, record_dir))
+
+    def forget_catalog(self):
+        "Drops the catalog of an unmounted volume, the next mount reindexes"
+        catalog = self.browse_btn.catalog
+        if catalog is not None:
+            drop_catalog(catalog.record_dir)
+            self.browse_btn.set_catalog(None)
+
+    def on_reindexed(self, record_dir):
+        self.indexing = False
+        if self.mounted:
+            self.browse_btn.set_catalog(catalog_for(record_dir))
+            self.browse_btn.refresh()
+        return False
+
+    def on_write_probe_done(self, speed):
+        self.probing = False
+        self.write_speed = speed
+        if speed is not None:
+            logger.info(f"{self.name} writes at {speed / pow(1024, 2):.1f} MiB/s")
+
+        return False
 
     def on_mount_callback(self, source_object, result, _):
         self.volume.mount_finish(result)
@@ -90,64 +198,168 @@ class Volume(Gtk.Box):
             self.remove_filesink()
             self.record_btn.set_icon_name(RECORD_ICON)
 
-    def on_time_callback(self):
-        if self.clock is not None and self.recorded_at is not None:
-            dt = datetime.datetime.now()
-            delta = dt - self.recorded_at
-            self.clock.set_time_in_seconds(int(delta.total_seconds()))
-
-        return True
-
-    def make_record_path(self, record_dir, ext="wv", attempts=23):
-        """
-        Returns the path of a file to point the filesink to. The file name
-        includes a timestamps to prevent collision, but if the file already exists, it
-        attempts to find unique file names a few times.
+    def on_tick(self, running_time):
+        if self.record_path is None or self.record_path not in self.pipeline.filesinks:
+            return
 
-        Returns None if no unique file name was available
-        """
-        now = datetime.datetime.now()
-        ts = now.strftime("%y%m%d-%H%M%S")
+        if self.clock is not None:
+            duration = self.pipeline.filesink_duration(self.record_path, running_time)
+            self.clock.set_time_in_seconds(None if duration is None else duration // Gst.SECOND)
+        if running_time >= 0:
+            self.update_estimates()
+
+    def update_estimates(self):
+        # Split takes write a file per channel, all to this volume
+        paths = [path for path in self.record_paths if path in self.pipeline.filesinks]
+        stats = [self.pipeline.filesink_stats(path) for path in paths]
+        if paths != self.rate_paths:
+            # The total jumps when a file comes or goes
+            self.rate_paths = paths
+            self.write_rate.reset()
+        self.write_rate.add(sum(s['bytes_written'] for s in stats))
+        rate = self.write_rate.rate
+        if rate is None or rate <= 0:
+            return
 
-        for attempt in range(attempts):
-            suffix = "" if attempt == 0 else "-{attempt}"
-            path = os.path.join(
-                record_dir,
-                f"elkr-{ts}{suffix}.{ext}"
-            )
+        try:
+            remaining = free_space(self.root) / rate
+        except OSError:
+            return
 
-            if not os.path.exists(path):
-                return path
+        warnings = []
+        if remaining < REMAINING_WARNING_S:
+            warnings.append("almost full")
+        if self.write_speed is not None and self.write_speed < rate * WRITE_SPEED_MARGIN:
+            warnings.append("too slow")
+        if max(s['fill_level'] for s in stats) >= FILL_LEVEL_WARNING:
+            warnings.append("falling behind")
+
+        hours, minutes = int(remaining // 3600), int(remaining % 3600) // 60
+        text = f"{hours}h{minutes:02}m left"
+        if len(warnings) > 0:
+            text = f"{text} - {', '.join(warnings)}"
+            self.status_label.set_markup(f'<span color="red" size="small">{text}</span>')
+        else:
+            self.status_label.set_markup(f'<span size="small">{text}</span>')
 
+    def make_record_path(self, record_dir, ext="wv", attempts=23, channels=None):
+        return make_record_path(record_dir, ext, attempts, channels, catalog=catalog_for(record_dir))
 
     def add_filesink(self):
         if not self.mounted:
             logger.error(f"Trying to record on an unmounted volume {self.name}")
             return
-        root = self.volume.get_mount().get_root().get_path()
-        record_dir = os.path.join(root, 'elk-recorder')
+        record_dir = make_record_dir(self.root)
 
-        if not os.path.exists(record_dir):
-            os.mkdir(record_dir)
+        channels = None
+        if self.pipeline.split_channels:
+            channels = self.pipeline.input_channels()
 
-        self.record_path = self.make_record_path(record_dir)
-        if self.record_path is None:
+        path = self.make_record_path(record_dir, FORMATS[self.pipeline.default_format]['ext'], channels=channels)
+        if path is None:
             logger.error(f"Unable to find a non existent file name in {record_dir}")
             return
 
-        self.parent.app.pipeline.add_filesink(self.record_path)
+        if channels is None:
+            self.pipeline.add_filesink(path)
+            self.record_paths = [path]
+        else:
+            paths = self.pipeline.add_split_filesinks(path)
+            if paths is None:
+                return
+            self.record_paths = list(paths.values())
+        # The clock and the estimates follow the first file of the take
+        self.record_path = self.record_paths[0]
         self.eject_btn.props.sensitive = False
-        self.recorded_at = datetime.datetime.now()
+        self.failed.clear()
 
         self.start_clock()
 
+    def resume(self, failed_path):
+        "Continues a recording that failed on another volume, or on this one"
+        try:
+            record_dir = make_record_dir(self.root)
+        except OSError as err:
+            logger.error(f"Unable to resume {failed_path} on {self.name}: {err}")
+            return
+
+        path = make_resume_path(record_dir, failed_path)
+        if path is None:
+            logger.error(f"Unable to find a non existent file name in {record_dir}")
+            return
+        if self.pipeline.resume_filesink(failed_path, path) is None:
+            return
+
+        logger.info(f"Recording {failed_path} resumed on {self.name}")
+        self.record_paths.append(path)
+        if self.record_path is None:
+            self.record_path = path
+            self.record_btn.set_icon_name(STOP_ICON)
+            self.eject_btn.props.sensitive = False
+            self.failed.clear()
+            self.start_clock()
+
+    def on_recording_failed(self, path):
+        "The file can't be written anymore, the recording resumes elsewhere"
+        logger.warning(f"Recording {path} failed on {self.name}")
+        self.record_paths.remove(path)
+        if path != self.record_path:
+            return
+
+        if len(self.record_paths) > 0:
+            self.record_path = self.record_paths[0]
+            return
+
+        self.record_path = None
+        self.record_btn.set_icon_name(RECORD_ICON)
+        self.write_rate.reset()
+        self.stop_clock()
+        self.status_label.set_markup('<span color="red" size="small">Write failed</span>')
+        self.on_changed()
+
     def remove_filesink(self):
-        self.parent.app.pipeline.remove_filesink(self.record_path)
-        self.eject_btn.props.sensitive = True
+        for path in self.record_paths:
+            self.pipeline.remove_filesink(path)
+        # The eject button is enabled back once the files are finalized
+        self.finalizing.update(self.record_paths)
         self.record_path = None
-        self.recorded_at = None
+        self.record_paths = []
+        self.write_rate.reset()
+        self.status_label.set_text('')
         self.stop_clock()
 
+    def on_filesink_removed(self, pipeline, path):
+        if path not in self.finalizing:
+            return
+
+        logger.debug(f"Recording {path} finalized on {self.name}")
+        self.finalizing.discard(path)
+        if self.pipeline.verifier is not None and self.pipeline.verifier.is_verifying(path):
+            # The eject button waits for the verification as well
+            self.verifying.add(path)
+        self.on_changed()
+
+    def on_verify_progress(self, verifier, path, fraction):
+        if path not in self.verifying or self.record_path is not None:
+            return
+        self.status_label.set_markup(f'<span size="small">Verifying {int(fraction * 100)}%</span>')
+
+    def on_verified(self, verifier, path, ok):
+        if path not in self.verifying:
+            return
+
+        self.verifying.discard(path)
+        if not ok:
+            self.failed.add(path)
+
+        if self.record_path is None:
+            if len(self.failed) > 0:
+                names = ', '.join(os.path.basename(p) for p in sorted(self.failed))
+                self.status_label.set_markup(f'<span color="red" size="small">Verification failed: {names}</span>')
+            elif len(self.verifying) == 0:
+                self.status_label.set_markup('<span size="small">Verified</span>')
+        self.on_changed()
+
     def start_clock(self):
         self.clock = Clock()
         self.clock.set_time_in_seconds()
@@ -16,6 +16,9 @@ class Volumes(Gtk.Box):
         self.app = app
         self.mon = Gio.VolumeMonitor.get()
         self.volumes = {}
+        # Failed recordings waiting for a volume to resume on, by path, with
+        # the uuid and the widget of the volume they were on
+        self.orphans = {}
 
         self.title_label = Gtk.Label.new()
         self.title_label.set_markup('<span size="small">Volumes</span>')
@@ -39,13 +42,12 @@ class Volumes(Gtk.Box):
         for vol in self.mon.get_volumes():
             self.on_volume_added(self.mon, vol)
 
-        GLib.timeout_add_seconds(1, self.on_time_callback)
+        self.app.ticker.connect('tick', self.on_tick)
+        self.app.pipeline.connect('filesink-failed', self.on_filesink_failed)
 
-    def on_time_callback(self):
+    def on_tick(self, ticker, running_time):
         for _, volume in self.volumes.items():
-            volume['widget'].on_time_callback()
-
-        return True
+            volume['widget'].on_tick(running_time)
 
     def on_volume_added(self, _, vol):
         logger.debug(f"Volume added: {vol.get_name()}")
@@ -60,19 +62,69 @@ class Volumes(Gtk.Box):
         self.no_volumes_label.hide()
 
         self.append(widget)
+        self.resume_orphans()
 
     def on_volume_changed(self, _, vol):
         logger.debug(f"Volume changed: {vol.get_name()}")
         uuid = vol.get_identifier('uuid')
         if uuid in self.volumes:
             self.volumes[uuid]['widget'].on_changed()
+        self.resume_orphans()
 
     def on_volume_removed(self, _, vol):
         logger.debug(f"Volume removed: {vol.get_name()}")
         uuid = vol.get_identifier('uuid')
         if uuid in self.volumes:
+            widget = self.volumes[uuid]['widget']
+            # Don't wait for the writes to fail, the audio goes to the
+            # spill until the recording resumes on another volume
+            for path in widget.record_paths:
+                self.orphans[path] = (uuid, widget)
+                self.app.pipeline.fail_filesink(path)
+            widget.on_removed()
             self.remove(self.volumes[uuid]['widget'])
             del self.volumes[uuid]
 
         if len(self.volumes) == 0:
             self.no_volumes_label.show()
+
+    def on_filesink_failed(self, pipeline, path):
+        for uuid, volume in self.volumes.items():
+            widget = volume['widget']
+            if path in widget.record_paths:
+                self.orphans[path] = (uuid, widget)
+                widget.on_recording_failed(path)
+        if path in self.orphans:
+            self.resume_orphans()
+
+    def resume_target(self, owner):
+        """
+        Another idle mounted volume, or the failed one once it was plugged
+        back, rather than the one still failing
+        """
+        owner_uuid, owner_widget = owner
+        candidates = [
+            (uuid, volume['widget']) for uuid, volume in self.volumes.items()
+            if volume['widget'].mounted and volume['widget'].record_path is None
+        ]
+        for uuid, widget in candidates:
+            if uuid != owner_uuid:
+                return widget
+        for uuid, widget in candidates:
+            if widget is not owner_widget:
+                return widget
+        return None
+
+    def resume_orphans(self):
+        owners = {}
+        for path, owner in self.orphans.items():
+            owners.setdefault(owner, []).append(path)
+
+        for owner, paths in owners.items():
+            widget = self.resume_target(owner)
+            if widget is None:
+                logger.warning(f"No volume to resume {len(paths)} failed recordings on")
+                continue
+            for path in sorted(paths):
+                del self.orphans[path]
+                widget.resume(path)
@@ -0,0 +1,183 @@
+import os, shutil, logging, subprocess, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import gi
+from gi.repository import GLib, GObject
+
+from .segments import finalizer, fsync_path, sha256_file
+from .encoder import FORMAT_WAVPACK, FORMAT_FLAC
+
+logger = logging.getLogger(__name__)
+
+# Few low priority workers, the live encoders must keep their cores
+VERIFY_WORKERS = max(1, (os.cpu_count() or 1) // 4)
+VERIFY_NICE = 19
+CHECKSUM_SUFFIX = '.sha256'
+
+# Decoders checking the integrity of a file: the WavPack block CRCs and the
+# FLAC frame CRCs. The WavPack encoders are shared by the takes and never see
+# the end of one, so the WavPack files carry no MD5 to check
+DECODERS = {
+    FORMAT_WAVPACK: ['wvunpack', '-vq'],
+    FORMAT_FLAC: ['flac', '-t', '-s'],
+}
+
+
+def checksum_path(path):
+    root, _ = os.path.splitext(path)
+    return f"{root}{CHECKSUM_SUFFIX}"
+
+
+def init_worker():
+    os.nice(VERIFY_NICE)
+
+
+def verify_file(path, format, sha256=None):
+    """
+    Runs in a worker process: reads a recorded file back from the storage,
+    compares its hash with the sha256 computed when it was finalized, and
+    decodes it when there is a decoder for its format. Returns the outcome
+    as a dict.
+    """
+    result = {'file': os.path.basename(path), 'sha256': sha256, 'decoded': None, 'error': None}
+
+    try:
+        # The file was synced, drop it from the page cache so it is read
+        # from the storage
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+        digest = sha256_file(path)
+    except OSError as err:
+        result['error'] = str(err)
+        return result
+
+    if sha256 is None:
+        result['sha256'] = digest
+    elif digest != sha256:
+        result['error'] = f"read back with sha256 {digest} instead of {sha256}"
+        return result
+
+    decoder = DECODERS.get(format)
+    if decoder is None or shutil.which(decoder[0]) is None:
+        return result
+
+    proc = subprocess.run(decoder + [path], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    result['decoded'] = proc.returncode == 0
+    if proc.returncode != 0:
+        result['error'] = proc.stderr.strip() or f"{decoder[0]} exited with {proc.returncode}"
+    return result
+
+
+def write_checksums(path, results):
+    "Writes the checksums of a take in the sha256sum format, next to it"
+    sidecar = checksum_path(path)
+    tmp = f"{sidecar}.tmp"
+    with open(tmp, 'w') as f:
+        for result in results:
+            f.write(f"{result['sha256']}  {result['file']}\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, sidecar)
+    fsync_path(os.path.dirname(sidecar) or '.')
+
+
+class Verifier(GObject.Object):
+    @GObject.Signal(name='progress', flags=GObject.SignalFlags.RUN_LAST,
+                    arg_types=(str, float),
+                    return_type=None)
+    def progress(self, *args):
+        pass
+
+    @GObject.Signal(name='verified', flags=GObject.SignalFlags.RUN_LAST,
+                    arg_types=(str, bool),
+                    return_type=None)
+    def verified(self, *args):
+        pass
+
+    def __init__(self, workers=VERIFY_WORKERS):
+        """
+        Checks the takes once they are finalized, in a small pool of low
+        priority processes so hashing and decoding don't compete with the
+        live pipeline for the GIL. 'progress' is emitted as the files of a
+        take get checked, then 'verified' once its checksums are written.
+        """
+        super().__init__()
+
+        self.workers = workers
+        self.executor = None
+        self.takes = {}
+
+    def verify(self, path, files, format, checksums=None):
+        """
+        Verifies the files of the take recorded to path, against their
+        sha256 by file name when given
+        """
+        if len(files) == 0:
+            logger.warning(f"Nothing to verify for {path}")
+            self.emit('verified', path, False)
+            return
+
+        if self.executor is None:
+            # Don't fork the threads of the running pipeline
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker
+            )
+
+        logger.debug(f"Verifying {len(files)} files of {path}")
+        take = {'total': len(files), 'results': []}
+        self.takes[path] = take
+        self.emit('progress', path, 0.0)
+
+        for filename in files:
+            sha256 = (checksums or {}).get(os.path.basename(filename))
+            future = self.executor.submit(verify_file, filename, format, sha256)
+            future.add_done_callback(
+                lambda future: GLib.idle_add(self.on_file_verified, path, future)
+            )
+
+    def is_verifying(self, path):
+        return path in self.takes
+
+    def on_file_verified(self, path, future):
+        take = self.takes[path]
+        try:
+            result = future.result()
+        except Exception as err:
+            result = {'file': None, 'sha256': None, 'decoded': None, 'error': str(err)}
+        if result['error'] is not None:
+            logger.error(f"Verification of {result['file']} failed: {result['error']}")
+
+        take['results'].append(result)
+        self.emit('progress', path, len(take['results']) / take['total'])
+
+        if len(take['results']) == take['total']:
+            results = sorted(take['results'], key=lambda r: r['file'] or '')
+            ok = all(r['error'] is None for r in results)
+            finalizer.submit(self.finish, path, results, ok)
+
+        return GLib.SOURCE_REMOVE
+
+    def finish(self, path, results, ok):
+        try:
+            write_checksums(path, [r for r in results if r['sha256'] is not None])
+        except OSError as err:
+            logger.error(f"Unable to write the checksums of {path}: {err}")
+            ok = False
+
+        GLib.idle_add(self.on_take_verified, path, ok)
+
+    def on_take_verified(self, path, ok):
+        del self.takes[path]
+        logger.info(f"Verification of {path} {'passed' if ok else 'failed'}")
+        self.emit('verified', path, ok)
+        return GLib.SOURCE_REMOVE
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
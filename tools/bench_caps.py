@@ -0,0 +1,158 @@
+#! /usr/bin/python3
+"""
+Measures what the capture format costs between the source and the encoder.
+
+Runs the real elkr Pipeline with an audiotestsrc in a few configurations:
+
+- passthrough: the source format is accepted as is, audioconvert is bypassed
+- convert-idle: same format, but audioconvert is kept in the path
+- convert: a format the encoder doesn't take, converted for every buffer
+
+Each configuration runs in its own process. The buffers reaching the wavpack
+encoder are compared with the ones leaving the source: a buffer whose memory
+was not produced by the source has been copied on the way. CPU time is
+reported per second of audio. The results are printed as JSON.
+"""
+
+import os, re, sys, json, time, argparse, subprocess
+from collections import deque
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLES_PER_BUFFER = 1024
+# Number of source buffers remembered when looking for copies
+RECENT_BUFFERS = 256
+
+CONFIGS = {
+    'passthrough': {'format': 'S32LE', 'passthrough': True},
+    'convert-idle': {'format': 'S32LE', 'passthrough': False},
+    'convert': {'format': 'F32LE', 'passthrough': True},
+}
+
+
+def memory_address(buf):
+    "The address of the first memory of a buffer, from its GI representation"
+    match = re.search(r'at (0x[0-9a-f]+)\)', repr(buf.peek_memory(0)))
+    return match.group(1) if match else None
+
+
+def run_config(name, config, rate, channels, duration):
+    import gi
+    gi.require_version('GLib', '2.0')
+    gi.require_version('GObject', '2.0')
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst, GLib
+
+    sys.path.insert(0, ROOT)
+    from src.elkr.pipeline import Pipeline
+
+    Gst.init(None)
+
+    num_buffers = int(duration * rate / SAMPLES_PER_BUFFER)
+    audio_duration = num_buffers * SAMPLES_PER_BUFFER / rate
+
+    pipeline = Pipeline(encoder_mode=1, encoder_md5=False, metrics=False, passthrough=config['passthrough'])
+
+    src = Gst.ElementFactory.make('audiotestsrc', None)
+    src.props.wave = 'pink-noise'
+    src.props.is_live = False
+    src.props.num_buffers = num_buffers
+    src.props.samplesperbuffer = SAMPLES_PER_BUFFER
+    caps = Gst.Caps.from_string(
+        f"audio/x-raw,format={config['format']},rate={rate},channels={channels},layout=interleaved"
+    )
+    pipeline.select_source(src, 'audiotestsrc', caps)
+
+    recent = deque(maxlen=RECENT_BUFFERS)
+    counts = {'buffers': 0, 'copies': 0}
+
+    def on_source_buffer(pad, info):
+        recent.append(memory_address(info.get_buffer()))
+        return Gst.PadProbeReturn.OK
+
+    def on_encoder_buffer(pad, info):
+        counts['buffers'] += 1
+        if memory_address(info.get_buffer()) not in recent:
+            counts['copies'] += 1
+        return Gst.PadProbeReturn.OK
+
+    src.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, on_source_buffer)
+    pipeline['encoder'].get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, on_encoder_buffer)
+
+    loop = GLib.MainLoop()
+    errors = []
+
+    def on_message(bus, message):
+        if message.type == Gst.MessageType.EOS:
+            loop.quit()
+        elif message.type == Gst.MessageType.ERROR:
+            err, _ = message.parse_error()
+            errors.append(err.message)
+            loop.quit()
+
+    pipeline.bus.connect('message', on_message)
+
+    cpu_before = time.process_time()
+    started_at = time.monotonic()
+    pipeline.start()
+    loop.run()
+    elapsed = time.monotonic() - started_at
+    cpu = time.process_time() - cpu_before
+    pipeline.stop()
+
+    return {
+        'config': name,
+        'format': config['format'],
+        'audioconvert_bypassed': pipeline.inputs[0]['bypass_convert'],
+        'errors': errors,
+        'audio_duration_s': audio_duration,
+        'wall_time_s': elapsed,
+        'cpu_s_per_audio_s': cpu / audio_duration,
+        'buffers': counts['buffers'],
+        'copied_buffers': counts['copies'],
+        'copies_per_buffer': counts['copies'] / counts['buffers'] if counts['buffers'] else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--configs', nargs='+', choices=list(CONFIGS), default=list(CONFIGS))
+    parser.add_argument('--rate', type=int, default=48000)
+    parser.add_argument('--channels', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=60.0,
+                        help="Seconds of audio processed by each run")
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        result = run_config(args.run, CONFIGS[args.run], args.rate, args.channels, args.duration)
+        json.dump(result, sys.stdout)
+        return
+
+    runs = []
+    for name in args.configs:
+        print(f"Running {name}", file=sys.stderr)
+        proc = subprocess.run(
+            [sys.executable, __file__, '--run', name, '--rate', str(args.rate),
+             '--channels', str(args.channels), '--duration', str(args.duration)],
+            stdout=subprocess.PIPE, text=True
+        )
+        if proc.returncode != 0:
+            runs.append({'config': name, 'errors': [f"exit code {proc.returncode}"]})
+        else:
+            runs.append(json.loads(proc.stdout))
+
+    report = {'runs': runs}
+    baseline = next((r for r in runs if r['config'] == 'convert' and not r['errors']), None)
+    if baseline is not None:
+        report['cpu_saved_s_per_audio_s'] = {
+            r['config']: baseline['cpu_s_per_audio_s'] - r['cpu_s_per_audio_s']
+            for r in runs if not r['errors']
+        }
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
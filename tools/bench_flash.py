@@ -0,0 +1,234 @@
+#! /usr/bin/python3
+"""
+Compares the flash write strategy with the plain filesink on a FAT volume.
+
+Each strategy records the same audio to a fresh loop mounted vfat image,
+mounted with the options udisks uses for removable FAT media, or to --dir
+when given. The real elkr Pipeline is fed by a non live audiotestsrc as
+fast as it can go, recording --files concurrent files so their allocations
+interleave as they do with several takes on a card. Every run happens in
+its own process and reports:
+
+- the sustained throughput, the bytes written over the time from the start
+  to the last file being finalized
+- the time between buffers leaving the sink queues: the queues stay full,
+  so it is the time the sink took to write each buffer, given as
+  percentiles to show the tail latency
+- the number of extents of each file, when filefrag is available
+
+Creating the image requires root and mkfs.vfat. The results are printed as
+JSON.
+"""
+
+import os, sys, json, time, shutil, argparse, tempfile, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STRATEGIES = ('filesink', 'flash')
+SAMPLES_PER_BUFFER = 1024
+PERCENTILES = (50, 90, 99, 99.9)
+# What udisks mounts removable vfat volumes with
+MOUNT_OPTIONS = 'flush,uid=0,gid=0,shortname=mixed,utf8=1'
+
+
+def percentile(values, p):
+    "Nearest rank percentile of sorted values"
+    if len(values) == 0:
+        return None
+    rank = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[rank]
+
+
+def extents(path):
+    "Number of extents of a file according to filefrag, or None"
+    try:
+        proc = subprocess.run(['filefrag', path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return None
+    if proc.returncode != 0:
+        return None
+    # "<path>: N extents found"
+    try:
+        return int(proc.stdout.rsplit(':', 1)[1].split()[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def run_config(strategy, args, out_dir):
+    import gi
+    gi.require_version('GLib', '2.0')
+    gi.require_version('GObject', '2.0')
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst, GLib
+
+    sys.path.insert(0, ROOT)
+    from src.elkr.pipeline import Pipeline
+    from src.elkr.encoder import FORMATS
+    from src.elkr.segments import MANIFEST_SUFFIX
+
+    Gst.init(None)
+
+    pipeline = Pipeline(
+        encoder_mode=1, metrics=False, verify=False, default_format=args.format,
+        segment_duration_s=args.segment_duration, fsync_interval_s=args.fsync_interval,
+        write_strategy=strategy, write_batch_bytes=args.batch, preallocate_bytes=args.preallocate,
+        direct_io=args.direct_io, fadvise=args.fadvise
+    )
+
+    src = Gst.ElementFactory.make('audiotestsrc', None)
+    src.props.wave = 'silence'
+    src.props.is_live = False
+    src.props.samplesperbuffer = SAMPLES_PER_BUFFER
+    src.props.num_buffers = int(args.duration * args.rate / SAMPLES_PER_BUFFER)
+    caps = Gst.Caps.from_string(f"audio/x-raw,format=S32LE,rate={args.rate},channels={args.channels}")
+    pipeline.select_source(src, 'audiotestsrc', caps)
+
+    ext = FORMATS[args.format]['ext']
+    paths = [os.path.join(out_dir, f"{strategy}-{n}.{ext}") for n in range(args.files)]
+    loop = GLib.MainLoop()
+    errors = []
+    pending = set(paths)
+    departures = {path: [] for path in paths}
+    stats = {}
+
+    def on_departure(pad, info, times):
+        times.append(time.monotonic())
+        return Gst.PadProbeReturn.OK
+
+    def on_message(bus, message):
+        if message.type == Gst.MessageType.EOS:
+            for path in paths:
+                stats[path] = pipeline.filesink_stats(path)
+            pipeline.stop()
+            for path in paths:
+                pipeline.remove_filesink(path)
+        elif message.type == Gst.MessageType.ERROR:
+            err, _ = message.parse_error()
+            errors.append(err.message)
+            loop.quit()
+
+    def on_removed(_, path):
+        pending.discard(path)
+        if len(pending) == 0:
+            loop.quit()
+
+    pipeline.bus.connect('message', on_message)
+    pipeline.connect('filesink-removed', on_removed)
+
+    for path in paths:
+        h = pipeline.add_filesink(path)
+        h['queue'].get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, on_departure, departures[path])
+
+    started_at = time.monotonic()
+    pipeline.start()
+    loop.run()
+    wall_s = time.monotonic() - started_at
+
+    files = []
+    written = 0
+    intervals = []
+    for path in paths:
+        times = departures[path]
+        intervals.extend((b - a) * 1000 for a, b in zip(times, times[1:]))
+        stem = os.path.splitext(os.path.basename(path))[0]
+        names = [n for n in os.listdir(out_dir) if n.startswith(stem) and not n.endswith(MANIFEST_SUFFIX)]
+        for name in sorted(names):
+            file = os.path.join(out_dir, name)
+            size = os.path.getsize(file)
+            written += size
+            files.append({'file': name, 'bytes': size, 'extents': extents(file)})
+    intervals.sort()
+    write_interval_ms = {f"p{p}": percentile(intervals, p) for p in PERCENTILES}
+    write_interval_ms['max'] = intervals[-1] if len(intervals) > 0 else None
+
+    return {
+        'strategy': strategy,
+        'errors': errors,
+        'wall_s': wall_s,
+        'bytes_written': written,
+        'throughput_mib_s': written / wall_s / pow(1024, 2),
+        'write_interval_ms': write_interval_ms,
+        'flash': {path: stats[path]['flash'] for path in paths if path in stats},
+        'files': files,
+    }
+
+
+def make_volume(args):
+    "Creates and loop mounts a fresh vfat image, returns (mount point, image)"
+    image = tempfile.NamedTemporaryFile(prefix='elkr-flash-', suffix='.img', dir=args.image_dir, delete=False)
+    image.truncate(args.image_size * pow(1024, 2))
+    image.close()
+    subprocess.run(['mkfs.vfat', '-F', '32', image.name], check=True, stdout=subprocess.DEVNULL)
+    mount_point = tempfile.mkdtemp(prefix='elkr-flash-')
+    subprocess.run(['mount', '-o', f"loop,{args.mount_options}", image.name, mount_point], check=True)
+    return mount_point, image.name
+
+
+def remove_volume(mount_point, image):
+    subprocess.run(['umount', mount_point], check=False)
+    os.rmdir(mount_point)
+    os.unlink(image)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=int, default=192000)
+    parser.add_argument('--channels', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=60.0, help="Seconds of audio recorded")
+    parser.add_argument('--format', default='wav')
+    parser.add_argument('--files', type=int, default=2, help="Files recorded concurrently")
+    parser.add_argument('--segment-duration', type=float, default=0)
+    parser.add_argument('--fsync-interval', type=int, default=5)
+    parser.add_argument('--batch', type=int, default=0, metavar='BYTES')
+    parser.add_argument('--preallocate', type=int, default=64 * pow(1024, 2), metavar='BYTES')
+    parser.add_argument('--direct-io', action='store_true')
+    parser.add_argument('--fadvise', action='store_true')
+    parser.add_argument('--dir', default=None, help="Record there instead of to a loop mounted image")
+    parser.add_argument('--image-dir', default='/var/tmp', help="Where the vfat images are created")
+    parser.add_argument('--image-size', type=int, default=4096, metavar='MIB')
+    parser.add_argument('--mount-options', default=MOUNT_OPTIONS)
+    parser.add_argument('--run', choices=STRATEGIES, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--out', default=None, help=argparse.SUPPRESS)
+    args, _ = parser.parse_known_args()
+
+    if args.run is not None:
+        result = run_config(args.run, args, args.out)
+        json.dump(result, sys.stdout)
+        return
+
+    runs = {}
+    for strategy in STRATEGIES:
+        print(f"Running {strategy}", file=sys.stderr)
+        if args.dir is None:
+            mount_point, image = make_volume(args)
+            out_dir = mount_point
+        else:
+            out_dir = tempfile.mkdtemp(prefix='elkr-flash-', dir=args.dir)
+        try:
+            proc = subprocess.run(
+                [sys.executable, __file__, '--run', strategy, '--out', out_dir] + sys.argv[1:],
+                stdout=subprocess.PIPE, text=True
+            )
+        finally:
+            if args.dir is None:
+                remove_volume(mount_point, image)
+            else:
+                shutil.rmtree(out_dir)
+        if proc.returncode != 0:
+            runs[strategy] = {'errors': [f"exit code {proc.returncode}"]}
+        else:
+            runs[strategy] = json.loads(proc.stdout)
+
+    report = {
+        'meta': {key: getattr(args, key) for key in ('rate', 'channels', 'duration', 'format', 'files',
+                                                     'segment_duration', 'fsync_interval', 'batch',
+                                                     'preallocate', 'direct_io', 'fadvise', 'dir',
+                                                     'mount_options')},
+        'runs': runs,
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
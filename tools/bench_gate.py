@@ -0,0 +1,153 @@
+#! /usr/bin/python3
+"""
+Compares what a level gated recording writes with an always-on one.
+
+Builds the real elkr Pipeline with a non live audiotestsrc producing bursts
+of pink noise separated by silence, its volume being driven by a controller
+so every run gets exactly the same audio. The same audio is recorded once
+always-on and once gated. Each run happens in its own process and reports
+the bytes written, the gaps indexed in the take manifest and the recorded
+duration. The results are printed as JSON.
+"""
+
+import os, sys, json, shutil, argparse, tempfile, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLES_PER_BUFFER = 480
+BURST_VOLUME = 0.5
+
+
+def run_config(gated, args, out_dir):
+    import gi
+    gi.require_version('GLib', '2.0')
+    gi.require_version('GObject', '2.0')
+    gi.require_version('Gst', '1.0')
+    gi.require_version('GstController', '1.0')
+    from gi.repository import Gst, GLib, GstController
+
+    sys.path.insert(0, ROOT)
+    from src.elkr.pipeline import Pipeline
+    from src.elkr.segments import manifest_path
+
+    Gst.init(None)
+
+    options = {}
+    if gated:
+        options = {
+            'gate_threshold_db': args.threshold,
+            'gate_attack_s': args.attack,
+            'gate_hangover_s': args.hangover,
+            'gate_preroll_s': args.preroll,
+        }
+    pipeline = Pipeline(encoder_mode=1, metrics=False, verify=False, segment_duration_s=0,
+                        fsync_interval_s=0, **options)
+
+    num_buffers = int(args.duration * args.rate / SAMPLES_PER_BUFFER)
+    src = Gst.ElementFactory.make('audiotestsrc', None)
+    src.props.wave = 'pink-noise'
+    src.props.is_live = False
+    src.props.num_buffers = num_buffers
+    src.props.samplesperbuffer = SAMPLES_PER_BUFFER
+
+    # A burst starts every period, the rest of it is silent
+    control = GstController.InterpolationControlSource()
+    control.props.mode = GstController.InterpolationMode.NONE
+    src.add_control_binding(GstController.DirectControlBinding.new_absolute(src, 'volume', control))
+    t = 0.0
+    while t < args.duration:
+        control.set(int(t * Gst.SECOND), BURST_VOLUME)
+        control.set(int((t + args.burst) * Gst.SECOND), 0.0)
+        t += args.period
+
+    caps = Gst.Caps.from_string(f"audio/x-raw,format=S32LE,rate={args.rate},channels={args.channels}")
+    pipeline.select_source(src, 'audiotestsrc', caps)
+
+    path = os.path.join(out_dir, f"{'gated' if gated else 'always-on'}.wv")
+    loop = GLib.MainLoop()
+    errors = []
+    gate = {}
+
+    def on_message(bus, message):
+        if message.type == Gst.MessageType.EOS:
+            # Everything reached the file, it is finalized once stopped
+            gate['stats'] = pipeline.gate_stats()
+            pipeline.stop()
+            pipeline.remove_filesink(path)
+        elif message.type == Gst.MessageType.ERROR:
+            err, _ = message.parse_error()
+            errors.append(err.message)
+            loop.quit()
+
+    pipeline.bus.connect('message', on_message)
+    pipeline.connect('filesink-removed', lambda *_: loop.quit())
+
+    pipeline.add_filesink(path)
+    pipeline.start()
+    loop.run()
+
+    with open(manifest_path(path)) as f:
+        manifest = json.load(f)
+    gaps = manifest.get('gaps', [])
+    skipped = sum(gap['duration_s'] for gap in gaps)
+
+    return {
+        'gated': gated,
+        'errors': errors,
+        'bytes_written': sum(s['bytes'] for s in manifest['segments']),
+        'gaps': len(gaps),
+        'recorded_s': args.duration - skipped,
+        'gate': gate.get('stats'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=int, default=48000)
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=600.0, help="Seconds of audio recorded")
+    parser.add_argument('--period', type=float, default=60.0, help="Seconds between two bursts")
+    parser.add_argument('--burst', type=float, default=5.0, help="Seconds of a burst")
+    parser.add_argument('--threshold', type=float, default=-40.0, metavar='DB')
+    parser.add_argument('--attack', type=float, default=0.1)
+    parser.add_argument('--hangover', type=float, default=5.0)
+    parser.add_argument('--preroll', type=float, default=1.0)
+    parser.add_argument('--dir', default='/dev/shm')
+    parser.add_argument('--run', choices=['gated', 'always-on'], default=None, help=argparse.SUPPRESS)
+    args, _ = parser.parse_known_args()
+
+    if args.run is not None:
+        out_dir = tempfile.mkdtemp(prefix='elkr-gate-', dir=args.dir)
+        try:
+            result = run_config(args.run == 'gated', args, out_dir)
+        finally:
+            shutil.rmtree(out_dir)
+        json.dump(result, sys.stdout)
+        return
+
+    runs = {}
+    for name in ('always-on', 'gated'):
+        print(f"Running {name}", file=sys.stderr)
+        proc = subprocess.run(
+            [sys.executable, __file__, '--run', name] + sys.argv[1:],
+            stdout=subprocess.PIPE, text=True
+        )
+        if proc.returncode != 0:
+            runs[name] = {'errors': [f"exit code {proc.returncode}"]}
+        else:
+            runs[name] = json.loads(proc.stdout)
+
+    report = {
+        'meta': {key: getattr(args, key) for key in ('rate', 'channels', 'duration', 'period', 'burst',
+                                                     'threshold', 'attack', 'hangover', 'preroll')},
+        'runs': runs,
+    }
+    if not runs['always-on']['errors'] and not runs['gated']['errors']:
+        report['bytes_ratio'] = runs['gated']['bytes_written'] / runs['always-on']['bytes_written']
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
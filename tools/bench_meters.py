@@ -0,0 +1,143 @@
+#! /usr/bin/python3
+"""
+Measures the CPU the level meters cost the main thread, without a display.
+
+Simulated level messages for --channels channels arrive every --interval
+ms for --duration seconds of audio. The levels random walk per channel,
+with --silent channels dead and the occasional clip. They are handled
+as fast as possible in two ways:
+
+- naive: every message is turned into bars and the meters are redrawn
+- coalesced: the messages are coalesced the way the pipeline does it,
+  keeping the loudest values, and read --fps times per second by the
+  meters, which are only redrawn when a bar moved by a pixel or a clip
+  indicator changed, as the Meters widget does
+
+The drawing is the one of the Meters widget, done on a cairo.ImageSurface
+of --width by --height pixels. The report gives the CPU time spent per
+second of audio, which is the main thread load the meters would add, and
+the number of redraws. GTK itself isn't measured. The results are printed
+as JSON.
+"""
+
+import os, sys, json, time, random, argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = ('naive', 'coalesced')
+
+
+class LevelSource:
+    def __init__(self, channels, silent, seed):
+        "Random walking levels in dB, the same for every mode"
+        self.random = random.Random(seed)
+        self.silent = set(range(channels - silent, channels))
+        self.rms = [-30.0] * channels
+
+    def message(self):
+        peak, rms = [], []
+        for channel, level in enumerate(self.rms):
+            if channel in self.silent:
+                peak.append(-120.0)
+                rms.append(-120.0)
+                continue
+            level = min(-3.0, max(-60.0, level + self.random.uniform(-3.0, 3.0)))
+            self.rms[channel] = level
+            rms.append(level)
+            peak.append(0.0 if self.random.random() < 0.001 else level + self.random.uniform(0.0, 9.0))
+        return {'peak': peak, 'rms': rms}
+
+
+def run(mode, args):
+    import gi
+    gi.require_version('Gtk', '4.0')
+    import cairo
+
+    sys.path.insert(0, ROOT)
+    from src.elkr.ui.meters import meter_bars, hold_clips, decay_clips, draw_meters
+
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, args.width, args.height)
+    source = LevelSource(args.channels, args.silent, args.seed)
+    messages = int(args.duration * 1000 / args.interval)
+    frame_ms = 1000 / args.fps
+
+    bars, clips = [], []
+    pending = None
+    next_frame_ms = frame_ms
+    draws = 0
+
+    def draw():
+        cr = cairo.Context(surface)
+        draw_meters(cr, args.width, args.height, bars, clips)
+        surface.flush()
+
+    started_at = time.process_time()
+    for n in range(messages):
+        levels = source.message()
+
+        if mode == 'naive':
+            bars = meter_bars(levels, args.width)
+            clips = hold_clips(levels['peak'], clips)
+            draw()
+            draws += 1
+            continue
+
+        # What Pipeline.on_level does
+        if pending is None:
+            pending = levels
+        else:
+            pending['peak'] = [max(a, b) for a, b in zip(pending['peak'], levels['peak'])]
+            pending['rms'] = [max(a, b) for a, b in zip(pending['rms'], levels['rms'])]
+
+        now_ms = (n + 1) * args.interval
+        while now_ms >= next_frame_ms:
+            next_frame_ms += frame_ms
+            # What Meters.on_frame does
+            if pending is None:
+                new_bars = bars
+                new_clips = decay_clips(clips)
+            else:
+                new_bars = meter_bars(pending, args.width)
+                new_clips = hold_clips(pending['peak'], clips)
+            pending = None
+            clips_changed = [c > 0 for c in new_clips] != [c > 0 for c in clips]
+            clips = new_clips
+            if new_bars != bars or clips_changed:
+                bars = new_bars
+                draw()
+                draws += 1
+    cpu_s = time.process_time() - started_at
+
+    return {
+        'mode': mode,
+        'messages': messages,
+        'draws': draws,
+        'cpu_s': cpu_s,
+        'cpu_ms_per_s': cpu_s * 1000 / args.duration,
+        'main_thread_load': cpu_s / args.duration,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', type=int, default=32)
+    parser.add_argument('--silent', type=int, default=4, help="Dead channels")
+    parser.add_argument('--interval', type=float, default=10.0, help="Level message interval in ms")
+    parser.add_argument('--fps', type=int, default=60, help="Frame rate of the coalesced meters")
+    parser.add_argument('--duration', type=float, default=60.0, help="Seconds of audio simulated")
+    parser.add_argument('--width', type=int, default=600)
+    parser.add_argument('--height', type=int, default=48)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    report = {
+        'meta': {key: getattr(args, key) for key in ('channels', 'silent', 'interval', 'fps', 'duration',
+                                                     'width', 'height', 'seed')},
+        'runs': {mode: run(mode, args) for mode in MODES},
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
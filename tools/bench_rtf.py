@@ -0,0 +1,199 @@
+#! /usr/bin/python3
+"""
+Real-time factor benchmark of the recording pipeline.
+
+Builds the real elkr Pipeline with an audiotestsrc feeding 'src-caps' and
+sweeps sample rate, channel count, wavpack mode, md5 and the number of
+filesinks on tmpfs and on disk. Each configuration runs in its own process so
+peak RSS is measured per run. The results are written as JSON, meant to be
+diffed between releases.
+
+The real-time factor is the processing time divided by the duration of the
+encoded audio: the pipeline keeps up as long as it stays below 1.
+"""
+
+import os, sys, json, time, shutil, argparse, platform, resource, tempfile, itertools, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLES_PER_BUFFER = 1024
+SAMPLE_INTERVAL_MS = 10
+
+
+def thread_cpu_times():
+    "Returns the user+system CPU seconds of each thread of this process, by thread name"
+    ticks = os.sysconf('SC_CLK_TCK')
+    times = {}
+    for tid in os.listdir('/proc/self/task'):
+        try:
+            with open(f"/proc/self/task/{tid}/stat") as f:
+                stat = f.read()
+        except FileNotFoundError:
+            continue
+        # The thread name is between parentheses and may contain spaces
+        name = stat[stat.index('(') + 1:stat.rindex(')')]
+        fields = stat[stat.rindex(')') + 2:].split()
+        cpu = (int(fields[11]) + int(fields[12])) / ticks
+        times[f"{name}/{tid}"] = cpu
+    return times
+
+
+def run_config(config):
+    import gi
+    gi.require_version('GLib', '2.0')
+    gi.require_version('GObject', '2.0')
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst, GLib
+
+    sys.path.insert(0, ROOT)
+    from src.elkr.pipeline import Pipeline
+
+    Gst.init(None)
+
+    num_buffers = int(config['duration'] * config['rate'] / SAMPLES_PER_BUFFER)
+    audio_duration = num_buffers * SAMPLES_PER_BUFFER / config['rate']
+
+    pipeline = Pipeline(encoder_mode=config['mode'], encoder_md5=config['md5'])
+    pipeline['blackhole'].props.sync = False
+
+    src = Gst.ElementFactory.make('audiotestsrc', None)
+    src.props.wave = 'pink-noise'
+    src.props.is_live = False
+    src.props.num_buffers = num_buffers
+    src.props.samplesperbuffer = SAMPLES_PER_BUFFER
+    caps = Gst.Caps.from_string(
+        f"audio/x-raw,format={config['format']},rate={config['rate']},"
+        f"channels={config['channels']},layout=interleaved"
+    )
+    pipeline.select_source(src, 'audiotestsrc', caps)
+
+    out_dir = tempfile.mkdtemp(prefix='elkr-bench-', dir=config['target_dir'])
+    for idx in range(config['sinks']):
+        pipeline.add_filesink(os.path.join(out_dir, f"bench-{idx}.wv"))
+
+    queues = {'input-queue': pipeline['input-queue']}
+    for path, h in pipeline.filesinks.items():
+        queues[os.path.basename(path)] = h['queue']
+    high_water = {name: 0 for name in queues}
+
+    def sample_queues():
+        for name, queue in queues.items():
+            high_water[name] = max(high_water[name], queue.props.current_level_bytes)
+        return GLib.SOURCE_CONTINUE
+
+    loop = GLib.MainLoop()
+    errors = []
+
+    def on_message(bus, message):
+        if message.type == Gst.MessageType.EOS:
+            loop.quit()
+        elif message.type == Gst.MessageType.ERROR:
+            err, _ = message.parse_error()
+            errors.append(err.message)
+            loop.quit()
+
+    pipeline.bus.connect('message', on_message)
+    GLib.timeout_add(SAMPLE_INTERVAL_MS, sample_queues)
+
+    cpu_before = thread_cpu_times()
+    started_at = time.monotonic()
+    pipeline.start()
+    loop.run()
+    elapsed = time.monotonic() - started_at
+    cpu_after = thread_cpu_times()
+
+    pipeline.stop()
+
+    written = sum(os.path.getsize(os.path.join(out_dir, f)) for f in os.listdir(out_dir))
+    shutil.rmtree(out_dir)
+
+    return {
+        'config': config,
+        'errors': errors,
+        'audio_duration_s': audio_duration,
+        'wall_time_s': elapsed,
+        'rtf': elapsed / audio_duration,
+        'cpu_s_per_thread': {
+            name: cpu - cpu_before.get(name, 0)
+            for name, cpu in cpu_after.items()
+        },
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'queue_high_water_bytes': high_water,
+        'bytes_written': written,
+    }
+
+
+def make_configs(args):
+    targets = {'tmpfs': args.tmpfs_dir, 'disk': args.disk_dir}
+    for rate, channels, mode, md5, sinks, target in itertools.product(
+            args.rates, args.channels, args.modes, args.md5, args.sinks, args.targets):
+        yield {
+            'rate': rate,
+            'channels': channels,
+            'format': args.format,
+            'mode': mode,
+            'md5': md5 == 'on',
+            'sinks': sinks,
+            'target': target,
+            'target_dir': targets[target],
+            'duration': args.duration,
+        }
+
+
+def run_sweep(args):
+    runs = []
+    for config in make_configs(args):
+        print(f"Running {json.dumps(config)}", file=sys.stderr)
+        proc = subprocess.run(
+            [sys.executable, __file__, '--run', json.dumps(config)],
+            stdout=subprocess.PIPE, text=True
+        )
+        if proc.returncode != 0:
+            runs.append({'config': config, 'errors': [f"exit code {proc.returncode}"]})
+        else:
+            runs.append(json.loads(proc.stdout))
+
+    return {
+        'meta': {
+            'host': platform.node(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'runs': runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rates', type=int, nargs='+', default=[44100, 48000, 96000])
+    parser.add_argument('--channels', type=int, nargs='+', default=[2, 8])
+    parser.add_argument('--format', default='S32LE')
+    parser.add_argument('--modes', type=int, nargs='+', choices=[1, 2, 3, 4], default=[1, 2, 3, 4])
+    parser.add_argument('--md5', nargs='+', choices=['on', 'off'], default=['on', 'off'])
+    parser.add_argument('--sinks', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--targets', nargs='+', choices=['tmpfs', 'disk'], default=['tmpfs', 'disk'])
+    parser.add_argument('--tmpfs-dir', default='/dev/shm')
+    parser.add_argument('--disk-dir', default=tempfile.gettempdir())
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help="Seconds of audio encoded by each run")
+    parser.add_argument('--output', default=None, help="Write the JSON report to this file")
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        json.dump(run_config(json.loads(args.run)), sys.stdout)
+        return
+
+    report = run_sweep(args)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#! /usr/bin/python3
+"""
+Compares split and interleaved encoding of a many channels input.
+
+Builds the real elkr Pipeline with a non live audiotestsrc feeding N channels
+and encodes the same audio once interleaved, with a single wavpack encoder,
+and once split, with one mono encoder per channel. Each run happens in its
+own process. The wall time gives the real-time factor and the per thread CPU
+time shows how the encoding is spread over the cores. The results are
+printed as JSON.
+"""
+
+import os, sys, json, time, argparse, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_rtf import thread_cpu_times
+
+SAMPLES_PER_BUFFER = 1024
+# Threads using less CPU than this are left out of the report
+MIN_THREAD_CPU_S = 0.05
+
+
+def run_config(split, rate, channels, mode, duration):
+    import gi
+    gi.require_version('GLib', '2.0')
+    gi.require_version('GObject', '2.0')
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst, GLib
+
+    sys.path.insert(0, ROOT)
+    from src.elkr.pipeline import Pipeline
+
+    Gst.init(None)
+
+    num_buffers = int(duration * rate / SAMPLES_PER_BUFFER)
+    audio_duration = num_buffers * SAMPLES_PER_BUFFER / rate
+
+    pipeline = Pipeline(encoder_mode=mode, metrics=False, verify=False, split_channels=split)
+
+    src = Gst.ElementFactory.make('audiotestsrc', None)
+    src.props.wave = 'pink-noise'
+    src.props.is_live = False
+    src.props.num_buffers = num_buffers
+    src.props.samplesperbuffer = SAMPLES_PER_BUFFER
+    caps = Gst.Caps.from_string(
+        f"audio/x-raw,format=S32LE,rate={rate},channels={channels},layout=interleaved"
+    )
+    pipeline.select_source(src, 'audiotestsrc', caps)
+
+    loop = GLib.MainLoop()
+    errors = []
+
+    def on_message(bus, message):
+        if message.type == Gst.MessageType.EOS:
+            loop.quit()
+        elif message.type == Gst.MessageType.ERROR:
+            err, _ = message.parse_error()
+            errors.append(err.message)
+            loop.quit()
+
+    pipeline.bus.connect('message', on_message)
+
+    cpu_before = thread_cpu_times()
+    started_at = time.monotonic()
+    pipeline.start()
+    loop.run()
+    elapsed = time.monotonic() - started_at
+    cpu_after = thread_cpu_times()
+    pipeline.stop()
+
+    threads = {
+        name: cpu - cpu_before.get(name, 0)
+        for name, cpu in cpu_after.items()
+    }
+    total_cpu = sum(threads.values())
+
+    return {
+        'split': split,
+        'errors': errors,
+        'audio_duration_s': audio_duration,
+        'wall_time_s': elapsed,
+        'rtf': elapsed / audio_duration,
+        'cpu_s': total_cpu,
+        # How many cores were kept busy on average
+        'parallelism': total_cpu / elapsed if elapsed > 0 else None,
+        'cpu_s_per_thread': {
+            name: cpu for name, cpu in threads.items() if cpu >= MIN_THREAD_CPU_S
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=int, default=48000)
+    parser.add_argument('--channels', type=int, default=16)
+    parser.add_argument('--mode', type=int, choices=[1, 2, 3, 4], default=4)
+    parser.add_argument('--duration', type=float, default=60.0,
+                        help="Seconds of audio encoded by each run")
+    parser.add_argument('--run', choices=['split', 'interleaved'], default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        result = run_config(args.run == 'split', args.rate, args.channels, args.mode, args.duration)
+        json.dump(result, sys.stdout)
+        return
+
+    runs = {}
+    for name in ('interleaved', 'split'):
+        print(f"Running {name}", file=sys.stderr)
+        proc = subprocess.run(
+            [sys.executable, __file__, '--run', name, '--rate', str(args.rate),
+             '--channels', str(args.channels), '--mode', str(args.mode),
+             '--duration', str(args.duration)],
+            stdout=subprocess.PIPE, text=True
+        )
+        if proc.returncode != 0:
+            runs[name] = {'errors': [f"exit code {proc.returncode}"]}
+        else:
+            runs[name] = json.loads(proc.stdout)
+
+    report = {
+        'meta': {'cpus': os.cpu_count(), 'rate': args.rate, 'channels': args.channels, 'mode': args.mode},
+        'runs': runs,
+    }
+    if not runs['interleaved']['errors'] and not runs['split']['errors']:
+        report['speedup'] = runs['interleaved']['wall_time_s'] / runs['split']['wall_time_s']
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
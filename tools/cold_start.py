@@ -0,0 +1,94 @@
+#! /usr/bin/python3
+"""
+Measures the time from launching the GUI to recording being possible.
+
+A cold start runs with an empty device cache, so the recorder has to wait for
+the device monitor. A warm start reuses the cache written by the previous run,
+which pre-selects the last used device. The time is taken when the status of
+the control socket first reports can_record. Results are printed as JSON.
+"""
+
+import os, sys, json, time, socket, argparse, tempfile, subprocess, statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAUNCHER = os.path.join(ROOT, 'elkr')
+
+
+def query_status(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(b"status\n")
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
+
+
+def wait_for_record(path, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if query_status(path).get('can_record'):
+                return True
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.005)
+    return False
+
+
+def run_once(cache_dir, timeout):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'elkr.sock')
+        env = dict(os.environ, XDG_CACHE_HOME=cache_dir)
+
+        started_at = time.monotonic()
+        proc = subprocess.Popen(
+            [sys.executable, LAUNCHER, '--socket', path],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            if not wait_for_record(path, timeout):
+                return None
+            elapsed = time.monotonic() - started_at
+            # Let the monitor reconcile and write the cache for the next run
+            time.sleep(1.0)
+            return elapsed
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+def summarize(runs):
+    runs = [r for r in runs if r is not None]
+    if len(runs) == 0:
+        return {'runs': 0}
+    return {
+        'runs': len(runs),
+        'record_enabled_s_median': statistics.median(runs),
+        'record_enabled_s_min': min(runs),
+        'record_enabled_s_max': max(runs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    args = parser.parse_args()
+
+    cold = []
+    warm = []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cold.append(run_once(cache_dir, args.timeout))
+            warm.append(run_once(cache_dir, args.timeout))
+
+    json.dump({'cold': summarize(cold), 'warm': summarize(warm)}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#! /usr/bin/python3
+"""
+Failover test of a recording whose volume disappears.
+
+Runs the real Pipeline with a live audiotestsrc and records to a first
+directory, preferably a small tmpfs. After a while the destination fails,
+either the way the UI reports a removed volume (the default) or for real
+with --fill, which fills the first directory until the writes fail. The
+audio then spills to RAM for --outage seconds before the recording resumes
+in a second directory and is stopped.
+
+The buffers reaching the sinks are compared with the encoded stream: the
+resumed file must start at or before the end of what the failed file wrote,
+and nothing encoded after the failure may be missing. A second sink that
+never fails must stay gapless. Exits with a non zero code when a check fails.
+
+To test on a tmpfs that really runs out of space:
+
+    mount -t tmpfs -o size=8m tmpfs /mnt/elkr-failover
+    python3 tools/failover_test.py --dir /mnt/elkr-failover --fill
+"""
+
+import os, sys, json, shutil, argparse, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FILL_BLOCK_BYTES = pow(1024, 2)
+# Tolerated difference between consecutive buffers
+GAP_TOLERANCE_NS = 1000000
+
+
+def fill_directory(path):
+    "Writes to path until the file system is full"
+    filler = os.path.join(path, 'filler')
+    block = b'\0' * FILL_BLOCK_BYTES
+    with open(filler, 'wb') as f:
+        try:
+            while True:
+                f.write(block)
+                f.flush()
+        except OSError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default='/dev/shm', help="Where the first file is recorded")
+    parser.add_argument('--resume-dir', default='/dev/shm', help="Where the recording resumes")
+    parser.add_argument('--before', type=float, default=3.0, help="Seconds recorded before the failure")
+    parser.add_argument('--outage', type=float, default=5.0, help="Seconds without a destination")
+    parser.add_argument('--after', type=float, default=3.0, help="Seconds recorded after resuming")
+    parser.add_argument('--fill', action='store_true', help="Fill the first directory instead of failing the sink")
+    args = parser.parse_args()
+
+    import gi
+    gi.require_version('GLib', '2.0')
+    gi.require_version('GObject', '2.0')
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst, GLib
+
+    sys.path.insert(0, ROOT)
+    from src.elkr.pipeline import Pipeline
+
+    Gst.init(None)
+
+    pipeline = Pipeline(encoder_mode=1, segment_duration_s=0, fsync_interval_s=0, verify=False)
+    src = Gst.ElementFactory.make('audiotestsrc', None)
+    src.props.is_live = True
+    src.props.wave = 'pink-noise'
+    pipeline.select_source(src, 'audiotestsrc', Gst.Caps.from_string('audio/x-raw,rate=48000,channels=2'))
+
+    out_dir = tempfile.mkdtemp(prefix='elkr-failover-', dir=args.dir)
+    resume_dir = tempfile.mkdtemp(prefix='elkr-failover-', dir=args.resume_dir)
+    paths = {
+        'failing': os.path.join(out_dir, 'failing.wv'),
+        'resumed': os.path.join(resume_dir, 'resumed.wv'),
+        'steady': os.path.join(resume_dir, 'steady.wv'),
+    }
+
+    loop = GLib.MainLoop()
+    written = {name: [] for name in list(paths) + ['encoded']}
+    results = {
+        'failed': False,
+        'resumed': False,
+        'finalized': 0,
+        'spill': None,
+        'errors': [],
+    }
+
+    def on_buffer(pad, info, name):
+        buf = info.get_buffer()
+        if not buf.has_flags(Gst.BufferFlags.HEADER):
+            written[name].append((buf.pts, buf.duration))
+        return Gst.PadProbeReturn.OK
+
+    def watch(name, h):
+        h['filesink'].get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, on_buffer, name)
+
+    pipeline['encoder'].get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, on_buffer, 'encoded')
+
+    def on_message(bus, message):
+        if message.type == Gst.MessageType.ERROR and message.src not in pipeline.failed_elements:
+            err, _ = message.parse_error()
+            results['errors'].append(err.message)
+            loop.quit()
+
+    def on_failed(_, path):
+        results['failed'] = True
+        GLib.timeout_add(int(args.outage * 1000), resume)
+
+    def on_removed(_, path):
+        results['finalized'] += 1
+        if results['finalized'] == 2:
+            loop.quit()
+
+    def start_recording():
+        watch('failing', pipeline.add_filesink(paths['failing']))
+        watch('steady', pipeline.add_filesink(paths['steady']))
+        GLib.timeout_add(int(args.before * 1000), fail)
+        return GLib.SOURCE_REMOVE
+
+    def fail():
+        if args.fill:
+            fill_directory(out_dir)
+        else:
+            pipeline.fail_filesink(paths['failing'])
+        return GLib.SOURCE_REMOVE
+
+    def resume():
+        h = pipeline.resume_filesink(paths['failing'], paths['resumed'])
+        if h is None:
+            results['errors'].append("unable to resume")
+            loop.quit()
+            return GLib.SOURCE_REMOVE
+        results['resumed'] = True
+        watch('resumed', h)
+        GLib.timeout_add(int(args.after * 1000), stop_recording)
+        return GLib.SOURCE_REMOVE
+
+    def stop_recording():
+        results['spill'] = pipeline.filesink_stats(paths['resumed'])['spill']
+        pipeline.remove_filesink(paths['resumed'])
+        pipeline.remove_filesink(paths['steady'])
+        return GLib.SOURCE_REMOVE
+
+    pipeline.bus.connect('message', on_message)
+    pipeline.connect('filesink-failed', on_failed)
+    pipeline.connect('filesink-removed', on_removed)
+
+    pipeline.start()
+    GLib.timeout_add(500, start_recording)
+    GLib.timeout_add_seconds(int(args.before + args.outage + args.after) + 30, loop.quit)
+    loop.run()
+    pipeline.stop()
+    shutil.rmtree(out_dir)
+    shutil.rmtree(resume_dir)
+
+    def gaps(buffers):
+        count = 0
+        for (pts, duration), (next_pts, _) in zip(buffers, buffers[1:]):
+            if next_pts > pts + duration + GAP_TOLERANCE_NS:
+                count += 1
+        return count
+
+    failing, resumed = written['failing'], written['resumed']
+    if len(failing) > 0 and len(resumed) > 0:
+        failed_end = failing[-1][0] + failing[-1][1]
+        # Negative when the resumed file overlaps the failed one
+        results['resume_gap_s'] = (resumed[0][0] - failed_end) / Gst.SECOND
+        results['resumed_gaps'] = gaps(resumed)
+        resumed_pts = {pts for pts, _ in resumed}
+        results['missing_buffers'] = sum(
+            1 for pts, _ in written['encoded']
+            if failed_end <= pts < resumed[-1][0] and pts not in resumed_pts
+        )
+    results['steady_gaps'] = gaps(written['steady'])
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+    failed = (
+        results['errors'] or not results['failed'] or not results['resumed'] or
+        results['finalized'] != 2 or results['steady_gaps'] or
+        results.get('resume_gap_s', 1) > GAP_TOLERANCE_NS / Gst.SECOND or
+        results.get('resumed_gaps') or results.get('missing_buffers')
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#! /usr/bin/python3
+"""
+Checks that the main loop stays responsive while the pipeline changes state.
+
+Runs the real Pipeline with a live audiotestsrc and cycles it --cycles
+times: switch to a new source while stopped, start, record for --hold
+seconds and stop. The first buffer of every start is held back in the
+streaming thread of the source for --stall seconds, the way a slow
+PipeWire or ALSA device opens, so each start completes asynchronously
+well after it was requested.
+
+A --tick ms timer runs on the main loop all along. How late it fires is
+the latency a UI would see, reported as percentiles. The time from each
+request to its completion callback is reported too. With --blocking,
+every request is followed by a get_state() waiting for its completion,
+as the pipeline used to do, to compare. Exits with a non zero code when
+the main loop was late by more than --max-late ms, or a cycle failed.
+"""
+
+import os, sys, json, time, argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PERCENTILES = (50, 90, 99, 100)
+WAVES = ('sine', 'pink-noise')
+
+
+def percentile(values, p):
+    "Nearest rank percentile of sorted values"
+    if len(values) == 0:
+        return None
+    rank = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[rank]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cycles', type=int, default=10)
+    parser.add_argument('--hold', type=float, default=1.0, help="Seconds recorded each cycle")
+    parser.add_argument('--stall', type=float, default=1.0, help="Seconds the first buffer of a start is held")
+    parser.add_argument('--tick', type=int, default=10, help="Interval of the latency timer in ms")
+    parser.add_argument('--max-late', type=float, default=100.0, help="Tolerated lateness of the timer in ms")
+    parser.add_argument('--blocking', action='store_true', help="Wait for every state change with get_state()")
+    args = parser.parse_args()
+
+    import gi
+    gi.require_version('GLib', '2.0')
+    gi.require_version('GObject', '2.0')
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst, GLib
+
+    sys.path.insert(0, ROOT)
+    from src.elkr.pipeline import Pipeline
+
+    Gst.init(None)
+
+    pipeline = Pipeline(encoder_mode=1, verify=False, metrics=False, segment_duration_s=0, fsync_interval_s=0)
+    caps = Gst.Caps.from_string('audio/x-raw,rate=48000,channels=2')
+
+    loop = GLib.MainLoop()
+    lateness = []
+    state = {
+        'cycle': 0,
+        'stall': False,
+        'requested_at': None,
+        'last_tick': None,
+    }
+    results = {
+        'switch_ms': [],
+        'start_ms': [],
+        'stop_ms': [],
+        'errors': [],
+    }
+
+    def on_tick():
+        now = time.monotonic()
+        if state['last_tick'] is not None:
+            lateness.append(max(0.0, (now - state['last_tick']) * 1000 - args.tick))
+        state['last_tick'] = now
+        return GLib.SOURCE_CONTINUE
+
+    def on_source_buffer(pad, info):
+        # From the streaming thread, the main loop must keep running
+        if state['stall']:
+            state['stall'] = False
+            time.sleep(args.stall)
+        return Gst.PadProbeReturn.OK
+
+    def wait_if_blocking():
+        if args.blocking:
+            pipeline.pipeline.get_state(Gst.CLOCK_TIME_NONE)
+
+    def elapsed_ms():
+        return (time.monotonic() - state['requested_at']) * 1000
+
+    def next_cycle():
+        if state['cycle'] == args.cycles:
+            loop.quit()
+            return GLib.SOURCE_REMOVE
+
+        started_at = time.monotonic()
+        src = Gst.ElementFactory.make('audiotestsrc', None)
+        src.props.is_live = True
+        src.props.wave = WAVES[state['cycle'] % len(WAVES)]
+        src.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, on_source_buffer)
+        pipeline.select_source(src, f"audiotestsrc-{state['cycle']}", caps)
+        results['switch_ms'].append((time.monotonic() - started_at) * 1000)
+
+        state['stall'] = True
+        state['requested_at'] = time.monotonic()
+        pipeline.start(on_started)
+        wait_if_blocking()
+        return GLib.SOURCE_REMOVE
+
+    def on_started(success):
+        results['start_ms'].append(elapsed_ms())
+        if not success:
+            results['errors'].append(f"start of cycle {state['cycle']} failed")
+            loop.quit()
+            return
+        GLib.timeout_add(int(args.hold * 1000), stop)
+
+    def stop():
+        state['requested_at'] = time.monotonic()
+        pipeline.stop(on_stopped)
+        wait_if_blocking()
+        return GLib.SOURCE_REMOVE
+
+    def on_stopped(success):
+        results['stop_ms'].append(elapsed_ms())
+        if not success:
+            results['errors'].append(f"stop of cycle {state['cycle']} failed")
+            loop.quit()
+            return
+        state['cycle'] += 1
+        GLib.idle_add(next_cycle)
+
+    def on_message(bus, message):
+        if message.type == Gst.MessageType.ERROR:
+            err, _ = message.parse_error()
+            results['errors'].append(err.message)
+            loop.quit()
+
+    pipeline.bus.connect('message', on_message)
+    GLib.timeout_add(args.tick, on_tick)
+    GLib.idle_add(next_cycle)
+    timeout = args.cycles * (args.hold + args.stall) + 30
+    GLib.timeout_add_seconds(int(timeout), loop.quit)
+    loop.run()
+    pipeline.stop()
+
+    lateness.sort()
+    results['cycles'] = state['cycle']
+    results['late_ms'] = {f"p{p}": percentile(lateness, p) for p in PERCENTILES}
+    results['ticks_late'] = sum(1 for late in lateness if late > args.max_late)
+    for key in ('switch_ms', 'start_ms', 'stop_ms'):
+        values = results[key]
+        results[key] = {'mean': sum(values) / len(values), 'max': max(values)} if len(values) > 0 else None
+    results['meta'] = {key: getattr(args, key) for key in ('cycles', 'hold', 'stall', 'tick', 'max_late', 'blocking')}
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+    failed = results['errors'] or results['cycles'] != args.cycles or results['ticks_late'] > 0
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
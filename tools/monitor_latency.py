@@ -0,0 +1,168 @@
+#! /usr/bin/python3
+"""
+Measures the end-to-end delay of the network monitor stream over loopback.
+
+Runs the real elkr Pipeline with a live audiotestsrc producing short ticks
+and a monitor stream to 127.0.0.1, while recording to a file so the monitor
+competes with the recording path as it would in use. A receiver pipeline in
+the same process depayloads and decodes the stream. The wall clock time of
+each tick onset is taken when it leaves the source and when it comes out of
+the decoder, the difference is the delay a remote listener would hear, on
+top of the network and of its own audio output. The results are printed as
+JSON.
+"""
+
+import os, sys, json, time, array, shutil, argparse, statistics, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RATE = 48000
+TICK_FREQ = 1000
+# Samples above this ratio of the full scale start a tick
+ONSET_THRESHOLD = 0.1
+# Ticks are this many seconds apart, onsets closer than half of it are ignored
+TICK_INTERVAL_S = 0.5
+
+
+class OnsetDetector:
+    "Wall clock times at which the ticks start in a stream of S16 buffers"
+
+    def __init__(self):
+        self.onsets = []
+        self.last_onset = None
+
+    def feed(self, data, channels, now, buffer_duration):
+        samples = array.array('h', data)
+        threshold = int(ONSET_THRESHOLD * 32767)
+        for i in range(0, len(samples), channels):
+            if abs(samples[i]) >= threshold:
+                # The time the onset sample would reach the end of the buffer
+                onset = now - buffer_duration * (1 - i / len(samples))
+                if self.last_onset is None or onset - self.last_onset > TICK_INTERVAL_S / 2:
+                    self.onsets.append(onset)
+                    self.last_onset = onset
+                return
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=None, metavar='MS',
+                        help="Monitor latency, the pipeline default when not given")
+    parser.add_argument('--jitter', type=float, default=20, metavar='MS',
+                        help="Latency of the receiver jitter buffer")
+    parser.add_argument('--port', type=int, default=5004)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--dir', default='/dev/shm', help="Where the concurrent recording is written")
+    args = parser.parse_args()
+
+    import gi
+    gi.require_version('GLib', '2.0')
+    gi.require_version('GObject', '2.0')
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst, GLib
+
+    sys.path.insert(0, ROOT)
+    from src.elkr.pipeline import Pipeline, MONITOR_PAYLOAD_TYPE
+
+    Gst.init(None)
+
+    receiver = Gst.parse_launch(
+        f"udpsrc address=127.0.0.1 port={args.port} "
+        f"caps=application/x-rtp,media=audio,encoding-name=OPUS,clock-rate=48000,payload={MONITOR_PAYLOAD_TYPE} ! "
+        f"rtpjitterbuffer latency={int(args.jitter)} ! rtpopusdepay ! opusdec ! "
+        f"audioconvert ! audio/x-raw,format=S16LE,channels=1 ! "
+        f"appsink name=appsink emit-signals=true sync=false"
+    )
+    received = OnsetDetector()
+
+    def on_new_sample(appsink):
+        now = time.monotonic()
+        sample = appsink.emit('pull-sample')
+        buf = sample.get_buffer()
+        received.feed(buf.extract_dup(0, buf.get_size()), 1, now, buf.duration / Gst.SECOND)
+        return Gst.FlowReturn.OK
+
+    receiver.get_by_name('appsink').connect('new-sample', on_new_sample)
+
+    pipeline = Pipeline(encoder_mode=1, segment_duration_s=0, fsync_interval_s=0, verify=False)
+    src = Gst.ElementFactory.make('audiotestsrc', None)
+    src.props.is_live = True
+    src.props.wave = 'ticks'
+    src.props.freq = TICK_FREQ
+    src.props.tick_interval = int(TICK_INTERVAL_S * Gst.SECOND)
+    src.props.samplesperbuffer = RATE // 100
+    pipeline.select_source(src, 'audiotestsrc',
+                           Gst.Caps.from_string(f"audio/x-raw,format=S16LE,rate={RATE},channels=1"))
+    sent = OnsetDetector()
+
+    def on_source_buffer(pad, info):
+        now = time.monotonic()
+        buf = info.get_buffer()
+        # The buffer was captured over the duration before it is pushed
+        sent.feed(buf.extract_dup(0, buf.get_size()), 1, now, buf.duration / Gst.SECOND)
+        return Gst.PadProbeReturn.OK
+
+    src.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, on_source_buffer)
+
+    loop = GLib.MainLoop()
+    errors = []
+
+    def on_message(bus, message):
+        if message.type == Gst.MessageType.ERROR:
+            err, _ = message.parse_error()
+            errors.append(err.message)
+            loop.quit()
+
+    pipeline.bus.connect('message', on_message)
+    receiver.get_bus().add_signal_watch()
+    receiver.get_bus().connect('message', on_message)
+
+    out_dir = tempfile.mkdtemp(prefix='elkr-monitor-', dir=args.dir)
+    monitor = pipeline.start_monitor('127.0.0.1', args.port, latency_ms=args.latency)
+    receiver.set_state(Gst.State.PLAYING)
+    pipeline.start()
+
+    def start_recording():
+        pipeline.add_filesink(os.path.join(out_dir, 'monitor.wv'))
+        return GLib.SOURCE_REMOVE
+
+    GLib.timeout_add(500, start_recording)
+    GLib.timeout_add(int(args.duration * 1000), loop.quit)
+    loop.run()
+
+    stats = pipeline.monitor_stats()
+    pipeline.stop_monitor()
+    pipeline.stop()
+    receiver.set_state(Gst.State.NULL)
+    shutil.rmtree(out_dir)
+
+    # Pairs every received onset with the last one sent before it
+    delays = []
+    for onset in received.onsets:
+        before = [s for s in sent.onsets if s <= onset]
+        if len(before) > 0 and onset - before[-1] < TICK_INTERVAL_S / 2:
+            delays.append((onset - before[-1]) * 1000)
+
+    result = {
+        'latency_ms': monitor['latency_ms'],
+        'frame_size_ms': monitor['frame_size_ms'],
+        'jitter_ms': args.jitter,
+        'ticks_sent': len(sent.onsets),
+        'ticks_received': len(received.onsets),
+        'overruns': stats['overruns'] if stats else None,
+        'errors': errors,
+    }
+    if len(delays) > 0:
+        result.update({
+            'delay_ms_min': min(delays),
+            'delay_ms_median': statistics.median(delays),
+            'delay_ms_max': max(delays),
+        })
+
+    json.dump(result, sys.stdout, indent=2)
+    print()
+    sys.exit(1 if errors or len(delays) == 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+#! /usr/bin/python3
+"""
+Continuity test of the pre-roll.
+
+Runs the real Pipeline with a pre-roll of --preroll seconds, fed by a live
+appsrc whose every sample holds its own index, on all channels, so a
+missing or repeated sample anywhere in a file shows. After --before
+seconds a WAV file is recorded for --after seconds, its first part coming
+out of the pre-roll and the rest live. This is repeated --takes times
+while the pipeline keeps running.
+
+Each file is checked the way tools/failover_test.py checks a resumed one:
+the buffers reaching the sink must follow each other without a gap, and
+the samples must be consecutive across the seam between the pre-roll and
+the live data. The file must start at least --preroll seconds before it
+was added, and the pre-roll queue must stay within its bound. Every take
+has its own WAV encoder, so each file must also start with a header whose
+data size was rewritten at its end. Exits with a non zero code when a
+check fails.
+"""
+
+import os, sys, json, time, shutil, struct, argparse, tempfile, threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RATE = 48000
+CHANNELS = 2
+BUFFER_FRAMES = 480
+# Tolerated difference between consecutive buffers
+GAP_TOLERANCE_NS = 1000000
+
+
+def read_wav_frames(path):
+    "The first channel of a S32LE WAV file, along with whether all channels agree"
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise ValueError(f"{path} is not a WAV file")
+
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id, size = struct.unpack_from('<4sI', data, offset)
+        if chunk_id == b'data':
+            # wavenc rewrites the size once the take ends, a wrong one means
+            # the file was never finalized by its encoder
+            if offset + 8 + size != len(data):
+                raise ValueError(f"{path} has a data size of {size} instead of {len(data) - offset - 8}")
+            samples = struct.unpack_from(f"<{size // 4}i", data, offset + 8)
+            frames = samples[::CHANNELS]
+            agree = all(samples[n::CHANNELS] == frames for n in range(1, CHANNELS))
+            return frames, agree
+        offset += 8 + size + size % 2
+    raise ValueError(f"No data in {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default='/dev/shm')
+    parser.add_argument('--preroll', type=float, default=2.0, help="Seconds of pre-roll")
+    parser.add_argument('--before', type=float, default=3.0, help="Seconds before the first take")
+    parser.add_argument('--after', type=float, default=2.0, help="Seconds recorded by each take")
+    parser.add_argument('--takes', type=int, default=3)
+    args = parser.parse_args()
+
+    import gi
+    gi.require_version('GLib', '2.0')
+    gi.require_version('GObject', '2.0')
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst, GLib
+
+    sys.path.insert(0, ROOT)
+    from src.elkr.pipeline import Pipeline, PREROLL_MARGIN_S
+
+    Gst.init(None)
+
+    pipeline = Pipeline(encoder_mode=1, verify=False, metrics=False, segment_duration_s=0, fsync_interval_s=0,
+                        preroll_seconds=args.preroll, default_format='wav')
+    caps = Gst.Caps.from_string(f"audio/x-raw,format=S32LE,layout=interleaved,rate={RATE},channels={CHANNELS}")
+    src = Gst.ElementFactory.make('appsrc', None)
+    src.props.is_live = True
+    src.props.format = Gst.Format.TIME
+    src.props.caps = caps
+    pipeline.select_source(src, 'counter', caps)
+
+    out_dir = tempfile.mkdtemp(prefix='elkr-preroll-', dir=args.dir)
+    loop = GLib.MainLoop()
+    pushing = threading.Event()
+    state = {'take': 0, 'base': None}
+    takes = []
+    errors = []
+
+    def push():
+        "Pushes counting samples in real time, stamped with the running time they were captured at"
+        frame = 0
+        while pushing.is_set():
+            element = pipeline.pipeline
+            clock = element.get_clock()
+            if clock is None:
+                time.sleep(0.01)
+                continue
+            if state['base'] is None:
+                state['base'] = clock.get_time() - element.get_base_time()
+            pts = state['base'] + Gst.util_uint64_scale(frame, Gst.SECOND, RATE)
+            duration = Gst.util_uint64_scale(BUFFER_FRAMES, Gst.SECOND, RATE)
+            # A live source pushes a buffer once it is captured
+            delay = (pts + duration - (clock.get_time() - element.get_base_time())) / Gst.SECOND
+            if delay > 0:
+                time.sleep(delay)
+
+            samples = [n for n in range(frame, frame + BUFFER_FRAMES) for _ in range(CHANNELS)]
+            buf = Gst.Buffer.new_wrapped(struct.pack(f"<{len(samples)}i", *samples))
+            buf.pts = pts
+            buf.duration = duration
+            buf.offset = frame
+            if src.emit('push-buffer', buf) != Gst.FlowReturn.OK:
+                return
+            frame += BUFFER_FRAMES
+
+    def on_buffer(pad, info, buffers):
+        buf = info.get_buffer()
+        if not buf.has_flags(Gst.BufferFlags.HEADER) and buf.pts != Gst.CLOCK_TIME_NONE:
+            buffers.append((buf.pts, buf.duration))
+        return Gst.PadProbeReturn.OK
+
+    def start_take():
+        path = os.path.join(out_dir, f"take-{state['take']}.wav")
+        take = {
+            'path': path,
+            'added_at': pipeline.running_time,
+            'preroll': pipeline.preroll_stats(),
+            'buffers': [],
+        }
+        h = pipeline.add_filesink(path)
+        if h is None:
+            errors.append(f"unable to record {path}")
+            loop.quit()
+            return GLib.SOURCE_REMOVE
+        h['filesink'].get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, on_buffer, take['buffers'])
+        takes.append(take)
+        GLib.timeout_add(int(args.after * 1000), stop_take, path)
+        return GLib.SOURCE_REMOVE
+
+    def stop_take(path):
+        pipeline.remove_filesink(path)
+        return GLib.SOURCE_REMOVE
+
+    def on_removed(_, path):
+        state['take'] += 1
+        if state['take'] == args.takes:
+            loop.quit()
+        else:
+            GLib.timeout_add(int(args.preroll * 1000), start_take)
+
+    def on_message(bus, message):
+        if message.type == Gst.MessageType.ERROR:
+            err, _ = message.parse_error()
+            errors.append(err.message)
+            loop.quit()
+
+    pipeline.bus.connect('message', on_message)
+    pipeline.connect('filesink-removed', on_removed)
+
+    pushing.set()
+    pusher = threading.Thread(target=push, daemon=True)
+    pusher.start()
+    pipeline.start()
+    GLib.timeout_add(int(args.before * 1000), start_take)
+    timeout = args.before + args.takes * (args.preroll + args.after) * 2 + 30
+    GLib.timeout_add_seconds(int(timeout), loop.quit)
+    loop.run()
+    pushing.clear()
+    pipeline.stop()
+    pusher.join()
+
+    def gaps(buffers):
+        count = 0
+        for (pts, duration), (next_pts, _) in zip(buffers, buffers[1:]):
+            if next_pts > pts + duration + GAP_TOLERANCE_NS:
+                count += 1
+        return count
+
+    results = {'takes': [], 'errors': errors}
+    bound_s = args.preroll + PREROLL_MARGIN_S
+    for take in takes:
+        result = {
+            'file': os.path.basename(take['path']),
+            'gaps': gaps(take['buffers']),
+            'preroll_level_s': take['preroll']['level_time'] if take['preroll'] else None,
+        }
+        try:
+            frames, agree = read_wav_frames(take['path'])
+        except (OSError, ValueError, struct.error) as err:
+            errors.append(str(err))
+            results['takes'].append(result)
+            continue
+
+        result['frames'] = len(frames)
+        result['channels_agree'] = agree
+        result['discontinuities'] = sum(1 for a, b in zip(frames, frames[1:]) if b != a + 1)
+        if len(frames) > 0 and take['added_at'] >= 0:
+            first_at = state['base'] + Gst.util_uint64_scale(frames[0], Gst.SECOND, RATE)
+            # How far before it was added the file starts
+            result['preroll_s'] = (take['added_at'] - first_at) / Gst.SECOND
+        results['takes'].append(result)
+    results['meta'] = {key: getattr(args, key) for key in ('preroll', 'before', 'after', 'takes')}
+
+    shutil.rmtree(out_dir)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+    tolerance_s = BUFFER_FRAMES / RATE
+    failed = errors or len(results['takes']) != args.takes or any(
+        take['gaps'] or take.get('discontinuities', 1) or not take.get('channels_agree') or
+        take.get('preroll_s', 0) < args.preroll - tolerance_s or
+        (take['preroll_level_s'] or 0) > bound_s
+        for take in results['takes']
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#! /usr/bin/python3
+"""
+Long run soak test looking for leaks across the recorder life cycles.
+
+Runs the real Pipeline with a live audiotestsrc recording to a tmpfs and
+loops through accelerated cycles, picked in turn:
+
+- take: records a short take to one or several files, then removes them
+- hotplug: the volume of a take disappears, its audio spills to RAM and
+  the take resumes on another directory, as the UI does when a volume is
+  yanked and another one is mounted
+- device: stops the pipeline, switches to a new source and starts again
+
+Every --sample-every cycles, it records the RSS, the open fds, the threads,
+the GStreamer elements and pads of the pipeline, the tee request pads and
+the highest tee pad index. Once done, the slope of each resource over the
+cycles after the warm up is compared with its threshold, and the harness
+exits with a non zero code when one grows faster. The tee pad indices grow
+with each request by design, they are reported but not checked. The
+samples and slopes are printed as JSON.
+"""
+
+import os, gc, sys, json, time, shutil, argparse, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CYCLES = ('take', 'hotplug', 'device')
+# Maximum growth per 1000 cycles
+SLOPE_THRESHOLDS = {
+    'rss_kib': 2048,
+    'fds': 1,
+    'threads': 1,
+    'elements': 1,
+    'pads': 1,
+    'tee_pads': 1,
+}
+
+
+def page_size_kib():
+    return os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def rss_kib():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * page_size_kib()
+
+
+def count_entries(path):
+    return len(os.listdir(path))
+
+
+def slope(points):
+    "Least squares slope of (x, y) points"
+    n = len(points)
+    if n < 2:
+        return 0.0
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    if var == 0:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cycles', type=int, default=3000)
+    parser.add_argument('--hold', type=float, default=0.1, help="Seconds a take records")
+    parser.add_argument('--outage', type=float, default=0.1, help="Seconds a hotplugged take spills")
+    parser.add_argument('--files', type=int, default=2, help="Files recorded by each take")
+    parser.add_argument('--sample-every', type=int, default=50)
+    parser.add_argument('--warmup', type=float, default=0.2,
+                        help="Ratio of the cycles left out of the slopes")
+    parser.add_argument('--dir', default='/dev/shm')
+    args = parser.parse_args()
+
+    import gi
+    gi.require_version('GLib', '2.0')
+    gi.require_version('GObject', '2.0')
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst, GLib
+
+    sys.path.insert(0, ROOT)
+    from src.elkr.pipeline import Pipeline
+
+    Gst.init(None)
+
+    pipeline = Pipeline(encoder_mode=1, segment_duration_s=0, fsync_interval_s=0, verify=False)
+    out_dir = tempfile.mkdtemp(prefix='elkr-soak-', dir=args.dir)
+    loop = GLib.MainLoop()
+    state = {'cycle': 0, 'pending': set(), 'sources': 0}
+    samples = []
+    errors = []
+
+    def new_source():
+        src = Gst.ElementFactory.make('audiotestsrc', None)
+        src.props.is_live = True
+        src.props.wave = 'pink-noise'
+        pipeline.select_source(src, f"soak-{state['sources']}",
+                               Gst.Caps.from_string('audio/x-raw,rate=48000,channels=2'))
+        state['sources'] += 1
+
+    def resources():
+        elements = 0
+        pads = 0
+        tee_pads = 0
+        tee_index = 0
+        for element in pipeline.pipeline.iterate_recurse():
+            elements += 1
+            pads += sum(1 for _ in element.iterate_pads())
+            if element.get_factory().get_name() == 'tee':
+                for pad in element.iterate_src_pads():
+                    tee_pads += 1
+                    tee_index = max(tee_index, int(pad.get_name().rpartition('_')[2]))
+        return {
+            'rss_kib': rss_kib(),
+            'fds': count_entries('/proc/self/fd'),
+            'threads': count_entries('/proc/self/task'),
+            'elements': elements,
+            'pads': pads,
+            'tee_pads': tee_pads,
+            'tee_pad_index': tee_index,
+        }
+
+    def sample():
+        gc.collect()
+        point = resources()
+        point['cycle'] = state['cycle']
+        point['time_s'] = time.monotonic() - started_at
+        samples.append(point)
+
+    def next_cycle():
+        if state['cycle'] % args.sample_every == 0:
+            sample()
+        if state['cycle'] == args.cycles:
+            loop.quit()
+            return GLib.SOURCE_REMOVE
+
+        kind = CYCLES[state['cycle'] % len(CYCLES)]
+        state['cycle'] += 1
+        if kind == 'take':
+            start_take()
+        elif kind == 'hotplug':
+            start_hotplug()
+        else:
+            switch_device()
+        return GLib.SOURCE_REMOVE
+
+    def path(name):
+        return os.path.join(out_dir, f"{state['cycle']:06}-{name}.wv")
+
+    def start_take():
+        paths = [path(f"take{n}") for n in range(args.files)]
+        for p in paths:
+            pipeline.add_filesink(p)
+        GLib.timeout_add(int(args.hold * 1000), stop_take, paths)
+
+    def stop_take(paths):
+        state['pending'].update(paths)
+        for p in paths:
+            pipeline.remove_filesink(p)
+        return GLib.SOURCE_REMOVE
+
+    def start_hotplug():
+        p = path('yanked')
+        pipeline.add_filesink(p)
+        GLib.timeout_add(int(args.hold * 1000), yank, p)
+
+    def yank(p):
+        pipeline.fail_filesink(p)
+        GLib.timeout_add(int(args.outage * 1000), resume, p)
+        return GLib.SOURCE_REMOVE
+
+    def resume(p):
+        resumed = path('resumed')
+        if pipeline.resume_filesink(p, resumed) is None:
+            errors.append(f"unable to resume {p}")
+            loop.quit()
+            return GLib.SOURCE_REMOVE
+        GLib.timeout_add(int(args.hold * 1000), stop_take, [resumed])
+        return GLib.SOURCE_REMOVE
+
+    def switch_device():
+        pipeline.stop()
+        new_source()
+        pipeline.start(lambda success: GLib.idle_add(next_cycle))
+
+    def on_removed(_, p):
+        state['pending'].discard(p)
+        if len(state['pending']) > 0:
+            return
+        # Every file of the cycle, including the yanked ones and the manifests
+        for name in os.listdir(out_dir):
+            os.unlink(os.path.join(out_dir, name))
+        GLib.idle_add(next_cycle)
+
+    def on_message(bus, message):
+        if message.type == Gst.MessageType.ERROR and message.src not in pipeline.failed_elements:
+            err, _ = message.parse_error()
+            errors.append(err.message)
+            loop.quit()
+
+    pipeline.bus.connect('message', on_message)
+    pipeline.connect('filesink-removed', on_removed)
+
+    new_source()
+    started_at = time.monotonic()
+    pipeline.start(lambda success: GLib.idle_add(next_cycle))
+    loop.run()
+    pipeline.stop()
+    shutil.rmtree(out_dir)
+
+    warm = [s for s in samples if s['cycle'] >= args.warmup * args.cycles]
+    slopes = {
+        name: slope([(s['cycle'], s[name]) for s in warm]) * 1000
+        for name in list(SLOPE_THRESHOLDS) + ['tee_pad_index']
+    }
+    growing = [name for name, limit in SLOPE_THRESHOLDS.items() if slopes[name] > limit]
+
+    json.dump({
+        'cycles': state['cycle'],
+        'duration_s': time.monotonic() - started_at,
+        'errors': errors,
+        'slopes_per_1000_cycles': slopes,
+        'thresholds_per_1000_cycles': SLOPE_THRESHOLDS,
+        'growing': growing,
+        'samples': samples,
+    }, sys.stdout, indent=2)
+    print()
+
+    sys.exit(1 if errors or growing or state['cycle'] != args.cycles else 0)
+
+
+if __name__ == '__main__':
+    main()
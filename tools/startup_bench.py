@@ -0,0 +1,87 @@
+#! /usr/bin/python3
+"""
+Compares the startup time and memory usage of the headless and GUI modes.
+
+Each mode is launched a few times, the startup time is the time until the
+control socket accepts connections, and the RSS is read from /proc once the
+recorder is up. Results are printed as JSON.
+"""
+
+import os, sys, json, time, socket, argparse, tempfile, subprocess, statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAUNCHER = os.path.join(ROOT, 'elkr')
+
+
+def read_rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return None
+
+
+def wait_for_socket(path, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.connect(path)
+                s.sendall(b"status\n")
+                s.recv(4096)
+                return True
+        except OSError:
+            time.sleep(0.005)
+    return False
+
+
+def run_once(mode, timeout):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'elkr.sock')
+        cmd = [sys.executable, LAUNCHER, '--socket', path]
+        if mode == 'headless':
+            cmd.append('--headless')
+
+        started_at = time.monotonic()
+        proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not wait_for_socket(path, timeout):
+                return None
+            elapsed = time.monotonic() - started_at
+            # Let the device monitor settle before sampling memory
+            time.sleep(0.5)
+            return {'startup_s': elapsed, 'rss_kb': read_rss_kb(proc.pid)}
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+def summarize(runs):
+    runs = [r for r in runs if r is not None]
+    if len(runs) == 0:
+        return {'runs': 0}
+    return {
+        'runs': len(runs),
+        'startup_s_median': statistics.median(r['startup_s'] for r in runs),
+        'startup_s_min': min(r['startup_s'] for r in runs),
+        'rss_kb_median': statistics.median(r['rss_kb'] for r in runs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--modes', nargs='+', default=['headless', 'gui'])
+    args = parser.parse_args()
+
+    results = {}
+    for mode in args.modes:
+        results[mode] = summarize(run_once(mode, args.timeout) for _ in range(args.runs))
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#! /usr/bin/python3
+"""
+Hot add/remove stress test of the filesinks.
+
+Runs the real Pipeline with a live audiotestsrc and adds/removes filesinks
+while it records, overlapping a few of them. It checks that the encoded
+stream and every sink branch stay gapless, that every removed sink is
+finalized, and measures how late the main loop runs while doing so.
+Exits with a non zero code when a check fails.
+"""
+
+import os, sys, json, time, random, shutil, argparse, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TICK_MS = 10
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sinks', type=int, default=100, help="Number of sinks to add and remove")
+    parser.add_argument('--overlap', type=int, default=4, help="Maximum number of sinks attached at once")
+    parser.add_argument('--min-hold', type=float, default=0.05, help="Minimum seconds a sink stays attached")
+    parser.add_argument('--max-hold', type=float, default=0.5, help="Maximum seconds a sink stays attached")
+    parser.add_argument('--dir', default='/dev/shm')
+    parser.add_argument('--max-latency-ms', type=float, default=50.0,
+                        help="Fail when the main loop runs later than this")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    import gi
+    gi.require_version('GLib', '2.0')
+    gi.require_version('GObject', '2.0')
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst, GLib
+
+    sys.path.insert(0, ROOT)
+    from src.elkr.pipeline import Pipeline
+
+    Gst.init(None)
+    random.seed(args.seed)
+
+    pipeline = Pipeline(encoder_mode=1, segment_duration_s=0, fsync_interval_s=0)
+    src = Gst.ElementFactory.make('audiotestsrc', None)
+    src.props.is_live = True
+    src.props.wave = 'pink-noise'
+    pipeline.select_source(src, 'audiotestsrc', Gst.Caps.from_string('audio/x-raw,rate=48000,channels=2'))
+
+    out_dir = tempfile.mkdtemp(prefix='elkr-stress-', dir=args.dir)
+    loop = GLib.MainLoop()
+    results = {
+        'added': 0,
+        'finalized': 0,
+        'sink_gaps': 0,
+        'stream_gaps': 0,
+        'max_loop_latency_ms': 0.0,
+        'errors': [],
+    }
+    attached = []
+    state = {'last_tick': None, 'last_end': None}
+
+    def on_encoded(pad, info):
+        buf = info.get_buffer()
+        if state['last_end'] is not None and buf.pts > state['last_end'] + Gst.MSECOND:
+            results['stream_gaps'] += 1
+        if buf.duration != Gst.CLOCK_TIME_NONE:
+            state['last_end'] = buf.pts + buf.duration
+        return Gst.PadProbeReturn.OK
+
+    pipeline['encoder'].get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, on_encoded)
+
+    def on_tick():
+        now = time.monotonic()
+        if state['last_tick'] is not None:
+            late = (now - state['last_tick']) * 1000 - TICK_MS
+            results['max_loop_latency_ms'] = max(results['max_loop_latency_ms'], late)
+        state['last_tick'] = now
+        return GLib.SOURCE_CONTINUE
+
+    def on_removed(_, path):
+        results['finalized'] += 1
+        if results['finalized'] == args.sinks:
+            loop.quit()
+
+    def remove_one(path):
+        results['sink_gaps'] += len(pipeline.filesinks[path]['stats']['gaps'])
+        attached.remove(path)
+        pipeline.remove_filesink(path)
+        return GLib.SOURCE_REMOVE
+
+    def add_one():
+        if results['added'] == args.sinks:
+            return GLib.SOURCE_REMOVE
+        if len(attached) >= args.overlap:
+            return GLib.SOURCE_CONTINUE
+
+        path = os.path.join(out_dir, f"stress-{results['added']}.wv")
+        pipeline.add_filesink(path)
+        attached.append(path)
+        results['added'] += 1
+        GLib.timeout_add(int(random.uniform(args.min_hold, args.max_hold) * 1000), remove_one, path)
+        return GLib.SOURCE_CONTINUE
+
+    def on_message(bus, message):
+        if message.type == Gst.MessageType.ERROR:
+            err, _ = message.parse_error()
+            results['errors'].append(err.message)
+            loop.quit()
+
+    pipeline.bus.connect('message', on_message)
+    pipeline.connect('filesink-removed', on_removed)
+    GLib.timeout_add(TICK_MS, on_tick)
+    GLib.timeout_add(int(args.min_hold * 1000 / 2), add_one)
+
+    started_at = time.monotonic()
+    pipeline.start()
+    loop.run()
+    results['duration_s'] = time.monotonic() - started_at
+    pipeline.stop()
+    shutil.rmtree(out_dir)
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+    failed = (
+        results['errors'] or results['stream_gaps'] or results['sink_gaps'] or
+        results['finalized'] != args.sinks or
+        results['max_loop_latency_ms'] > args.max_latency_ms
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
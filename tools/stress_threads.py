@@ -0,0 +1,180 @@
+#! /usr/bin/python3
+"""
+Measures what the thread policy saves from a CPU hog.
+
+Runs the real Pipeline with a live audiotestsrc recording to --files files
+with the slowest wavpack mode and the leak sink policy, so late encoders
+and writers show as dropped audio instead of blocking the capture. CPU
+hogs, --hogs processes spinning at the default priority, run alongside.
+The same run is made once without any thread policy and once with the one
+given on the command line, each in its own process. Each run reports:
+
+- the buffers the source pushed later than --late-ms after the end of
+  their capture, and the worst delay, which is how long the capture thread
+  was kept from running
+- the buffers the sinks dropped and the gaps they left
+- the CPU time of the streaming threads by role, and what the policy
+  could apply to each thread
+
+Real time scheduling requires CAP_SYS_NICE or an RLIMIT_RTPRIO, without
+them the capture threads fall back to a negative nice value, or nothing.
+The results are printed as JSON.
+"""
+
+import os, sys, json, time, shutil, argparse, tempfile, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIGS = ('default', 'policy')
+HOG = "while True: pass"
+
+
+def run_config(config, args, out_dir):
+    import gi
+    gi.require_version('GLib', '2.0')
+    gi.require_version('GObject', '2.0')
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst, GLib
+
+    sys.path.insert(0, ROOT)
+    from src.elkr.pipeline import Pipeline, SINK_POLICY_LEAK
+
+    Gst.init(None)
+
+    options = {}
+    if config == 'policy':
+        options = {
+            'thread_affinity': args.affinity,
+            'capture_priority': args.capture_priority,
+            'worker_nice': args.worker_nice,
+        }
+    pipeline = Pipeline(encoder_mode=4, sink_policy=SINK_POLICY_LEAK, verify=False, metrics=False,
+                        segment_duration_s=0, fsync_interval_s=0, **options)
+
+    src = Gst.ElementFactory.make('audiotestsrc', None)
+    src.props.is_live = True
+    src.props.wave = 'pink-noise'
+    src.props.samplesperbuffer = args.rate * args.buffer_ms // 1000
+    caps = Gst.Caps.from_string(f"audio/x-raw,format=S32LE,rate={args.rate},channels={args.channels}")
+    pipeline.select_source(src, 'audiotestsrc', caps)
+
+    late_ns = int(args.late_ms * Gst.MSECOND)
+    capture = {'buffers': 0, 'late': 0, 'max_delay_ms': 0.0}
+
+    def on_source_buffer(pad, info):
+        element = pipeline.pipeline
+        clock = element.get_clock()
+        buf = info.get_buffer()
+        if clock is None or buf.pts == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+        # A live source pushes a buffer once it is fully captured
+        delay = clock.get_time() - element.get_base_time() - (buf.pts + buf.duration)
+        capture['buffers'] += 1
+        if delay > late_ns:
+            capture['late'] += 1
+        capture['max_delay_ms'] = max(capture['max_delay_ms'], delay / Gst.MSECOND)
+        return Gst.PadProbeReturn.OK
+
+    src.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, on_source_buffer)
+
+    paths = [os.path.join(out_dir, f"{config}-{n}.wv") for n in range(args.files)]
+    loop = GLib.MainLoop()
+    errors = []
+    result = {}
+    pending = set(paths)
+
+    def on_message(bus, message):
+        if message.type == Gst.MessageType.ERROR:
+            err, _ = message.parse_error()
+            errors.append(err.message)
+            loop.quit()
+
+    def stop():
+        sinks = {os.path.basename(p): pipeline.filesink_stats(p) for p in paths}
+        result['dropped_buffers'] = sum(s['dropped_buffers'] for s in sinks.values())
+        result['gaps'] = sum(s['gaps'] for s in sinks.values())
+        result['threads'] = pipeline.thread_stats()
+        for path in paths:
+            pipeline.remove_filesink(path)
+        return GLib.SOURCE_REMOVE
+
+    def on_removed(_, path):
+        pending.discard(path)
+        if len(pending) == 0:
+            loop.quit()
+
+    pipeline.bus.connect('message', on_message)
+    pipeline.connect('filesink-removed', on_removed)
+
+    for path in paths:
+        pipeline.add_filesink(path)
+    pipeline.start()
+    GLib.timeout_add(int(args.duration * 1000), stop)
+    loop.run()
+    pipeline.stop()
+
+    result.update({
+        'config': config,
+        'errors': errors,
+        'capture': capture,
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=int, default=96000)
+    parser.add_argument('--channels', type=int, default=8)
+    parser.add_argument('--buffer-ms', type=int, default=10)
+    parser.add_argument('--files', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--hogs', type=int, default=2 * os.cpu_count(), help="CPU hog processes")
+    parser.add_argument('--late-ms', type=float, default=10.0)
+    parser.add_argument('--affinity', default=None, metavar='ROLE=CPUS;...')
+    parser.add_argument('--capture-priority', type=int, default=50)
+    parser.add_argument('--worker-nice', type=int, default=None)
+    parser.add_argument('--dir', default='/dev/shm')
+    parser.add_argument('--run', choices=CONFIGS, default=None, help=argparse.SUPPRESS)
+    args, _ = parser.parse_known_args()
+
+    if args.run is not None:
+        out_dir = tempfile.mkdtemp(prefix='elkr-threads-', dir=args.dir)
+        try:
+            result = run_config(args.run, args, out_dir)
+        finally:
+            shutil.rmtree(out_dir)
+        json.dump(result, sys.stdout)
+        return
+
+    runs = {}
+    for config in CONFIGS:
+        print(f"Running {config} with {args.hogs} CPU hogs", file=sys.stderr)
+        hogs = [subprocess.Popen([sys.executable, '-c', HOG]) for _ in range(args.hogs)]
+        try:
+            proc = subprocess.run(
+                [sys.executable, __file__, '--run', config] + sys.argv[1:],
+                stdout=subprocess.PIPE, text=True
+            )
+        finally:
+            for hog in hogs:
+                hog.kill()
+                hog.wait()
+        if proc.returncode != 0:
+            runs[config] = {'errors': [f"exit code {proc.returncode}"]}
+        else:
+            runs[config] = json.loads(proc.stdout)
+        # Let the machine settle between the runs
+        time.sleep(1)
+
+    report = {
+        'meta': {key: getattr(args, key) for key in ('rate', 'channels', 'buffer_ms', 'files', 'duration',
+                                                     'hogs', 'late_ms', 'affinity', 'capture_priority',
+                                                     'worker_nice')},
+        'runs': runs,
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()